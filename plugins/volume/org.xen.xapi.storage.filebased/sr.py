@@ -7,7 +7,9 @@ import urlparse
 
 from xapi.storage import log
 from xapi.storage.libs import util
+from xapi.storage.libs.libcow import statcache
 from xapi.storage.libs.libcow.coalesce import COWCoalesce
+from xapi.storage.libs.libcow.supervisor import JobsStillRunning
 from xapi.storage.libs.libcow.volume import COWVolume
 import xapi.storage.api.v5.volume
 
@@ -71,23 +73,35 @@ class Implementation(xapi.storage.api.v5.volume.SR_skeleton):
         # stop GC
         try:
             COWCoalesce.stop_gc(dbg, 'filebased', sr)
+        except JobsStillRunning:
+            # The volumes of the SR are still in use
+            raise
         except:
             log.debug('GC already stopped')
 
     def ls(self, dbg, sr):
         return COWVolume.ls(dbg, sr, filebased.Callbacks())
 
+    def ls_since(self, dbg, sr, generation):
+        return COWVolume.ls_since(dbg, sr, generation, filebased.Callbacks())
+
     def set_description(self, dbg, sr, new_description):
         util.update_sr_metadata(
             dbg, 'file://' + sr, {'description': new_description})
+        statcache.invalidate(dbg, sr)
 
     def set_name(self, dbg, sr, new_name):
         util.update_sr_metadata(dbg, 'file://' + sr, {'name': new_name})
+        statcache.invalidate(dbg, sr)
 
     def stat(self, dbg, sr):
         if not os.path.isdir(sr):
             raise xapi.storage.api.v5.volume.Sr_not_attached(sr)
+        return statcache.cached_stat(
+            dbg, sr, filebased.Callbacks(),
+            lambda: self._stat(dbg, sr))
 
+    def _stat(self, dbg, sr):
         # Get the filesystem size
         statvfs = os.statvfs(sr)
         psize = statvfs.f_blocks * statvfs.f_frsize
@@ -128,6 +142,8 @@ if __name__ == '__main__':
         cmd.detach()
     elif base == 'SR.ls':
         cmd.ls()
+    elif base == 'SR.ls_since':
+        util.sr_ls_since_commandline(Implementation())
     elif base == 'SR.set_description':
         cmd.set_description()
     elif base == 'SR.set_name':
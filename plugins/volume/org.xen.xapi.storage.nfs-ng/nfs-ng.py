@@ -1,7 +1,23 @@
 import xapi.storage.libs.libcow.callbacks
+from xapi.storage.libs.libcow import coalesce
+
+# Metabase changes made by other hosts raise no local inotify event
+GC_IDLE_TIMEOUT = 60
 
 
 class Callbacks(xapi.storage.libs.libcow.callbacks.Callbacks):
 
     def getVolumeUriPrefix(self, opq):
         return "nfs-ng/" + opq + "|"
+
+    def get_gc_idle_timeout(self, opq):
+        return GC_IDLE_TIMEOUT
+
+    def is_shared(self, opq):
+        return True
+
+    def get_background_tasks(self):
+        tasks = super(Callbacks, self).get_background_tasks()
+        # Datapath refreshes requested by the GC of other hosts
+        tasks.append(('refresher', coalesce.run_refresher))
+        return tasks
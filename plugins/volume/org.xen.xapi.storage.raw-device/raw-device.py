@@ -4,3 +4,7 @@ import xapi.storage.libs.libcow.callbacks
 class Callbacks(xapi.storage.libs.libcow.callbacks.Callbacks):
     def getVolumeUriPrefix(self, opq):
         return "raw-device/" + opq + "|"
+
+    def has_volume_pool(self, opq):
+        # The volumes are links to the configured devices
+        return False
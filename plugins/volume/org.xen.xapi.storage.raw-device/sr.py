@@ -8,7 +8,9 @@ import urlparse
 
 from xapi.storage import log
 from xapi.storage.libs import util
+from xapi.storage.libs.libcow import statcache
 from xapi.storage.libs.libcow.coalesce import COWCoalesce
+from xapi.storage.libs.libcow.supervisor import JobsStillRunning
 from xapi.storage.libs.libcow.volume import COWVolume
 import xapi.storage.api.v5.volume
 
@@ -71,6 +73,9 @@ class Implementation(xapi.storage.api.v5.volume.SR_skeleton):
         # stop GC
         try:
             COWCoalesce.stop_gc(dbg, 'raw-device', sr)
+        except JobsStillRunning:
+            # The volumes of the SR are still in use
+            raise
         except:
             log.debug('GC already stopped')
 
@@ -78,17 +83,27 @@ class Implementation(xapi.storage.api.v5.volume.SR_skeleton):
         return COWVolume.ls(
             dbg, sr, importlib.import_module('raw-device').Callbacks())
 
+    def ls_since(self, dbg, sr, generation):
+        return COWVolume.ls_since(
+            dbg, sr, generation, importlib.import_module('raw-device').Callbacks())
+
     def set_description(self, dbg, sr, new_description):
         util.update_sr_metadata(
             dbg, 'file://' + sr, {'description': new_description})
+        statcache.invalidate(dbg, sr)
 
     def set_name(self, dbg, sr, new_name):
         util.update_sr_metadata(dbg, 'file://' + sr, {'name': new_name})
+        statcache.invalidate(dbg, sr)
 
     def stat(self, dbg, sr):
         if not os.path.isdir(sr):
             raise xapi.storage.api.v5.volume.Sr_not_attached(sr)
+        return statcache.cached_stat(
+            dbg, sr, importlib.import_module('raw-device').Callbacks(),
+            lambda: self._stat(dbg, sr))
 
+    def _stat(self, dbg, sr):
         devices = util.get_sr_metadata(dbg, 'file://' + sr)['devices']
         total_size = 0
         for device in map(lambda x: os.path.realpath(x), devices):
@@ -128,6 +143,8 @@ if __name__ == '__main__':
         cmd.detach()
     elif base == 'SR.ls':
         cmd.ls()
+    elif base == 'SR.ls_since':
+        util.sr_ls_since_commandline(Implementation())
     elif base == 'SR.set_description':
         cmd.set_description()
     elif base == 'SR.set_name':
@@ -8,6 +8,7 @@ import xapi.storage.api.v5.volume
 
 from xapi.storage import log
 from xapi.storage.libs import util
+from xapi.storage.libs.libcow import statcache
 from xapi.storage.libs.libcow.callbacks import VolumeContext
 from xapi.storage.libs.libcow.imageformat import ImageFormat
 from xapi.storage.libs.libcow.lock import PollLock
@@ -17,6 +18,7 @@ from xapi.storage.libs.libcow.volume_implementation import Implementation as \
 
 @util.decorate_all_routines(util.log_exceptions_in_function)
 class Implementation(DefaultImplementation):
+    @statcache.invalidates
     def create(self, dbg, sr, name, description, size, sharable):
         devices = util.get_sr_metadata(dbg, 'file://' + sr)['devices']
         devices = map(lambda x: os.path.normpath(x), devices)
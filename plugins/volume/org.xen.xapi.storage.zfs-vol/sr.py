@@ -4,11 +4,13 @@ import importlib
 import os
 import os.path
 import sys
+import time
 import urlparse
 
 from xapi.storage import log
 from xapi.storage.libs import util
 from xapi.storage.common import call
+from xapi.storage.libs.libcow import psizecache, statcache, supervisor
 from xapi.storage.libs.libcow.imageformat import ImageFormat
 from xapi.storage.libs.libcow.volume import COWVolume
 from xapi.storage.libs.libcow.callbacks import VolumeContext
@@ -104,21 +106,89 @@ class Implementation(xapi.storage.api.v5.volume.SR_skeleton):
             mountpoint = zfsutils.pool_mountpoint(dbg, pool_name)
         except Exception:
             log.debug('{}: SR.attach: mountpoint for {} not found, import it'.format(dbg, pool_name))
-        else:
-            # SR.attach should be idempotent. So if the mountpoint is already
-            # mounted just return it.
-            return mountpoint
-
-        zfsutils.pool_import(dbg, pool_name)
-        return zfsutils.pool_mountpoint(dbg, configuration["zpool"])
+            zfsutils.pool_import(dbg, pool_name)
+            mountpoint = zfsutils.pool_mountpoint(dbg, configuration["zpool"])
+        # SR.attach should be idempotent. So if the mountpoint is already
+        # mounted just return it, the supervisor ignores a second
+        # registration.
+        cb = importlib.import_module('zfs-vol').Callbacks()
+        with VolumeContext(cb, mountpoint, 'w') as opq:
+            cb.upgrade_database(opq)
+        # Fill the pool of spare zvols
+        supervisor.register(dbg, 'zfs-vol', mountpoint)
+        return mountpoint
 
     def detach(self, dbg, sr):
+        try:
+            supervisor.unregister(dbg, 'zfs-vol', sr)
+        except supervisor.JobsStillRunning:
+            # The pool is still creating a zvol
+            raise
+        except Exception:
+            log.debug('{}: pool of spare zvols already stopped'.format(dbg))
         meta = util.get_sr_metadata(dbg, 'file://' + sr)
         # When the pool is exported it is also unmounted.
         zfsutils.pool_export(dbg, meta["zpool"])
 
-    def ls(self, dbg, sr):
+    def _ls_results(self, dbg, opq, cb, pool_name, vdis, all_custom_keys,
+                    psize_max_age):
         results = []
+
+        # The cached sizes are refreshed by SR.ls itself, with a single
+        # zfs call for all the stale ones
+        now = time.time()
+        stale = [vdi for vdi in vdis
+                 if not psizecache.is_fresh(vdi.volume, psize_max_age, now)]
+        if stale:
+            used = zfsutils.pool_get_used(dbg, pool_name)
+            # snapshot id is unique but its full name varies, see
+            # zfsutils.zvol_find_snap_path()
+            snap_used = dict(
+                (name.split("@")[1], value)
+                for name, value in used.items() if "@" in name)
+            measures = {}
+            for vdi in stale:
+                if vdi.volume.snap:
+                    psize = snap_used.get(str(vdi.volume.id))
+                else:
+                    psize = used.get(
+                        zfsutils.zvol_path(pool_name, vdi.volume.id))
+                if psize is None:
+                    log.error("volume %s not found on disk", vdi.volume.id)
+                else:
+                    measures[vdi.volume.id] = psize
+                vdi.volume.psize = psize
+            with cb.db_context(opq) as db:
+                db.update_volume_psizes(measures, now)
+
+        for vdi in vdis:
+            psize = vdi.volume.psize
+            if psize is None:
+                continue
+            image_format = ImageFormat.get_format(vdi.image_type)
+            is_snapshot = bool(vdi.volume.snap)
+
+            vdi_uri = cb.getVolumeUriPrefix(opq) + vdi.uuid
+            custom_keys = {}
+            if vdi.uuid in all_custom_keys:
+                custom_keys = all_custom_keys[vdi.uuid]
+
+            results.append({
+                'uuid': vdi.uuid,
+                'key': vdi.uuid,
+                'name': vdi.name,
+                'description': vdi.description,
+                'read_write': not is_snapshot,
+                'virtual_size': vdi.volume.vsize,
+                'physical_utilisation': psize,
+                'uri': [image_format.uri_prefix + vdi_uri],
+                'keys': custom_keys,
+                'sharable': bool(vdi.sharable)
+            })
+
+        return results
+
+    def ls(self, dbg, sr):
         meta = util.get_sr_metadata(dbg, 'file://' + sr)
         pool_name = meta["zpool"]
         cb = importlib.import_module('zfs-vol').Callbacks()
@@ -128,42 +198,43 @@ class Implementation(xapi.storage.api.v5.volume.SR_skeleton):
                 all_custom_keys = db.get_all_vdi_custom_keys()
                 for vdi in vdis:
                     zfsutils.zfsvol_vdi_sanitize(vdi, db)
+                psize_max_age = db.psize_max_age
 
-            for vdi in vdis:
-                image_format = ImageFormat.get_format(vdi.image_type)
-                is_snapshot = bool(vdi.volume.snap)
-                if is_snapshot:
-                    vol_name = zfsutils.zvol_find_snap_path(dbg, pool_name, vdi.volume.id)
-                    if vol_name is None:
-                        log.error("snapshot volume %s not found on disk", vdi.volume.id)
-                        continue
-                else:
-                    vol_name = zfsutils.zvol_path(pool_name, vdi.volume.id)
-                psize = zfsutils.vol_get_used(dbg, vol_name)
-
-                vdi_uri = cb.getVolumeUriPrefix(opq) + vdi.uuid
-                custom_keys = {}
-                if vdi.uuid in all_custom_keys:
-                    custom_keys = all_custom_keys[vdi.uuid]
-
-                results.append({
-                    'uuid': vdi.uuid,
-                    'key': vdi.uuid,
-                    'name': vdi.name,
-                    'description': vdi.description,
-                    'read_write': not is_snapshot,
-                    'virtual_size': vdi.volume.vsize,
-                    'physical_utilisation': psize,
-                    'uri': [image_format.uri_prefix + vdi_uri],
-                    'keys': custom_keys,
-                    'sharable': bool(vdi.sharable)
-                })
+            return self._ls_results(
+                dbg, opq, cb, pool_name, vdis, all_custom_keys,
+                psize_max_age)
 
-        return results
+    def ls_since(self, dbg, sr, generation):
+        "Incremental ls(), see COWVolume.ls_since()"
+        meta = util.get_sr_metadata(dbg, 'file://' + sr)
+        pool_name = meta["zpool"]
+        cb = importlib.import_module('zfs-vol').Callbacks()
+        with VolumeContext(cb, sr, 'r') as opq:
+            with cb.db_context(opq) as db:
+                full, vdis, all_custom_keys, deleted = \
+                    db.get_vdi_changes(generation)
+                for vdi in vdis:
+                    zfsutils.zfsvol_vdi_sanitize(vdi, db)
+                psize_max_age = db.psize_max_age
+                new_generation = db.generation
+
+            return {
+                'generation': new_generation,
+                'full': full,
+                'vdis': self._ls_results(
+                    dbg, opq, cb, pool_name, vdis, all_custom_keys,
+                    psize_max_age),
+                'deleted': deleted
+            }
 
     def stat(self, dbg, sr):
         if not os.path.isdir(sr):
             raise xapi.storage.api.v5.volume.Sr_not_attached(sr)
+        return statcache.cached_stat(
+            dbg, sr, importlib.import_module('zfs-vol').Callbacks(),
+            lambda: self._stat(dbg, sr))
+
+    def _stat(self, dbg, sr):
         meta = util.get_sr_metadata(dbg, 'file://' + sr)
         pool_name = meta["zpool"]
 
@@ -181,10 +252,12 @@ class Implementation(xapi.storage.api.v5.volume.SR_skeleton):
 
     def set_name(self, dbg, sr, new_name):
         util.update_sr_metadata(dbg, 'file://' + sr, {'name': new_name})
+        statcache.invalidate(dbg, sr)
 
     def set_description(self, dbg, sr, new_description):
         util.update_sr_metadata(
             dbg, 'file://' + sr, {'description': new_description})
+        statcache.invalidate(dbg, sr)
 
 
 if __name__ == '__main__':
@@ -204,6 +277,8 @@ if __name__ == '__main__':
         cmd.detach()
     elif base == 'SR.ls':
         cmd.ls()
+    elif base == 'SR.ls_since':
+        util.sr_ls_since_commandline(Implementation())
     elif base == 'SR.stat':
         cmd.stat()
     elif base == 'SR.set_name':
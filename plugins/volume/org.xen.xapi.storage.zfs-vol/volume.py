@@ -9,6 +9,7 @@ import xapi.storage.api.v5.volume
 
 from xapi.storage import log
 from xapi.storage.libs import util
+from xapi.storage.libs.libcow import statcache, volumepool
 from xapi.storage.libs.libcow.callbacks import VolumeContext
 from xapi.storage.libs.libcow.imageformat import ImageFormat
 from xapi.storage.libs.libcow.lock import PollLock
@@ -17,10 +18,13 @@ from xapi.storage.libs.libcow.volume_implementation import Implementation as \
 
 import zfsutils
 
+MEBIBYTE = 2**20
+
 @util.decorate_all_routines(util.log_exceptions_in_function)
 class Implementation(DefaultImplementation):
     "Volume driver to provide raw volumes from zvol's"
 
+    @statcache.invalidates
     def create(self, dbg, sr, name, description, size, sharable):
         meta = util.get_sr_metadata(dbg, 'file://' + sr)
         pool_name = meta["zpool"]
@@ -32,11 +36,17 @@ class Implementation(DefaultImplementation):
 
             with PollLock(opq, 'gl', self.callbacks, 0.5):
                 with self.callbacks.db_context(opq) as db:
-                    volume = db.insert_new_volume(size, image_type)
+                    # zfs set volsize wants a multiple of the block size
+                    volume = volumepool.claim(
+                        dbg, opq, db, self.callbacks,
+                        ((int(size) - 1) // MEBIBYTE + 1) * MEBIBYTE,
+                        image_type)
+                    if volume is None:
+                        volume = db.insert_new_volume(size, image_type)
+                        path = zfsutils.zvol_path(pool_name, volume.id)
+                        zfsutils.vol_create(dbg, path, size)
                     db.insert_vdi(
                         name, description, vdi_uuid, volume.id, sharable)
-                    path = zfsutils.zvol_path(pool_name, volume.id)
-                    zfsutils.vol_create(dbg, path, size)
 
                     vol_name = zfsutils.zvol_path(pool_name, volume.id)
                     volume.vsize = zfsutils.vol_get_size(dbg, vol_name)
@@ -60,6 +70,7 @@ class Implementation(DefaultImplementation):
             'keys': {}
         }
 
+    @statcache.invalidates
     def destroy(self, dbg, sr, key):
         meta = util.get_sr_metadata(dbg, 'file://' + sr)
         pool_name = meta["zpool"]
@@ -88,8 +99,12 @@ class Implementation(DefaultImplementation):
                         zfsutils.zpool_log_state(dbg, "before destroy {}".format(vol_name), pool_name)
                         # for each snapshot select a clone
                         vol_dependencies = []
-                        for vol_snap in zfsutils.zvol_get_snaphots(dbg, vol_name):
-                            snap_dependencies = tuple(zfsutils.zsnap_get_dependencies(dbg, vol_snap))
+                        vol_snaps = zfsutils.zvol_get_snaphots(dbg, vol_name)
+                        all_snap_dependencies = util.parallel_map(
+                            dbg,
+                            lambda vol_snap: tuple(zfsutils.zsnap_get_dependencies(dbg, vol_snap)),
+                            vol_snaps)
+                        for vol_snap, snap_dependencies in zip(vol_snaps, all_snap_dependencies):
                             if snap_dependencies:
                                 vol_dependencies.append(snap_dependencies[0])
                             else:
@@ -110,6 +125,7 @@ class Implementation(DefaultImplementation):
                     cb.volumeDestroy(opq, str(vdi.volume.id))
                     db.delete_volume(vdi.volume.id)
 
+    @statcache.invalidates
     def resize(self, dbg, sr, key, new_size):
         meta = util.get_sr_metadata(dbg, 'file://' + sr)
         pool_name = meta["zpool"]
@@ -169,6 +185,7 @@ class Implementation(DefaultImplementation):
             'sharable': False
         }
 
+    @statcache.invalidates
     def snapshot(self, dbg, sr, key):
         meta = util.get_sr_metadata(dbg, 'file://' + sr)
         pool_name = meta["zpool"]
@@ -210,6 +227,7 @@ class Implementation(DefaultImplementation):
         }
 
 
+    @statcache.invalidates
     def clone(self, dbg, sr, key):
         meta = util.get_sr_metadata(dbg, 'file://' + sr)
         pool_name = meta["zpool"]
@@ -254,6 +272,76 @@ class Implementation(DefaultImplementation):
             'sharable': False
         }
 
+    @statcache.invalidates
+    def clone_many(self, dbg, sr, key, count):
+        """
+        Create 'count' clones of a snapshot in one locked section and
+        one metabase transaction, running the 'zfs clone' commands
+        concurrently
+        """
+        if count < 1:
+            raise ValueError('Invalid number of clones: {}'.format(count))
+        meta = util.get_sr_metadata(dbg, 'file://' + sr)
+        pool_name = meta["zpool"]
+
+        cb = self.callbacks
+        with VolumeContext(cb, sr, 'w') as opq:
+            with PollLock(opq, 'gl', cb, 0.5):
+                created = []
+                try:
+                    with cb.db_context(opq) as db:
+                        vdi = db.get_vdi_by_id(key)
+                        zfsutils.zfsvol_vdi_sanitize(vdi, db)
+                        if not vdi.volume.snap:
+                            raise Exception('Only snapshots can be cloned!')
+                        snap_name = zfsutils.zvol_find_snap_path(
+                            dbg, pool_name, vdi.volume.id)
+                        image_format = ImageFormat.get_format(vdi.image_type)
+
+                        clones = []
+                        for _ in range(count):
+                            cloned_volume = db.insert_child_volume(
+                                vdi.volume.id, vdi.volume.vsize)
+                            clone_uuid = str(uuid.uuid4())
+                            db.insert_vdi(vdi.name, vdi.description,
+                                          clone_uuid, cloned_volume.id,
+                                          vdi.sharable)
+                            clones.append((clone_uuid, cloned_volume))
+
+                        def clone(clone_path):
+                            zfsutils.vol_clone(dbg, snap_name, clone_path)
+                            created.append(clone_path)
+
+                        util.parallel_map(dbg, clone, [
+                            zfsutils.zvol_path(pool_name, volume.id)
+                            for _, volume in clones])
+                except Exception:
+                    # The transaction was rolled back
+                    for clone_path in created:
+                        try:
+                            zfsutils.vol_destroy(dbg, clone_path)
+                        except Exception as exc:
+                            log.error('%s: cannot destroy %s: %s',
+                                      dbg, clone_path, exc)
+                    raise
+
+            uri_prefix = image_format.uri_prefix + cb.getVolumeUriPrefix(opq)
+
+        # The clones share the blocks of the snapshot
+        psize = zfsutils.vol_get_used(dbg, snap_name)
+        return [{
+            'uuid': new_uuid,
+            'key': new_uuid,
+            'name': str(new_volume.id),
+            'description': vdi.description,
+            'read_write': True,
+            'virtual_size': vdi.volume.vsize,
+            'physical_utilisation': psize,
+            'uri': [uri_prefix + new_uuid],
+            'keys': {},
+            'sharable': False
+        } for new_uuid, new_volume in clones]
+
 def call_volume_command():
     """Parse the arguments and call the required command"""
     log.log_call_argv()
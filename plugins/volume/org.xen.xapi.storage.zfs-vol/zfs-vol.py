@@ -1,6 +1,12 @@
 import os.path
+import time
 import xapi.storage.libs.libcow.callbacks
 
+import zfsutils
+
+# Seconds to wait for udev to create the device of a new zvol
+ZVOL_DEVICE_TIMEOUT = 10
+
 class Callbacks(xapi.storage.libs.libcow.callbacks.Callbacks):
     "ZFS-vol callbacks"
 
@@ -9,3 +15,38 @@ class Callbacks(xapi.storage.libs.libcow.callbacks.Callbacks):
 
     def volumeGetPath(self, opq, name):
         return os.path.join("/dev/zvol", os.path.basename(opq), name)
+
+    # The pool of spare volumes creates, resizes and destroys sparse
+    # zvols through the following, see volumepool
+
+    def volumeCreate(self, opq, name, size):
+        zfsutils.vol_create("volumeCreate",
+                            zfsutils.zvol_path(os.path.basename(opq), name),
+                            size)
+        vol_path = self.volumeGetPath(opq, name)
+        deadline = time.time() + ZVOL_DEVICE_TIMEOUT
+        while not os.path.exists(vol_path):
+            if time.time() >= deadline:
+                raise Exception("device %s of zvol not created" % vol_path)
+            time.sleep(0.1)
+        return vol_path
+
+    def volumeResize(self, opq, name, new_size):
+        zfsutils.vol_resize("volumeResize",
+                            zfsutils.zvol_path(os.path.basename(opq), name),
+                            new_size)
+
+    def volumeDestroy(self, opq, name):
+        # VDI.destroy already destroyed the zvols of the VDIs, snapshots
+        # have none of their own
+        zvol = zfsutils.zvol_path(os.path.basename(opq), name)
+        if zfsutils.vol_exists("volumeDestroy", zvol):
+            zfsutils.vol_destroy("volumeDestroy", zvol)
+        super(Callbacks, self).volumeDestroy(opq, name)
+
+    def has_gc(self):
+        # zvols are no COW images, zfs itself shares their blocks
+        return False
+
+    def get_background_tasks(self):
+        return []
@@ -1,8 +1,8 @@
 import os
-import subprocess
 
 import xapi
 from xapi.storage import log
+from xapi.storage.libs import spawn, util
 
 ###
 
@@ -13,11 +13,10 @@ def call(dbg, cmd_args, error=True, simple=True, expRc=0,
     "Fork of xapi.storage call() with retry on busy."
     while ntries:
         log.debug('%s: Running cmd %s', dbg, cmd_args)
-        proc = subprocess.Popen(
+        proc = spawn.popen(
             cmd_args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            close_fds=True)
+            stdout=spawn.PIPE,
+            stderr=spawn.PIPE)
         stdout, stderr = proc.communicate()
         if error and proc.returncode != expRc:
             log.error('%s: %s exitted with code %s: %s',
@@ -36,6 +35,20 @@ def call(dbg, cmd_args, error=True, simple=True, expRc=0,
 def call_retry(dbg, cmd_args, error=True, simple=True, expRc=0):
     return call(dbg, cmd_args, error=error, simple=simple, expRc=expRc, ntries=10)
 
+# Tag of the cached outputs of "zfs list", see util.cached_call()
+ZFS_CACHE_TAG = 'zfs'
+
+def call_cached(dbg, cmd_args):
+    "Read-only call() whose output is reused within the operation."
+    return util.cached_call(dbg, cmd_args, tags=(ZFS_CACHE_TAG,), caller=call)
+
+def call_mutating(dbg, cmd_args):
+    "call_retry() for commands changing the datasets."
+    try:
+        return call_retry(dbg, cmd_args)
+    finally:
+        util.invalidate_cached_calls((ZFS_CACHE_TAG,))
+
 ###
 
 MOUNT_ROOT = '/var/run/sr-mount'
@@ -56,7 +69,7 @@ def zvol_snap_path(pool_name, vol_id, snap_id):
 def zvol_find_snap_path(dbg, pool_name, snap_id):
     cmd = "zfs list -t snapshot -Hp -o name".split()
     snap_id = str(snap_id)
-    for this_snap_name in call(dbg, cmd).strip().splitlines():
+    for this_snap_name in call_cached(dbg, cmd).strip().splitlines():
         this_base, this_snap_id = this_snap_name.split("@")
         if this_snap_id == snap_id:
             return this_snap_name
@@ -64,11 +77,11 @@ def zvol_find_snap_path(dbg, pool_name, snap_id):
 
 def zvol_get_snaphots(dbg, vol_name):
     cmd = "zfs list -Hp -t snapshot -o name".split() + [vol_name]
-    return call(dbg, cmd).strip().splitlines()
+    return call_cached(dbg, cmd).strip().splitlines()
 
 def zsnap_get_dependencies(dbg, snap_name):
     cmd = "zfs list -Hp -o name,origin".split()
-    for entry in call(dbg, cmd).strip().splitlines():
+    for entry in call_cached(dbg, cmd).strip().splitlines():
         zvol, origin = entry.split("\t")
         if origin == snap_name:
             yield zvol
@@ -97,7 +110,7 @@ def pool_export(dbg, pool_name):
 
 def pool_destroy(dbg, pool_name):
     cmd = "zpool destroy".split() + [pool_name]
-    call_retry(dbg, cmd)
+    call_mutating(dbg, cmd)
 
 def pool_get_size(dbg, sr_path):
     # size is returned in bytes
@@ -116,6 +129,16 @@ def vol_get_used(dbg, vol_name):
     cmd = "zfs get -Hp -o value used".split() + [ vol_name ]
     return int(call(dbg, cmd))
 
+def pool_get_used(dbg, pool_name):
+    "Bytes used by each volume and snapshot of the pool, by name."
+    cmd = "zfs get -Hp -r -t volume,snapshot -o name,value used".split() + [
+        pool_name]
+    used = {}
+    for entry in call(dbg, cmd).strip().splitlines():
+        name, value = entry.split("\t")
+        used[name] = int(value)
+    return used
+
 def vol_get_size(dbg, vol_name):
     # size is returned in bytes
     cmd = "zfs get -Hp -o value volsize".split() + [ vol_name ]
@@ -125,27 +148,32 @@ def vol_create(dbg, zvol_path, size_mib):
     cmd = ("zfs create -s".split() + [zvol_path]
            + ['-V', str(size_mib)]
            )
-    call_retry(dbg, cmd)
+    call_mutating(dbg, cmd)
+
+def vol_exists(dbg, zvol_path):
+    cmd = "zfs list -H -o name".split() + [zvol_path]
+    returncode = call(dbg, cmd, error=False, simple=False)[2]
+    return returncode == 0
 
 def vol_destroy(dbg, zvol_path):
     cmd = "zfs destroy".split() + [zvol_path]
-    call_retry(dbg, cmd)
+    call_mutating(dbg, cmd)
 
 def vol_promote(dbg, zvol_path):
     cmd = "zfs promote".split() + [zvol_path]
-    call_retry(dbg, cmd)
+    call_mutating(dbg, cmd)
 
 def vol_resize(dbg, vol_path, new_size):
     cmd = "zfs set".split() + ['volsize={}'.format(new_size), vol_path]
-    call_retry(dbg, cmd)
+    call_mutating(dbg, cmd)
 
 def vol_snapshot(dbg, snap_name):
     cmd = "zfs snapshot".split() + [snap_name]
-    call_retry(dbg, cmd)
+    call_mutating(dbg, cmd)
 
 def vol_clone(dbg, snap_name, clone_name):
     cmd = "zfs clone".split() + [snap_name, clone_name]
-    call_retry(dbg, cmd)
+    call_mutating(dbg, cmd)
 
 ###
 
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from xapi.storage.libs.libcow.callbacks import Callbacks
+from xapi.storage.libs.libcow.imageformat import ImageFormat
+from xapi.storage.libs.libcow.vhdutil import VHDUtil
+from xapi.storage.libs.libcow.volume import COWVolume
+
+THIS_HOST = 'host1'
+
+
+class FakeCallbacks(Callbacks):
+    def getUniqueIdentifier(self, opq):
+        return THIS_HOST
+
+    def get_current_host(self):
+        return THIS_HOST
+
+    def get_data_metadata_path(self, opq, volume):
+        return os.path.join(opq, 'meta-' + volume)
+
+    def getVolumeUriPrefix(self, opq):
+        return 'file://test/'
+
+
+class SnapshotBatchTest(unittest.TestCase):
+    PATCHED = ('pause_datapath', 'unpause_datapath', 'online_snapshot',
+               'offline_snapshot', 'is_parent_pointing_to_path')
+
+    def setUp(self):
+        self.sr = tempfile.mkdtemp()
+        self.cb = FakeCallbacks()
+        self.cb.create_database(self.sr)
+        self.calls = []
+
+        self.saved = dict((name, VHDUtil.__dict__[name])
+                          for name in self.PATCHED)
+        VHDUtil.pause_datapath = staticmethod(
+            lambda dbg, meta: self.calls.append(('pause', meta)))
+        VHDUtil.unpause_datapath = staticmethod(
+            lambda dbg, meta, path: self.calls.append(
+                ('unpause', meta, path)))
+        VHDUtil.online_snapshot = staticmethod(self._snapshot)
+        VHDUtil.offline_snapshot = staticmethod(self._snapshot)
+        VHDUtil.is_parent_pointing_to_path = staticmethod(
+            lambda dbg, path, parent_path: True)
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(VHDUtil, name, value)
+        shutil.rmtree(self.sr)
+
+    def _snapshot(self, dbg, new_cow_path, parent_cow_path, force):
+        self.calls.append(('snapshot', new_cow_path, parent_cow_path))
+
+    def _add_volume(self, db, parent_id=None, snap=False):
+        if parent_id is None:
+            volume = db.insert_new_volume(2**30, ImageFormat.IMAGE_VHD)
+        else:
+            volume = db.insert_child_volume(parent_id, 2**30, snap)
+        open(os.path.join(self.sr, str(volume.id)), 'w').close()
+        return volume
+
+    def test_mixed_batch_with_active_snapshot(self):
+        with self.cb.db_context(self.sr) as db:
+            # An active VDI on a single volume
+            leaf = self._add_volume(db)
+            db.insert_vdi('disk', '', 'disk', leaf.id, False)
+            db.update_vdi_active_on('disk', THIS_HOST)
+            # An active snapshot VDI, its parent holds its data
+            parent = self._add_volume(db)
+            snap = self._add_volume(db, parent.id, True)
+            db.insert_vdi('snap', '', 'snap', snap.id, False)
+            db.update_vdi_active_on('snap', THIS_HOST)
+
+        results = COWVolume.snapshot_batch(
+            'test', self.sr, ['disk', 'snap'], self.cb)
+
+        self.assertEqual(len(results), 2)
+        with self.cb.db_context(self.sr) as db:
+            disk = db.get_vdi_by_id('disk')
+            snap_vdi = db.get_vdi_by_id('snap')
+        # The leaf of the snapshot VDI does not change
+        self.assertEqual(snap_vdi.volume.id, snap.id)
+        self.assertNotEqual(disk.volume.id, leaf.id)
+
+        # Only the datapath of the VDI moving to a new leaf is paused,
+        # then resumed on that leaf
+        meta = self.cb.get_data_metadata_path(self.sr, 'disk')
+        new_leaf_path = self.cb.volumeGetPath(self.sr, str(disk.volume.id))
+        self.assertEqual(
+            [call for call in self.calls if call[0] != 'snapshot'],
+            [('pause', meta), ('unpause', meta, new_leaf_path)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+"""
+Minimal ctypes wrapper around the Linux inotify API.
+
+Class:
+    Watcher: Watches directories and waits for events with a timeout.
+
+Exceptions:
+    InotifyError: Gets the last errno and raises an exception
+                  with the error and description
+"""
+
+from __future__ import absolute_import
+import errno
+import os
+import select
+import struct
+from ctypes import CDLL, get_errno, c_char_p, c_int, c_uint32
+
+__all__ = [
+    'Watcher', 'InotifyError',
+    'IN_MODIFY', 'IN_CLOSE_WRITE', 'IN_MOVED_FROM', 'IN_MOVED_TO',
+    'IN_CREATE', 'IN_DELETE', 'IN_Q_OVERFLOW',
+]
+
+_LIBC = CDLL('libc.so.6', use_errno=True)
+_LIBC.inotify_init1.argtypes = [c_int]
+_LIBC.inotify_add_watch.argtypes = [c_int, c_char_p, c_uint32]
+
+# Events - these match the ones in sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = 0o2000000
+
+# struct inotify_event header: wd, mask, cookie, len
+_EVENT_HEADER = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+
+class InotifyError(OSError):
+
+    """Creates [errno] - <strerror> Exceptions."""
+
+    def __init__(self):
+        err = get_errno()
+        super(InotifyError, self).__init__(err, os.strerror(err))
+
+
+class Watcher(object):
+    """
+    Set of inotify watches sharing one descriptor
+    """
+
+    def __init__(self):
+        self.fd = _LIBC.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            raise InotifyError()
+        self.paths = {}
+
+    def add_watch(self, path, mask):
+        """
+        Watch the directory 'path' for the events in 'mask'
+        """
+        wd = _LIBC.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            raise InotifyError()
+        self.paths[wd] = path
+        return wd
+
+    def read_events(self):
+        """
+        Return the pending (path, mask, name) events without blocking
+        """
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, _READ_SIZE)
+            except OSError as exc:
+                if exc.errno in (errno.EAGAIN, errno.EINTR):
+                    return events
+                raise
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, length = _EVENT_HEADER.unpack_from(buf, offset)
+                offset += _EVENT_HEADER.size
+                name = buf[offset:offset + length].rstrip('\0')
+                offset += length
+                events.append((self.paths.get(wd), mask, name))
+
+    def wait(self, timeout=None):
+        """
+        Wait up to 'timeout' seconds (forever if None) for events
+        """
+        try:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+        except select.error as exc:
+            if exc.args[0] != errno.EINTR:
+                raise
+            readable = []
+        if not readable:
+            return []
+        return self.read_events()
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        self.close()
+        return False
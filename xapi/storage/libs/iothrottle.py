@@ -0,0 +1,185 @@
+"""
+I/O budget for external commands.
+
+An IOThrottle holds token buckets of bytes/s and operations/s. Every
+process started with it is sampled through /proc/<pid>/io and stopped
+(SIGSTOP) for as long as it overdraws the budget, then resumed
+(SIGCONT). Unlike blkio cgroups this also works on NFS, which has no
+block device to throttle.
+
+The budget is shared by all the processes paced at once. The processes
+still stopped when this process exits are resumed, so that they do not
+stay stopped once their pacer is gone.
+"""
+
+from __future__ import absolute_import, division
+import atexit
+import errno
+import os
+import signal
+import threading
+import time
+
+from xapi.storage import log
+
+# Sampling period of the paced processes, in seconds
+PACE_PERIOD = 0.1
+
+# Period at which the budget is reloaded, in seconds
+RELOAD_PERIOD = 10
+
+# Pids stopped by the pacers of this process
+_STOPPED = set()
+_STOPPED_LOCK = threading.Lock()
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket allowing bursts of one second
+    """
+
+    def __init__(self, rate):
+        self.__lock = threading.Lock()
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.time()
+
+    def set_rate(self, rate):
+        with self.__lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, rate)
+
+    def consume(self, amount):
+        """
+        Take 'amount' tokens, return the seconds to wait to repay the debt
+        """
+        with self.__lock:
+            if not self.rate:
+                return 0
+            now = time.time()
+            self.tokens = min(
+                self.tokens + (now - self.last) * self.rate, self.rate)
+            self.last = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+def _read_proc_io(pid):
+    """
+    Return (bytes, operations) done so far by 'pid', None if it is gone
+    """
+    try:
+        with open('/proc/{}/io'.format(pid)) as proc_io:
+            counters = dict(
+                line.split(':', 1) for line in proc_io.read().splitlines())
+    except (IOError, OSError):
+        return None
+    return (int(counters['rchar']) + int(counters['wchar']),
+            int(counters['syscr']) + int(counters['syscw']))
+
+
+def _signal(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except OSError as exc:
+        if exc.errno != errno.ESRCH:
+            raise
+
+
+def _resume_stopped():
+    """
+    Resume the processes left stopped, called at exit
+    """
+    with _STOPPED_LOCK:
+        pids = list(_STOPPED)
+    for pid in pids:
+        _signal(pid, signal.SIGCONT)
+
+
+atexit.register(_resume_stopped)
+
+
+class Pacer(object):
+    """
+    Thread pacing one process, see IOThrottle.start()
+    """
+
+    def __init__(self, throttle, pid):
+        self.throttle = throttle
+        self.pid = pid
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __run(self):
+        last = _read_proc_io(self.pid)
+        while last is not None and not self.stopped.wait(PACE_PERIOD):
+            current = _read_proc_io(self.pid)
+            if current is None:
+                return
+            delay = self.throttle.consume(
+                current[0] - last[0], current[1] - last[1])
+            last = current
+            if delay > 0:
+                with _STOPPED_LOCK:
+                    _STOPPED.add(self.pid)
+                try:
+                    _signal(self.pid, signal.SIGSTOP)
+                    self.stopped.wait(delay)
+                finally:
+                    _signal(self.pid, signal.SIGCONT)
+                    with _STOPPED_LOCK:
+                        _STOPPED.discard(self.pid)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class IOThrottle(object):
+    """
+    Budget of bytes/s and IOPS, 0 meaning unlimited.
+
+    'reload', if given, is called regularly while processes are paced and
+    returns the current (bps, iops) so the budget can change at runtime.
+    """
+
+    def __init__(self, bps=0, iops=0, reload=None):
+        self.bytes = TokenBucket(bps)
+        self.ops = TokenBucket(iops)
+        self.reload = reload
+        self.last_reload = time.time()
+        self.__lock = threading.Lock()
+
+    def set_budget(self, bps, iops):
+        self.bytes.set_rate(bps)
+        self.ops.set_rate(iops)
+
+    def __maybe_reload(self):
+        if self.reload is None:
+            return
+        with self.__lock:
+            now = time.time()
+            if now - self.last_reload < RELOAD_PERIOD:
+                return
+            self.last_reload = now
+        try:
+            self.set_budget(*self.reload())
+        except Exception as exc:
+            log.error('Cannot reload the I/O budget: {}'.format(exc))
+
+    def consume(self, nr_bytes, nr_ops):
+        """
+        Charge the I/O done, return the seconds the process must pause
+        """
+        self.__maybe_reload()
+        return max(self.bytes.consume(nr_bytes), self.ops.consume(nr_ops))
+
+    def start(self, process):
+        """
+        Pace 'process' until Pacer.stop() is called
+        """
+        return Pacer(self, process.pid)
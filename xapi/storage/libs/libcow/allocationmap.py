@@ -0,0 +1,127 @@
+"""
+Block allocation maps for virtual disk images
+"""
+
+from __future__ import absolute_import, division
+
+# Number of bits set for every possible byte value
+_POPCOUNT = bytearray(bin(i).count('1') for i in range(256))
+
+
+class AllocationMap(object):
+    """
+    Bitmap of the blocks allocated in a single image of a chain.
+
+    Bit 'n' (most significant bit first) is set when block 'n' holds data
+    in the image itself, regardless of what its parents contain.
+    """
+
+    def __init__(self, block_size, vsize, bitmap=None):
+        self.block_size = block_size
+        self.vsize = vsize
+        self.nr_blocks = (vsize + block_size - 1) // block_size
+        if bitmap is None:
+            bitmap = bytearray((self.nr_blocks + 7) // 8)
+        self.bitmap = bitmap
+
+    @classmethod
+    def from_extents(cls, block_size, vsize, extents):
+        """
+        Build a map from a list of allocated (offset, length) byte ranges
+        """
+        allocation_map = cls(block_size, vsize)
+        for offset, length in extents:
+            allocation_map.set_range(offset, length)
+        return allocation_map
+
+    @classmethod
+    def fully_allocated(cls, block_size, vsize):
+        allocation_map = cls(block_size, vsize)
+        allocation_map.set_range(0, vsize)
+        return allocation_map
+
+    def set_block(self, block):
+        self.bitmap[block >> 3] |= 0x80 >> (block & 7)
+
+    def set_range(self, offset, length):
+        """
+        Mark every block overlapping the byte range as allocated
+        """
+        if length <= 0:
+            return
+        first = offset // self.block_size
+        last = min((offset + length - 1) // self.block_size,
+                   self.nr_blocks - 1)
+        block = first
+        while block <= last and block & 7:
+            self.set_block(block)
+            block += 1
+        # Whole bytes can be filled at once
+        full_bytes = (last + 1 - block) >> 3
+        if full_bytes > 0:
+            self.bitmap[block >> 3:(block >> 3) + full_bytes] = (
+                b'\xff' * full_bytes)
+            block += full_bytes << 3
+        while block <= last:
+            self.set_block(block)
+            block += 1
+
+    def is_allocated(self, block):
+        return bool(self.bitmap[block >> 3] & (0x80 >> (block & 7)))
+
+    def is_empty(self):
+        return self.bitmap.count(b'\x00') == len(self.bitmap)
+
+    def allocated_blocks(self):
+        return sum(self.bitmap.translate(_POPCOUNT))
+
+    def allocated_bytes(self):
+        """
+        Upper bound of the data held by the image, in bytes
+        """
+        return min(self.allocated_blocks() * self.block_size, self.vsize)
+
+    def overlap_bytes(self, other):
+        """
+        Upper bound of the data allocated in both maps, in bytes.
+
+        Both maps must use the same block size.
+        """
+        if other.block_size != self.block_size:
+            raise ValueError('Block sizes differ: {} != {}'.format(
+                self.block_size, other.block_size))
+        blocks = sum(
+            _POPCOUNT[mine & theirs]
+            for mine, theirs in zip(self.bitmap, other.bitmap))
+        return min(blocks * self.block_size, self.vsize, other.vsize)
+
+    def extents(self):
+        """
+        Yield the allocated (offset, length) byte ranges in order
+        """
+        start = None
+        for index, byte in enumerate(self.bitmap):
+            if byte == 0 and start is None:
+                continue
+            if byte == 0xff and start is not None:
+                continue
+            for bit in range(8):
+                block = (index << 3) + bit
+                if block >= self.nr_blocks:
+                    break
+                if byte & (0x80 >> bit):
+                    if start is None:
+                        start = block
+                elif start is not None:
+                    yield self.__extent(start, block)
+                    start = None
+        if start is not None:
+            yield self.__extent(start, self.nr_blocks)
+
+    def __extent(self, first, end):
+        offset = first * self.block_size
+        return offset, min(end * self.block_size, self.vsize) - offset
+
+    def __str__(self):
+        return 'AllocationMap(block_size={}, blocks={}/{})'.format(
+            self.block_size, self.allocated_blocks(), self.nr_blocks)
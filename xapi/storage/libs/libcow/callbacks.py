@@ -72,15 +72,24 @@ class VolumeLock(object):
 
 
 class VolumeContext(object):
+    """
+    Scope of an operation on an SR.
+
+    Read-only commands run through util.cached_call() are memoised
+    until the context exits.
+    """
 
     def __init__(self, callbacks, sr, mode):
         self.opq = callbacks.volumeStartOperations(sr, mode)
         self.callbacks = callbacks
+        self.command_cache = util.CommandCache()
 
     def __enter__(self):
+        self.command_cache.__enter__()
         return self.opq
 
     def __exit__(self, exc_type, value, traceback):
+        self.command_cache.__exit__(exc_type, value, traceback)
         self.callbacks.volumeStopOperations(self.opq)
 
 
@@ -104,14 +113,20 @@ class Callbacks(object):
         """
         util.mkdir_p(self.get_trash_dir(opq))
 
-    def empty_trash(self, opq):
+    def empty_trash(self, opq, rate=0, sleep=time.sleep):
+        """
+        Remove the trash files progressively, see util.reap_file().
+        Return False if interrupted by 'sleep'.
+        """
         try:
             dir = self.get_trash_dir(opq)
             for path in os.listdir(dir):
-                os.unlink(os.path.join(dir, path))
+                if not util.reap_file(os.path.join(dir, path), rate, sleep):
+                    return False
         except OSError as exc:
             if exc.errno != errno.ENOENT:
                 raise
+        return True
 
     def _get_trash_volume_path(self, opq, name):
         return os.path.join(self.get_trash_dir(opq), name)
@@ -209,9 +224,41 @@ class Callbacks(object):
         """
         return util.get_current_host()
 
+    def get_gc_idle_timeout(self, opq):
+        """
+        Seconds an idle GC waits before checking for work again. None to
+        wait for a local change of the metabase or of the trash directory.
+        """
+        return None
+
+    def is_shared(self, opq):
+        """
+        True if several hosts attach the SR at once, their GCs then elect
+        a leader, see lease.GCLease
+        """
+        return False
+
+    def has_gc(self):
+        """
+        False if the volumes of the SR are no COW images: the supervisor
+        then runs neither the GC nor the tasks serving it, only the pool
+        of spare volumes and get_background_tasks()
+        """
+        return True
+
+    def has_volume_pool(self, opq):
+        """
+        True if the new volumes of the SR are taken from a pool of spare
+        volumes, see volumepool
+        """
+        return True
+
     def get_background_tasks(self):
-        path = os.path.abspath(re.sub("pyc$", "py", db_backup.__file__))
-        return [('db_backup', path)]
+        """
+        Return the (name, function) of the tasks the supervisor runs for
+        the SR besides the GC. The function is called with the job.
+        """
+        return [('db_backup', db_backup.run_backup)]
 
     def get_database(self, opq):
         return VolumeMetabase(self.volumeMetadataGetPath(opq))
@@ -221,6 +268,15 @@ class Callbacks(object):
         db.create()
         db.close()
 
+    def upgrade_database(self, opq):
+        """
+        Upgrade the schema of the database of an attached SR
+        """
+        with Lock(opq, 'db', self):
+            db = self.get_database(opq)
+            db.upgrade()
+            db.close()
+
     @contextmanager
     def db_context(self, opq):
         """
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Benchmark of the bulk clone of a VDI against one clone per VDI.
+
+Clones a template VDI of an attached SR 1, 10, 100 and 1000 times (see
+--counts) with clone_many(), then with as many clone() calls when
+--sequential is given, and destroys the clones after each run.
+
+    clonebench.py [--counts N,...] [--sequential] [--json] \\
+        <sr_type> <uri> <vdi_uuid>
+"""
+
+from __future__ import absolute_import, division
+import argparse
+import importlib
+import json
+import sys
+import time
+
+from xapi.storage.libs import util
+from xapi.storage.libs.libcow import volume_implementation
+
+DBG = 'clonebench'
+
+DEFAULT_COUNTS = [1, 10, 100, 1000]
+
+
+def get_implementation(sr_type):
+    """
+    Volume implementation of an SR type, the one of libcow unless its
+    plugin overrides it
+    """
+    # Adds the plugin to the module search path
+    callbacks = util.get_sr_callbacks(sr_type)
+    module = importlib.import_module('volume')
+    implementation = getattr(
+        module, 'Implementation', volume_implementation.Implementation)
+    return implementation(callbacks)
+
+
+def _destroy(implementation, uri, clones):
+    for clone in clones:
+        implementation.destroy(DBG, uri, clone['key'])
+
+
+def run(implementation, uri, key, counts, sequential=False):
+    """
+    Return a {'count', 'bulk', 'sequential'} result per count, durations
+    in seconds
+    """
+    results = []
+    for count in counts:
+        result = {'count': count, 'bulk': None, 'sequential': None}
+
+        start = time.time()
+        clones = implementation.clone_many(DBG, uri, key, count)
+        result['bulk'] = time.time() - start
+        _destroy(implementation, uri, clones)
+
+        if sequential:
+            clones = []
+            start = time.time()
+            try:
+                for _ in range(count):
+                    clones.append(implementation.clone(DBG, uri, key))
+                result['sequential'] = time.time() - start
+            finally:
+                _destroy(implementation, uri, clones)
+        results.append(result)
+    return results
+
+
+def format_results(results):
+    lines = ['{:>6} {:>10} {:>10} {:>12} {:>8}'.format(
+        'clones', 'bulk (s)', 'per clone', 'one by one', 'speedup')]
+    for result in results:
+        sequential = result['sequential']
+        lines.append('{:>6} {:>10.3f} {:>8.1f}ms {:>12} {:>8}'.format(
+            result['count'], result['bulk'],
+            1000 * result['bulk'] / result['count'],
+            '-' if sequential is None else '{:.3f}'.format(sequential),
+            '-' if sequential is None else '{:.1f}x'.format(
+                sequential / result['bulk'])))
+    return '\n'.join(lines)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the bulk clone of a VDI')
+    parser.add_argument('--counts', default=','.join(
+        str(count) for count in DEFAULT_COUNTS),
+                        help='comma separated numbers of clones')
+    parser.add_argument('--sequential', action='store_true',
+                        help='also clone the VDI one clone at a time')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    parser.add_argument('sr_type')
+    parser.add_argument('uri')
+    parser.add_argument('vdi_uuid')
+    args = parser.parse_args(argv[1:])
+
+    counts = [int(count) for count in args.counts.split(',')]
+    results = run(get_implementation(args.sr_type), args.uri,
+                  args.vdi_uuid, counts, args.sequential)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(format_results(results))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,32 +1,118 @@
-#!/usr/bin/env python
 """
 Garbage collector and tree coalesce
 """
 
 from __future__ import absolute_import
+import errno
 import os
 import pickle
-import re
-import subprocess
-import sys
+import signal
 import time
 
 from xapi.storage import log
 from xapi.storage.libs import util
+from xapi.storage.libs.iothrottle import IOThrottle
 
 from xapi.storage.libs.libcow.callbacks import VolumeContext
+from xapi.storage.libs.libcow.costmodel import (
+    FIXED_COST, CostModel, ThroughputEstimator)
+from xapi.storage.libs.libcow import gcpolicy
+from xapi.storage.libs.libcow import gcstats
 from xapi.storage.libs.libcow.imageformat import ImageFormat
+from xapi.storage.libs.libcow import inbox
+from xapi.storage.libs.libcow.lease import GCLease
 from xapi.storage.libs.libcow.lock import PollLock
+from xapi.storage.libs.libcow.scheduler import GCScheduler
 
 
 # Debug string
 GC = 'GC'
 
 _MIB = 2**20
-_LEAF_COALESCE_MAX_SIZE = 20 * _MIB
+
+# Coalesce throughput assumed until one has been measured
+_INITIAL_COALESCE_RATE = 20 * _MIB
+
+# Coalesce throughput below which the measures are not trusted
+_MIN_COALESCE_RATE = 1 * _MIB
+
+# Number of snapshots taken to shrink a busy leaf before giving up on it
+# for _LEAF_COALESCE_BACKOFF seconds: its VM writes faster than the GC
+# coalesces
+_LEAF_COALESCE_MAX_ITERATIONS = 10
+_LEAF_COALESCE_BACKOFF = 3600
 
 PRIO_GC = 1
 
+# Maximum number of non-leaf coalesces running at once
+_NON_LEAF_COALESCE_MAX_WORKERS = 4
+
+# Maximum number of datapaths refreshed at once
+_REFRESH_MAX_WORKERS = 8
+
+# Daemons of an SR started before the supervisor, see _stop_legacy_tasks()
+LEGACY_TASKS = ('gc', 'db_backup')
+
+# The supervisor runs the GC of every SR in one process, hence the state
+# below is per SR unique identifier.
+
+# Ranks the candidates, keeps the write rates seen by this process
+_COST_MODELS = {}
+
+# Throughput of the non-leaf coalesces, paced by the I/O budget of the GC
+_COALESCE_RATES = {}
+
+# Throughput of the leaf coalesces, never throttled: sets the largest leaf
+# coalesced in a pause
+_LEAF_COALESCE_RATES = {}
+
+# VDI uuid -> snapshots taken to shrink its leaf, pruned of the VDIs
+# destroyed meanwhile
+_LEAF_ITERATIONS = {}
+
+# VDI uuid -> time until which its leaf is not coalesced
+_LEAF_BACKOFF = {}
+
+
+def _cost_model(opq, callbacks):
+    return _COST_MODELS.setdefault(
+        callbacks.getUniqueIdentifier(opq), CostModel())
+
+
+def _coalesce_rate(opq, callbacks, leaf=False):
+    rates = _LEAF_COALESCE_RATES if leaf else _COALESCE_RATES
+    return rates.setdefault(
+        callbacks.getUniqueIdentifier(opq),
+        ThroughputEstimator(_INITIAL_COALESCE_RATE, FIXED_COST,
+                            _MIN_COALESCE_RATE))
+
+
+def _leaf_iterations(opq, callbacks):
+    return _LEAF_ITERATIONS.setdefault(callbacks.getUniqueIdentifier(opq), {})
+
+
+def _leaf_backoff(opq, callbacks):
+    return _LEAF_BACKOFF.setdefault(callbacks.getUniqueIdentifier(opq), {})
+
+
+def __prune_leaf_state(opq, db, callbacks):
+    """
+    Forget the leaf coalesce attempts of the VDIs destroyed since
+    """
+    iterations = _leaf_iterations(opq, callbacks)
+    backoff = _leaf_backoff(opq, callbacks)
+    uuids = set(iterations) | set(backoff)
+    if not uuids:
+        return
+    existing = set(vdi.uuid for vdi in db.get_vdis_by_ids(list(uuids)))
+    for uuid in uuids - existing:
+        iterations.pop(uuid, None)
+        backoff.pop(uuid, None)
+
+
+def _gc_stats(opq, callbacks):
+    return gcstats.get_stats(callbacks.getUniqueIdentifier(opq))
+
 
 class VolumeLock(object):
     """
@@ -40,15 +126,52 @@ class VolumeLock(object):
 
 def __refresh_leaf_vdis(opq, callbacks, leaves):
     """
-    Refresh the supplied leaf VDIs to reload the delta tree
+    Refresh the supplied leaf VDIs to reload the delta tree.
+
+    The entries of a VDI are applied in order by one worker, or once if
+    its image format reloads the whole chain at each refresh. The
+    datapaths are independent and are refreshed concurrently.
     """
+    if not leaves:
+        return
+    refreshes = {}
     for leaf in leaves:
-        with callbacks.db_context(opq) as db:
-            vdi = db.get_vdi_by_id(leaf.leaf_id)
-        log.debug('Refreshing datapath for {}'.format(vdi.uuid))
-        refresh_live_cow_chain(vdi, leaf, callbacks, opq)
-        with callbacks.db_context(opq) as db:
-            db.remove_refresh_entry(vdi.uuid)
+        refreshes.setdefault(leaf.leaf_id, []).append(leaf)
+    with callbacks.db_context(opq) as db:
+        vdis = dict(
+            (vdi.uuid, vdi) for vdi in db.get_vdis_by_ids(refreshes.keys()))
+    # Entries of destroyed VDIs have nothing left to refresh
+    gone = set(refreshes) - set(vdis)
+    applied = []
+
+    def refresh(vdi_uuid):
+        vdi = vdis[vdi_uuid]
+        entries = refreshes[vdi_uuid]
+        image_utils = ImageFormat.get_format(vdi.image_type).image_utils
+        if image_utils.refresh_reloads_chain():
+            log.debug('Refreshing datapath for {}'.format(vdi_uuid))
+            refresh_live_cow_chain(vdi, entries[-1], callbacks, opq)
+            applied.extend(entries)
+            return
+        for entry in entries:
+            log.debug('Refreshing datapath for {}: {} -> {}'.format(
+                vdi_uuid, entry.old_parent, entry.new_parent))
+            refresh_live_cow_chain(vdi, entry, callbacks, opq)
+            applied.append(entry)
+
+    error = None
+    try:
+        util.parallel_map(GC, refresh, vdis.keys(),
+                          max_workers=_REFRESH_MAX_WORKERS)
+    except util.ParallelException as exc:
+        # The entries not applied are kept, to be retried in order
+        error = exc
+
+    with callbacks.db_context(opq) as db:
+        db.remove_refresh_entries(gone)
+        db.remove_applied_refresh_entries(applied)
+    if error:
+        raise error
 
 
 def __reparent_children(opq, callbacks, journal_entries):
@@ -83,6 +206,10 @@ def __reparent_children(opq, callbacks, journal_entries):
                     child.id, child.parent_id, child.new_parent_id, leaves)
                 log.debug("Children {}: leaves: {} will be refreshed".format(
                     child.id, [str(x) for x in leaves_to_refresh]))
+        if leaves:
+            # Wake up the hosts of the leaves now that the entries are
+            # committed
+            inbox.notify(opq, [leaf.active_on for leaf in leaves])
 
 
 def __find_non_leaf_coalesceable(database):
@@ -95,25 +222,49 @@ def __find_non_leaf_coalesceable(database):
     return results
 
 
-def __find_leaf_coalesceable(this_host, database):
+def __find_leaf_coalesceable(this_host, database, include_inactive=True):
     """
     Find all the leaf coalesable nodes from the database
     """
-    results = database.find_leaf_coalesceable(this_host)
+    results = database.find_leaf_coalesceable(this_host, include_inactive)
     if results:
         log.debug("Found {} leaf coalescable nodes".format(len(results)))
     return results
 
 
-def _find_best_leaf_coalesceable(this_host, uri, callbacks):
+def _find_best_leaf_coalesceable(this_host, uri, callbacks, throttle=None,
+                                 include_inactive=True):
     """
-    Find the next pair of COW nodes to be leaf coalesced
+    Find the next pair of COW nodes to be leaf coalesced, among the leaves
+    active on this host and the inactive ones if 'include_inactive'.
+
+    The candidates are ranked without the global SR lock, measuring their
+    images takes a while. They are checked again once it is taken back.
     """
     with VolumeContext(callbacks, uri, 'w') as opq:
+        cost_model = _cost_model(opq, callbacks)
         with PollLock(opq, 'gl', callbacks, PRIO_GC):
             with callbacks.db_context(opq) as db:
-                nodes = __find_leaf_coalesceable(this_host, db)
-            for node in nodes:
+                __prune_leaf_state(opq, db, callbacks)
+                nodes = __find_leaf_coalesceable(
+                    this_host, db, include_inactive)
+                candidates = cost_model.describe(db, nodes)
+        _gc_stats(opq, callbacks).record_backlog(
+            leaf_coalesceable=len(nodes))
+        if not candidates:
+            return False
+        candidates = cost_model.rank(GC, opq, callbacks, candidates)
+        backoff = _leaf_backoff(opq, callbacks)
+
+        with PollLock(opq, 'gl', callbacks, PRIO_GC):
+            with callbacks.db_context(opq) as db:
+                candidates = __still_coalesceable(
+                    candidates, db.find_leaf_coalesceable(
+                        this_host, include_inactive))
+            for candidate in candidates:
+                node = candidate.node
+                if __leaf_backed_off(candidate, backoff):
+                    continue
                 # Temp: no leaf on qcow2 for now
                 # Support of QCOW2 has been disabled, comment the code until we
                 # reenable it...
@@ -122,11 +273,104 @@ def _find_best_leaf_coalesceable(this_host, uri, callbacks):
                 with callbacks.db_context(opq) as db:
                     leaf, parent = __lock_node_pair(node, opq, db, callbacks)
                 if (leaf, parent) != (None, None):
-                    __leaf_coalesce(leaf, parent, opq, callbacks)
+                    __leaf_coalesce(leaf, parent, opq, callbacks, throttle)
                     return True
     return False
 
 
+def __still_coalesceable(candidates, nodes):
+    """
+    Keep the candidates whose node is still one of 'nodes', with the same
+    parent, and update their node
+    """
+    current = dict(((node.id, node.parent_id), node) for node in nodes)
+    still = []
+    for candidate in candidates:
+        node = current.get((candidate.node.id, candidate.node.parent_id))
+        if node is not None:
+            candidate.node = node
+            still.append(candidate)
+    return still
+
+
+def __leaf_backed_off(candidate, backoff):
+    for vdi, _ in candidate.leaves:
+        if backoff.get(vdi.uuid, 0) > time.time():
+            return True
+        backoff.pop(vdi.uuid, None)
+    return False
+
+
+def _allocated_bytes(image_utils, path):
+    """
+    Bytes of data held by an image, its physical size if unknown
+    """
+    try:
+        return image_utils.get_allocation_map(GC, path).allocated_bytes()
+    except Exception as exc:
+        log.debug('No allocation map for {}: {}'.format(path, exc))
+        return util.get_physical_file_size(path)
+
+
+def _timed_coalesce(opq, callbacks, image_utils, path, parent_path,
+                    throttle=None, leaf=False):
+    """
+    Coalesce 'path' into its parent and record the throughput, in the
+    estimator of the leaf coalesces if 'leaf'
+    """
+    rate = _coalesce_rate(opq, callbacks, leaf)
+    nr_bytes = _allocated_bytes(image_utils, path)
+    start = time.time()
+    with _gc_stats(opq, callbacks).coalescing(path, nr_bytes, rate.rate):
+        image_utils.coalesce(GC, path, parent_path, throttle)
+    rate.record(nr_bytes, time.time() - start)
+
+
+def _resumable_coalesce(opq, callbacks, image_utils, volume, parent,
+                        throttle=None):
+    """
+    Coalesce a large volume with progress checkpoints in the metabase so
+    that a restarted GC resumes it. Return False if the resumable
+    coalesce is disabled ('gc_resumable_coalesce_min' is 0), if the
+    volume is too small to be worth it or if its format does not support
+    it.
+    """
+    path = callbacks.volumeGetPath(opq, str(volume.id))
+    parent_path = callbacks.volumeGetPath(opq, str(parent.id))
+    with callbacks.db_context(opq) as db:
+        min_size = db.gc_resumable_coalesce_min
+        start_block = db.get_coalesce_checkpoint(volume.id, parent.id)
+        if min_size <= 0:
+            if start_block:
+                # Started before it was disabled: start over
+                db.remove_coalesce_checkpoint(volume.id)
+            return False
+    nr_bytes = _allocated_bytes(image_utils, path)
+    if not start_block and nr_bytes < min_size:
+        return False
+
+    def checkpoint(next_block):
+        with callbacks.db_context(opq) as db:
+            db.set_coalesce_checkpoint(volume.id, parent.id, next_block)
+
+    rate = _coalesce_rate(opq, callbacks)
+    start = time.time()
+    try:
+        with _gc_stats(opq, callbacks).coalescing(
+                path, nr_bytes, rate.rate):
+            image_utils.coalesce_resumable(
+                GC, path, parent_path, checkpoint, start_block, throttle)
+    except NotImplementedError as exc:
+        log.debug('No resumable coalesce for {}: {}'.format(volume.id, exc))
+        return False
+    if not start_block:
+        rate.record(nr_bytes, time.time() - start)
+
+    with callbacks.db_context(opq) as db:
+        db.remove_coalesce_checkpoint(volume.id)
+    return True
+
+
 def find_active_leaves(volume, database, leaf_accumulator):
     """
     Recursively find the active leaf nodes of the specified volume
@@ -158,10 +402,16 @@ def refresh_live_cow_chain(vdi, refresh, callbacks, opq):
         callbacks.volumeGetPath(opq, str(refresh.new_parent)))
 
 
-def __leaf_coalesce(leaf, parent, opq, callbacks):
+def __leaf_coalesce(leaf, parent, opq, callbacks, throttle=None):
     """
     Perform leaf volume coalesce.
 
+    The leaf is coalesced while its datapath is paused if the expected
+    pause, derived from the measured coalesce throughput, is short
+    enough. Otherwise the leaf is snapshotted: non_leaf_coalesce() moves
+    its data to the parent while the VM runs and the new leaf, holding
+    only the writes done meanwhile, is retried on a later pass.
+
     Must be called from inside a global SR lock.
     """
     leaf_volume = leaf.volume
@@ -174,25 +424,40 @@ def __leaf_coalesce(leaf, parent, opq, callbacks):
 
     leaf_path = callbacks.volumeGetPath(opq, str(leaf_volume.id))
     parent_path = callbacks.volumeGetPath(opq, str(parent_volume.id))
-    leaf_psize = os.path.getsize(leaf_path)
 
     try:
         with callbacks.db_context(opq) as db:
             vdi = db.get_vdi_for_volume(leaf_volume.id)
+            pause_target = db.gc_leaf_pause_target
         image_utils = ImageFormat.get_format(vdi.image_type).image_utils
 
         vdi_meta_path = callbacks.get_data_metadata_path(opq, vdi.uuid)
 
-        if leaf_psize < _LEAF_COALESCE_MAX_SIZE:
-            log.debug("Running leaf-coalesce on {}".format(leaf_volume.id))
+        leaf_size = _allocated_bytes(image_utils, leaf_path)
+        rate = _coalesce_rate(opq, callbacks, leaf=True)
+        max_size = rate.bytes_in(pause_target)
+        log.debug("Leaf {} holds {} bytes, {} can be coalesced in {}s".format(
+            leaf_volume.id, leaf_size, max_size, pause_target))
 
-            image_utils.coalesce(GC, leaf_path, parent_path)
+        if leaf_size <= max_size:
+            log.debug("Running leaf-coalesce on {}".format(leaf_volume.id))
 
+            # Writes must not reach the leaf once its data has been copied.
+            # Not throttled, the guest is waiting.
             if vdi.active_on:
                 image_utils.pause_datapath(GC, vdi_meta_path)
+            try:
+                _timed_coalesce(
+                    opq, callbacks, image_utils, leaf_path, parent_path,
+                    leaf=True)
 
-            with callbacks.db_context(opq) as db:
-                db.update_vdi_volume_id(vdi.uuid, leaf_volume.parent_id)
+                with callbacks.db_context(opq) as db:
+                    db.update_vdi_volume_id(vdi.uuid, leaf_volume.parent_id)
+            except Exception:
+                if vdi.active_on:
+                    image_utils.unpause_datapath(
+                        GC, vdi_meta_path, leaf_path)
+                raise
 
             if vdi.active_on:
                 image_utils.unpause_datapath(
@@ -201,7 +466,22 @@ def __leaf_coalesce(leaf, parent, opq, callbacks):
             with callbacks.db_context(opq) as db:
                 db.delete_volume(leaf_volume.id)
                 callbacks.volumeDestroy(opq, str(leaf_volume.id))
+            _leaf_iterations(opq, callbacks).pop(vdi.uuid, None)
         else:
+            leaf_iterations = _leaf_iterations(opq, callbacks)
+            iterations = leaf_iterations.get(vdi.uuid, 0) + 1
+            if iterations > _LEAF_COALESCE_MAX_ITERATIONS:
+                log.debug(
+                    "Leaf of {} still holds {} bytes after {} snapshots, "
+                    "retry in {}s".format(
+                        vdi.uuid, leaf_size, iterations - 1,
+                        _LEAF_COALESCE_BACKOFF))
+                del leaf_iterations[vdi.uuid]
+                _leaf_backoff(opq, callbacks)[vdi.uuid] = \
+                    time.time() + _LEAF_COALESCE_BACKOFF
+                return
+            leaf_iterations[vdi.uuid] = iterations
+
             # If the leaf is larger than the maximum size allowed for
             # a live leaf coalesce to happen, snapshot it and let
             # non_leaf_coalesce() take care of it.
@@ -238,35 +518,66 @@ def __leaf_coalesce(leaf, parent, opq, callbacks):
         callbacks.volumeUnlock(opq, parent.lock)
 
 
-def non_leaf_coalesce(node, parent, uri, callbacks):
+def non_leaf_coalesce(node, parent, uri, callbacks, throttle=None):
     """
     Perform non-leaf (mid tree) volume coalesce
     """
-    node_volume = node.volume
-    parent_volume = parent.volume
+    non_leaf_coalesce_batch([(node, parent)], uri, callbacks, throttle)
 
-    log.debug("non_leaf_coalesce key={}, parent={}".format(
-        node_volume.id, parent_volume.id))
 
-    with VolumeContext(callbacks, uri, 'w') as opq:
+def non_leaf_coalesce_batch(pairs, uri, callbacks, throttle=None):
+    """
+    Coalesce disjoint (node, parent) pairs concurrently, then reparent
+    the children of all the coalesced nodes under a single global lock.
+
+    The coalesces share the I/O budget of the optional IOThrottle.
+    """
+    def coalesce(pair):
+        node_volume = pair[0].volume
+        parent_volume = pair[1].volume
+        log.debug("non_leaf_coalesce key={}, parent={}".format(
+            node_volume.id, parent_volume.id))
         node_path = callbacks.volumeGetPath(opq, str(node_volume.id))
         parent_path = callbacks.volumeGetPath(opq, str(parent_volume.id))
         log.debug("Running cow-coalesce on {}".format(node_volume.id))
         image_utils = ImageFormat.get_format(
             node_volume.image_type).image_utils
-        image_utils.coalesce(GC, node_path, parent_path)
+        if not _resumable_coalesce(
+                opq, callbacks, image_utils, node_volume, parent_volume,
+                throttle):
+            _timed_coalesce(opq, callbacks, image_utils, node_path,
+                            parent_path, throttle)
+
+    with VolumeContext(callbacks, uri, 'w') as opq:
+        error = None
+        coalesced = pairs
+        try:
+            util.parallel_map(GC, coalesce, pairs,
+                              max_workers=_NON_LEAF_COALESCE_MAX_WORKERS)
+        except util.ParallelException as exc:
+            # Still reparent the children of the nodes that succeeded
+            error = exc
+            failed = [pair for pair, _ in exc.errors]
+            coalesced = [pair for pair in pairs if pair not in failed]
 
         with PollLock(opq, 'gl', callbacks, PRIO_GC):
-            with callbacks.db_context(opq) as db:
-                # reparent all of the children to this node's parent
-                children = db.get_children(node_volume.id)
-                journal_entries = db.add_journal_entries(
-                    node_volume.id, parent_volume.id, children)
+            try:
+                with callbacks.db_context(opq) as db:
+                    # reparent all of the children to this node's parent
+                    journal_entries = []
+                    for node, parent in coalesced:
+                        children = db.get_children(node.volume.id)
+                        journal_entries.extend(db.add_journal_entries(
+                            node.volume.id, parent.volume.id, children))
 
-            __reparent_children(opq, callbacks, journal_entries)
+                __reparent_children(opq, callbacks, journal_entries)
+            finally:
+                for node, parent in pairs:
+                    callbacks.volumeUnlock(opq, node.lock)
+                    callbacks.volumeUnlock(opq, parent.lock)
 
-            callbacks.volumeUnlock(opq, node.lock)
-            callbacks.volumeUnlock(opq, parent.lock)
+        if error:
+            raise error
 
 
 def __lock_node_pair(node, opq, database, callbacks):
@@ -283,40 +594,78 @@ def __lock_node_pair(node, opq, database, callbacks):
     return ret
 
 
-def _find_best_non_leaf_coalesceable(uri, callbacks):
+def _find_best_non_leaf_coalesceable(uri, callbacks,
+                                     max_pairs=_NON_LEAF_COALESCE_MAX_WORKERS):
     """
-    Find the next pair of COW nodes to be coalesced
+    Find up to 'max_pairs' pairs of COW nodes to be coalesced.
+
+    The candidates are tried in the order of the cost model, ranked
+    without the global SR lock and checked again under it. A volume is
+    locked by at most one pair, so the pairs returned are disjoint and
+    can be coalesced concurrently.
     """
     with VolumeContext(callbacks, uri, 'w') as opq:
-        ret = (None, None)
+        cost_model = _cost_model(opq, callbacks)
+        pairs = []
         with PollLock(opq, 'gl', callbacks, PRIO_GC):
             with callbacks.db_context(opq) as db:
                 nodes = __find_non_leaf_coalesceable(db)
-                for node in nodes:
-                    ret = __lock_node_pair(node, opq, db, callbacks)
+                candidates = cost_model.describe(db, nodes)
+        _gc_stats(opq, callbacks).record_backlog(
+            non_leaf_coalesceable=len(nodes))
+        if not candidates:
+            return pairs
+        candidates = cost_model.rank(GC, opq, callbacks, candidates)
+
+        with PollLock(opq, 'gl', callbacks, PRIO_GC):
+            with callbacks.db_context(opq) as db:
+                candidates = __still_coalesceable(
+                    candidates, db.find_non_leaf_coalesceable())
+                for candidate in candidates:
+                    ret = __lock_node_pair(
+                        candidate.node, opq, db, callbacks)
                     if ret != (None, None):
-                        break
-    return ret
+                        pairs.append(ret)
+                        if len(pairs) >= max_pairs:
+                            break
+    return pairs
 
 
-def recover_journal(uri, this_host, callbacks):
+def recover_journal(uri, this_host, callbacks, leader=True):
     """
-    Complete recover operations started in a different instance
+    Complete recover operations started in a different instance.
+
+    Only the GC leader replays the journal, the other hosts refresh the
+    leaves active on them.
     """
     with VolumeContext(callbacks, uri, 'w') as opq:
+        stats = _gc_stats(opq, callbacks)
+        if not leader:
+            # Spare the global SR lock to the leader when there is nothing
+            # to refresh
+            with callbacks.db_context(opq) as db:
+                if not db.get_refresh_entries(this_host):
+                    stats.record_backlog(refresh_backlog=0)
+                    return
+
         # Take the global SR lock, the coaleasce reparenting happens within
         # this lock, so if we can get it and if there are any pending
         # operations then a different process crashed or was aborted and we
         # need to complete the outstanding operations
         with PollLock(opq, 'gl', callbacks, PRIO_GC):
-            with callbacks.db_context(opq) as db:
-                # Get the journalled reparent operations
-                journal_entries = db.get_journal_entries()
-            __reparent_children(opq, callbacks, journal_entries)
+            if leader:
+                with callbacks.db_context(opq) as db:
+                    # Get the journalled reparent operations
+                    journal_entries = db.get_journal_entries()
+                __reparent_children(opq, callbacks, journal_entries)
 
             # Now refresh any leaves
             with callbacks.db_context(opq) as db:
                 refresh_entries = db.get_refresh_entries(this_host)
+                # The leader sees the refreshes of all the hosts
+                stats.record_backlog(refresh_backlog=(
+                    db.count_refresh_entries() if leader
+                    else len(refresh_entries)))
             __refresh_leaf_vdis(opq, callbacks, refresh_entries)
 
 
@@ -329,103 +678,221 @@ def remove_garbage_volumes(uri, callbacks):
             with callbacks.db_context(opq) as db:
                 garbage = db.get_garbage_volumes()
 
-            if len(garbage) > 0:
+            removed = 0
+            try:
                 for volume in garbage:
                     with callbacks.db_context(opq) as db:
                         db.delete_volume(volume.id)
                         callbacks.volumeDestroy(opq, str(volume.id))
-        callbacks.empty_trash(opq)
+                    removed += 1
+            finally:
+                _gc_stats(opq, callbacks).record_backlog(
+                    garbage_volumes=len(garbage) - removed)
 
 
-def start_task(dbg_msg, uri, callbacks, name, args):
+def gc_is_enabled(uri, callbacks):
     with VolumeContext(callbacks, uri, 'w') as opq:
-        task = subprocess.Popen(args)
-        log.debug(dbg_msg)
-        path = os.path.join(util.var_run_prefix(), 'sr',
-                            callbacks.getUniqueIdentifier(opq))
-        try:
-            os.makedirs(path)
-        except OSError:
-            pass
-        path = os.path.join(path, name + '_task.pickle')
-        with open(path, 'w+') as f:
-            pickle.dump(task, f)
+        return not os.path.exists(os.path.join(
+            '/var/lib/sr',
+            callbacks.getUniqueIdentifier(opq),
+            'gc_disabled'
+        ))
 
 
-def stop_task(dbg_msg, uri, callbacks, name):
-    def stop():
-        with VolumeContext(callbacks, uri, 'w') as opq:
-            path = os.path.join(util.var_run_prefix(), 'sr',
-                                callbacks.getUniqueIdentifier(opq),
-                                name + '_task.pickle')
-            with open(path) as f:
-                process = pickle.load(f)
-            process.kill()
-            process.wait()
-            os.unlink(path)
+def has_pending_work(uri, this_host, callbacks, leader=True):
+    """
+    Cheap check for GC work, does not take the global SR lock
+    """
+    with VolumeContext(callbacks, uri, 'w') as opq:
+        with callbacks.db_context(opq) as db:
+            return db.has_pending_gc_work(this_host, leader)
 
-    try:
-        with util.timeout(5):
-            stop()
-    except util.TimeoutException:
-        log.error('Timeout reached for task: {}'.format(name))
-    log.debug(dbg_msg)
+
+def get_io_budget(uri, callbacks):
+    """
+    Return the (bytes/s, IOPS) budget of the GC, 0 means unlimited
+    """
+    with VolumeContext(callbacks, uri, 'w') as opq:
+        with callbacks.db_context(opq) as db:
+            return db.gc_io_bps, db.gc_io_iops
 
 
-def start_background_tasks(dbg, sr_type, uri, callbacks):
-    tasks = callbacks.get_background_tasks()
-    if tasks:
-        for name, path in tasks:
-            args = [path, sr_type, uri]
-            dbg_msg = "{}: Starting {} sr_type={} uri={}".format(
-                dbg, name, sr_type, uri)
-            start_task(dbg_msg, uri, callbacks, name, args)
+def make_io_throttle(uri, callbacks, policy=None):
+    """
+    IOThrottle following the budget set in the SR configuration, lifted
+    during the maintenance windows of the policy
+    """
+    def reload():
+        if policy and policy.in_maintenance_window():
+            return 0, 0
+        return get_io_budget(uri, callbacks)
 
+    bps, iops = reload()
+    return IOThrottle(bps, iops, reload=reload)
 
-def gc_is_enabled(uri, callbacks):
+
+def load_policy(uri, callbacks, policy):
+    """
+    Refresh the GC policy from the SR configuration
+    """
     with VolumeContext(callbacks, uri, 'w') as opq:
-        return not os.path.exists(os.path.join(
-            '/var/lib/sr',
-            callbacks.getUniqueIdentifier(opq),
-            'gc_disabled'
-        ))
+        with callbacks.db_context(opq) as db:
+            policy.load_configuration(db)
 
 
-def run_coalesce(sr_type, uri):
+def record_max_chain_height(uri, callbacks):
     """
-    GC/Coalesce main loop
+    Record the height of the longest chain in the GC statistics
     """
-    util.daemonize()
+    with VolumeContext(callbacks, uri, 'w') as opq:
+        with callbacks.db_context(opq) as db:
+            height = db.get_max_chain_height()
+        _gc_stats(opq, callbacks).record_backlog(max_chain_height=height)
 
-    callbacks = util.get_sr_callbacks(sr_type)
-    this_host = callbacks.get_current_host()
 
-    while gc_is_enabled(uri, callbacks):
-        done_work = False
-        try:
-            remove_garbage_volumes(uri, callbacks)
+def run_gc_pass(uri, this_host, callbacks, throttle=None,
+                level=gcpolicy.QUIET, leader=True):
+    """
+    Run one unit of GC work, return True if something was coalesced.
+
+    Coalesces are deferred when the load 'level' is OVERLOADED and run
+    one at a time when it is BUSY. Unless 'leader', only the leaves
+    active on this host are handled.
+    """
+    if leader:
+        remove_garbage_volumes(uri, callbacks)
+
+    recover_journal(uri, this_host, callbacks, leader)
 
-            recover_journal(uri, this_host, callbacks)
+    if level == gcpolicy.OVERLOADED:
+        return False
 
-            child, parent = _find_best_non_leaf_coalesceable(uri, callbacks)
-            if (child, parent) != (None, None):
-                non_leaf_coalesce(child, parent, uri, callbacks)
-                done_work = True
-            elif _find_best_leaf_coalesceable(this_host, uri, callbacks):
-                done_work = True
+    if leader:
+        max_pairs = _NON_LEAF_COALESCE_MAX_WORKERS
+        if level == gcpolicy.BUSY:
+            max_pairs = 1
+        pairs = _find_best_non_leaf_coalesceable(uri, callbacks, max_pairs)
+        if pairs:
+            non_leaf_coalesce_batch(pairs, uri, callbacks, throttle)
+            return True
+    return _find_best_leaf_coalesceable(
+        this_host, uri, callbacks, throttle, include_inactive=leader)
 
-            # If we did no work then delay by some time
-            if not done_work:
-                time.sleep(30)
+
+def run_gc(job):
+    """
+    GC/Coalesce main loop of an SR, run by the supervisor until the job
+    is stopped or the GC is disabled
+    """
+    uri, callbacks = job.uri, job.callbacks
+    this_host = callbacks.get_current_host()
+    with VolumeContext(callbacks, uri, 'w') as opq:
+        scheduler = GCScheduler(opq, callbacks)
+        policy = gcpolicy.GCPolicy(opq)
+        stats = _gc_stats(opq, callbacks)
+        lease = None
+        if callbacks.is_shared(opq):
+            lease = GCLease(opq, callbacks, this_host)
+    job.on_stop(scheduler.interrupt)
+    try:
+        if lease:
+            lease.start()
+        load_policy(uri, callbacks, policy)
+        throttle = make_io_throttle(uri, callbacks, policy)
+
+        while not job.stopping and gc_is_enabled(uri, callbacks):
+            load_policy(uri, callbacks, policy)
+            level = policy.level()
+            leader = lease is None or lease.is_leader()
+
+            # Keep going while there are candidates, a pass only
+            # coalesces a few pairs. Slow down when the host is busy.
+            with job.work():
+                stats.pass_started()
+                worked = run_gc_pass(
+                    uri, this_host, callbacks, throttle, level, leader)
+            stats.pass_done()
+            # Changes of the SR wake up the GC for a pass
+            record_max_chain_height(uri, callbacks)
+            if worked:
+                if level == gcpolicy.BUSY:
+                    job.sleep(gcpolicy.BUSY_DELAY)
+                continue
+
+            # Events received until now are covered by the check below
+            scheduler.drain()
+            pending = has_pending_work(uri, this_host, callbacks, leader)
+            if pending and level == gcpolicy.OVERLOADED:
+                job.sleep(gcpolicy.DEFER_DELAY)
             else:
-                time.sleep(10)
+                if not pending:
+                    stats.wait_idle()
+                scheduler.wait_idle(pending)
+    finally:
+        stats.gc_stopped()
+        if lease:
+            lease.stop()
+        scheduler.close()
+    if not job.stopping:
+        log.debug('Stopping GC of {}... Is now disabled'.format(uri))
+
+
+def run_refresher(job):
+    """
+    Refresh the datapaths of this host as soon as the GC of another host
+    of a shared SR asks for it, see inbox
+    """
+    uri, callbacks = job.uri, job.callbacks
+    this_host = callbacks.get_current_host()
+    with VolumeContext(callbacks, uri, 'w') as opq:
+        refresh_inbox = inbox.RefreshInbox(opq, this_host)
+    while not job.stopping:
+        if refresh_inbox.changed():
+            recover_journal(uri, this_host, callbacks, leader=False)
+        job.sleep(inbox.POLL_INTERVAL)
 
-        except Exception:
-            import traceback
-            log.error("Exception in GC main loop {}, {}".format(
-                sys.exc_info(), traceback.format_exc()))
+
+def _stop_legacy_tasks(dbg, uri, callbacks):
+    """
+    Kill the daemons of an SR started by the versions running one process
+    per task, before the supervisor. Each one is recorded in a pickled
+    Popen object.
+    """
+    with VolumeContext(callbacks, uri, 'w') as opq:
+        task_dir = os.path.join(util.var_run_prefix(), 'sr',
+                                callbacks.getUniqueIdentifier(opq))
+    for name in LEGACY_TASKS:
+        path = os.path.join(task_dir, name + '_task.pickle')
+        try:
+            with open(path) as task_file:
+                pid = pickle.load(task_file).pid
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                log.error('{}: cannot read {}: {}'.format(dbg, path, exc))
+            continue
+        except Exception as exc:
+            log.error('{}: cannot read {}: {}'.format(dbg, path, exc))
+        else:
+            _kill_legacy_task(dbg, uri, name, pid)
+        os.unlink(path)
+
+
+def _kill_legacy_task(dbg, uri, name, pid):
+    # The pid may have been reused since, the daemons were started with
+    # the URI of the SR as argument
+    try:
+        with open('/proc/{}/cmdline'.format(pid)) as cmdline:
+            if uri not in cmdline.read().split('\0'):
+                return
+    except IOError:
+        return
+    log.debug('{}: killing the legacy {} daemon {} of {}'.format(
+        dbg, name, pid, uri))
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except OSError as exc:
+        if exc.errno != errno.ESRCH:
             raise
-    log.debug('Stopping GC daemon... Is now disabled')
 
 
 class COWCoalesce(object):
@@ -434,48 +901,28 @@ class COWCoalesce(object):
     """
     @staticmethod
     def start_gc(dbg, sr_type, uri):
+        # Imported here, the supervisor runs the GC of this module
+        from xapi.storage.libs.libcow import supervisor
+
         # Ensure trash directory exists before starting GC.
         callbacks = util.get_sr_callbacks(sr_type)
         with VolumeContext(callbacks, uri, 'w') as opq:
             callbacks.create_trash_dir(opq)
+            callbacks.upgrade_database(opq)
 
-        if gc_is_enabled(uri, callbacks):
-            # Get the command to run, need to replace pyc with py as __file__
-            # will be the byte compiled file.
-            dbg_msg = "{}: Starting GC sr_type={} uri={}".format(
-                dbg, sr_type, uri
-            )
-            args = [
-                os.path.abspath(re.sub("pyc$", "py", __file__)), sr_type, uri
-            ]
-            start_task(dbg_msg, uri, callbacks, "gc", args)
-        else:
+        if not gc_is_enabled(uri, callbacks):
             log.debug('GC is disabled, cannot start it')
-        start_background_tasks(dbg, sr_type, uri, callbacks)
+        _stop_legacy_tasks(dbg, uri, callbacks)
+        # The other background tasks run even when the GC is disabled
+        supervisor.register(dbg, sr_type, uri)
 
     @staticmethod
     def stop_gc(dbg, sr_type, uri):
-        tasks = [('gc', None)]
-
-        callbacks = util.get_sr_callbacks(sr_type)
-        background_tasks = callbacks.get_background_tasks()
-        if background_tasks:
-            tasks.extend(background_tasks)
-
-        # Stop gc first and then other background tasks.
-        for name, _ in tasks:
-            log.debug(
-                "{}: Attempting to kill {} process for sr_type={}, uri={}"
-                .format(dbg, name, sr_type, uri))
-            dbg_msg = "{}: {} process killed for uri={}".format(dbg, name, uri)
-            stop_task(dbg_msg, uri, callbacks, name)
-
-
-if __name__ == '__main__':
-    try:
-        SR_TYPE = sys.argv[1]
-        URI = sys.argv[2]
-        run_coalesce(SR_TYPE, URI)
-    except RuntimeError:
-        log.error("libcow:coalesce: error {}", exc_info=True)
-        raise
+        """
+        Raises supervisor.JobsStillRunning if the GC or another task of the
+        SR is still running after the stop timeout
+        """
+        from xapi.storage.libs.libcow import supervisor
+
+        _stop_legacy_tasks(dbg, uri, util.get_sr_callbacks(sr_type))
+        supervisor.unregister(dbg, sr_type, uri)
@@ -0,0 +1,228 @@
+"""
+Cost model ranking the coalesce candidates of the GC
+"""
+
+from __future__ import absolute_import, division
+import threading
+import time
+
+from xapi.storage import log
+from xapi.storage.libs.libcow.imageformat import ImageFormat
+
+_MIB = 2**20
+_GIB = 2**30
+
+# Removing one level from a chain of depth 1 is worth that many bytes of
+# reclaimed space
+DEPTH_WEIGHT = 1 * _GIB
+
+# Fixed overhead of a coalesce (fork, pause, journal, refresh), in bytes
+FIXED_COST = 16 * _MIB
+
+# Extra weight of a chain attached to a running VM
+ACTIVE_BONUS = 1.0
+
+# Allocation rate (bytes/s) above which a VDI is considered hot, and the
+# maximal weight given to hotness
+HOT_WRITE_RATE = 1 * _MIB
+HOT_BONUS_MAX = 4.0
+
+# Smoothing factor of the write rate estimate and lifetime of a sample
+_RATE_ALPHA = 0.5
+_SAMPLE_TTL = 3600
+
+
+class Candidate(object):
+    """
+    A (node, parent) pair that can be coalesced and the numbers
+    describing the benefit and the cost of doing it.
+    """
+
+    def __init__(self, node, parent):
+        self.node = node
+        self.parent = parent
+        # [(VDI, chain depth)] of the leaves whose chain gets shorter
+        self.leaves = []
+        self.bytes_to_copy = 0
+        self.reclaimed = 0
+        self.write_rate = 0.0
+
+    @property
+    def depth_gain(self):
+        """
+        Every leaf loses one level, weighted by the depth of its chain
+        """
+        return sum(depth for _, depth in self.leaves)
+
+    @property
+    def active_leaves(self):
+        return len([vdi for vdi, _ in self.leaves if vdi.active_on])
+
+    @property
+    def score(self):
+        """
+        Benefit per byte copied, higher is better
+        """
+        hotness = min(self.write_rate / HOT_WRITE_RATE, HOT_BONUS_MAX)
+        weight = 1 + ACTIVE_BONUS * self.active_leaves + hotness
+        benefit = DEPTH_WEIGHT * self.depth_gain * weight + \
+            max(self.reclaimed, 0)
+        return benefit / (self.bytes_to_copy + FIXED_COST)
+
+    def __str__(self):
+        return ('Candidate(node={}, parent={}, score={:.3f}, copy={}, '
+                'reclaimed={}, depth_gain={}, active={}, rate={:.0f})'.format(
+                    self.node.id, self.parent.id, self.score,
+                    self.bytes_to_copy, self.reclaimed, self.depth_gain,
+                    self.active_leaves, self.write_rate))
+
+
+class CostModel(object):
+    """
+    Rank coalesce candidates, the most valuable work per byte first.
+
+    The write rate of the leaves is estimated from the growth of their
+    physical size between two rankings, so it is only known in a long
+    lived process such as the GC daemon.
+    """
+
+    def __init__(self):
+        # volume id -> (time, psize, smoothed rate)
+        self.__samples = {}
+
+    def observe(self, volume_id, psize, now=None):
+        """
+        Record the physical size of a volume, return its write rate
+        """
+        if now is None:
+            now = time.time()
+        previous = self.__samples.get(volume_id)
+        rate = 0.0
+        if previous is not None:
+            last_time, last_psize, last_rate = previous
+            if now > last_time:
+                current = max(psize - last_psize, 0) / (now - last_time)
+                rate = _RATE_ALPHA * current + (1 - _RATE_ALPHA) * last_rate
+            else:
+                rate = last_rate
+        self.__samples[volume_id] = (now, psize, rate)
+        return rate
+
+    def expire(self, now=None):
+        """
+        Drop the samples not refreshed for a while, e.g. deleted volumes
+        """
+        if now is None:
+            now = time.time()
+        for volume_id, sample in self.__samples.items():
+            if sample[0] < now - _SAMPLE_TTL:
+                del self.__samples[volume_id]
+
+    @staticmethod
+    def __depth(db, volume):
+        depth = 0
+        while volume:
+            depth += 1
+            volume = db.get_volume_by_id(volume.parent_id)
+        return depth
+
+    @staticmethod
+    def __leaves(db, volume, depth, accumulator):
+        children = db.get_children(volume.id)
+        if not children:
+            vdi = db.get_vdi_for_volume(volume.id)
+            if vdi:
+                accumulator.append((vdi, depth))
+            return
+        for child in children:
+            CostModel.__leaves(db, child, depth + 1, accumulator)
+
+    def describe(self, db, nodes):
+        """
+        Build the candidates of 'nodes' from the metabase
+        """
+        candidates = []
+        for node in nodes:
+            parent = db.get_volume_by_id(node.parent_id)
+            if parent is None:
+                continue
+            candidate = Candidate(node, parent)
+            self.__leaves(db, node, self.__depth(db, node), candidate.leaves)
+            candidates.append(candidate)
+        return candidates
+
+    def measure(self, dbg, opq, callbacks, candidate):
+        """
+        Fill in the sizes of a candidate from the volume images
+        """
+        node_path = callbacks.volumeGetPath(opq, str(candidate.node.id))
+        parent_path = callbacks.volumeGetPath(opq, str(candidate.parent.id))
+        image_utils = ImageFormat.get_format(
+            candidate.node.image_type).image_utils
+        node_psize = callbacks.volumeGetPhysSize(opq, str(candidate.node.id))
+        try:
+            node_map = image_utils.get_allocation_map(dbg, node_path)
+            parent_map = image_utils.get_allocation_map(dbg, parent_path)
+            candidate.bytes_to_copy = node_map.allocated_bytes()
+            # The node is deleted and the parent grows by the blocks it
+            # does not hold yet
+            candidate.reclaimed = node_psize - (
+                candidate.bytes_to_copy - node_map.overlap_bytes(parent_map))
+        except Exception as exc:
+            log.debug('{}: no allocation map for {}: {}'.format(
+                dbg, candidate.node.id, exc))
+            candidate.bytes_to_copy = node_psize
+            candidate.reclaimed = 0
+
+        candidate.write_rate = 0.0
+        for vdi, _ in candidate.leaves:
+            psize = callbacks.volumeGetPhysSize(opq, str(vdi.volume.id))
+            candidate.write_rate += self.observe(vdi.volume.id, psize)
+
+    def rank(self, dbg, opq, callbacks, candidates):
+        """
+        Return the candidates sorted from the best to the worst
+        """
+        for candidate in candidates:
+            try:
+                self.measure(dbg, opq, callbacks, candidate)
+            except Exception as exc:
+                # Still a candidate, ranked on the metabase only
+                log.error('{}: cannot measure {}: {}'.format(
+                    dbg, candidate.node.id, exc))
+        self.expire()
+        candidates = sorted(candidates, key=lambda c: c.score, reverse=True)
+        for candidate in candidates:
+            log.debug('{}: {}'.format(dbg, candidate))
+        return candidates
+
+
+class ThroughputEstimator(object):
+    """
+    Smoothed throughput (bytes/s) of the coalesces run by this process.
+
+    A coalesce is recorded as if it copied 'overhead' more bytes, so that
+    the fixed cost of the small ones does not drag the rate down, and the
+    rate never falls below 'min_rate'.
+    """
+
+    def __init__(self, initial_rate, overhead=0, min_rate=0):
+        self.__lock = threading.Lock()
+        self.rate = float(initial_rate)
+        self.overhead = overhead
+        self.min_rate = float(min_rate)
+
+    def record(self, nr_bytes, seconds):
+        if nr_bytes <= 0 or seconds <= 0:
+            return
+        sample = (nr_bytes + self.overhead) / seconds
+        with self.__lock:
+            self.rate = max(
+                _RATE_ALPHA * sample + (1 - _RATE_ALPHA) * self.rate,
+                self.min_rate)
+
+    def bytes_in(self, seconds):
+        """
+        Bytes expected to be coalesced in 'seconds'
+        """
+        return max(int(self.rate * seconds) - self.overhead, 0)
@@ -13,6 +13,19 @@ class COWUtil(object):
     def is_empty(dbg, vol_path):
         raise NotImplementedError()
 
+    @staticmethod
+    def get_allocation_map(dbg, vol_path):
+        """Return the blocks allocated in the image itself.
+
+        Args:
+            vol_path: (str) Absolute path to the image
+
+        Returns:
+            (AllocationMap) bitmap of the blocks holding data in
+            'vol_path', ignoring its parents
+        """
+        raise NotImplementedError()
+
     @staticmethod
     def create(dbg, vol_path, size_mib):
         raise NotImplementedError()
@@ -56,9 +69,31 @@ class COWUtil(object):
         raise NotImplementedError()
 
     @staticmethod
-    def coalesce(dbg, vol_path, parent_path):
+    def copy_child(dbg, child_path, new_path):
+        """
+        Write to new_path a copy of child_path, an image just created by
+        a snapshot and holding no data, with its own identity: a cheap
+        snapshot of the same parent. Raises NotImplementedError if the
+        format does not support it, the snapshot must be repeated then.
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def coalesce(dbg, vol_path, parent_path, throttle=None):
+        """
+        Coalesce/commit the changes in vol_path to its parent, pacing the
+        I/O with the optional IOThrottle
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def coalesce_resumable(dbg, vol_path, parent_path, checkpoint=None,
+                           start_block=0, throttle=None):
         """
-        Coalesce/commit the changes in vol_path to its parent
+        Coalesce vol_path into its parent from 'start_block', calling
+        'checkpoint' with the next block to copy whenever the progress is
+        durable. Raises NotImplementedError if the format or the images
+        do not support it, coalesce() must be used then.
         """
         raise NotImplementedError()
 
@@ -70,6 +105,19 @@ class COWUtil(object):
     def get_vsize(dbg, vol_path):
         raise NotImplementedError()
 
+    @staticmethod
+    def scan(dbg, paths):
+        """Get the chain information of many images in one pass.
+
+        Args:
+            paths: (list) Absolute paths of the images to scan
+
+        Returns:
+            (dict) path -> (parent, vsize, psize), parent being the
+            absolute path of the parent image or None
+        """
+        raise NotImplementedError()
+
     @staticmethod
     def set_parent(dbg, vol_path, parent_path):
         raise NotImplementedError()
@@ -91,6 +139,14 @@ class COWUtil(object):
             dbg, meta_path, coalesced_node, parent_node):
         raise NotImplementedError()
 
+    @staticmethod
+    def refresh_reloads_chain():
+        """
+        True if refresh_datapath_coalesce() reloads the whole chain of the
+        datapath, False if it only applies the reparenting it is given
+        """
+        return False
+
     @staticmethod
     def pause_datapath(dbg, meta_path):
         raise NotImplementedError()
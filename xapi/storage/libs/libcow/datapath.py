@@ -7,6 +7,7 @@ from xapi.storage.libs import image, util
 from .callbacks import VolumeContext
 from .imageformat import ImageFormat
 from .lock import Lock
+from . import volumepool
 
 
 class COWDatapath(object):
@@ -106,6 +107,27 @@ class COWDatapath(object):
     def create_single_clone(cls, db, sr, key, cb):
         pass
 
+    @staticmethod
+    def _reset(dbg, opq, db, cb, vdi, image_utils):
+        """
+        Drop the data of a non-persistent VDI. A new child of its parent,
+        taken from the pool of spare volumes, replaces its leaf which the
+        GC then collects. The leaf is emptied in place if the VDI has no
+        parent or the pool no spare.
+        """
+        parent_id = vdi.volume.parent_id
+        if parent_id is not None:
+            volume = volumepool.claim(
+                dbg, opq, db, cb, vdi.volume.vsize, vdi.volume.image_type,
+                parent_id)
+            if volume is not None:
+                image_utils.offline_snapshot(
+                    dbg, cb.volumeGetPath(opq, str(volume.id)),
+                    cb.volumeGetPath(opq, str(parent_id)), True)
+                db.update_vdi_volume_id(vdi.uuid, volume.id)
+                return
+        image_utils.reset(dbg, cb.volumeGetPath(opq, str(vdi.volume.id)))
+
     @classmethod
     def epc_open(cls, dbg, uri, persistent, cb):
         log.debug("{}: Datapath.epc_open: uri == {}".format(dbg, uri))
@@ -126,7 +148,7 @@ class COWDatapath(object):
                             )
                             if vdi.nonpersistent:
                                 # Truncate, etc
-                                image_utils.reset(dbg, vol_path)
+                                cls._reset(dbg, opq, db, cb, vdi, image_utils)
                                 db.update_vdi_nonpersistent(vdi.uuid, 1)
                         elif vdi.nonpersistent:
                             log.debug(
@@ -135,7 +157,7 @@ class COWDatapath(object):
                                                                  vol_path)
                             )
                             # truncate
-                            image_utils.reset(dbg, vol_path)
+                            cls._reset(dbg, opq, db, cb, vdi, image_utils)
                         else:
                             log.debug(
                                 ("{}: Datapath.epc_open: {} is "
@@ -166,7 +188,7 @@ class COWDatapath(object):
                             vdi.image_type).image_utils
                         if vdi.nonpersistent:
                             # truncate
-                            image_utils.reset(dbg, vol_path)
+                            cls._reset(dbg, opq, db, cb, vdi, image_utils)
                             db.update_vdi_nonpersistent(vdi.uuid, None)
             except Exception as e:
                 log.error("{}: Datapath.epc_close: failed to complete close, {}"
@@ -1,6 +1,5 @@
-#!/usr/bin/env python
 """
-Daemon to backup SQL database and metadata.
+Background task to backup SQL database and metadata.
 """
 import sys
 import time
@@ -12,13 +11,20 @@ from xapi.storage.libs import util
 
 LOG_DOMAIN = 'db_backup'
 
+# Delay before retrying after an unexpected error, in seconds
+ERROR_RETRY_DELAY = 60
 
-def backup(uri, callbacks):
-    util.daemonize()
+
+def run_backup(job):
+    """
+    Backup loop of an SR, run by the supervisor until the job is stopped
+    """
+    uri = 'file://{}'.format(job.uri)
+    callbacks = job.callbacks
     mnt_path = urlparse.urlparse(uri).path
     backups_path = "{}/db_backups".format(mnt_path)
     util.mkdir_p(backups_path)
-    while True:
+    while not job.stopping:
         try:
             # 1. Get database configuration.
             with callbacks.db_context(mnt_path) as db:
@@ -28,29 +34,19 @@ def backup(uri, callbacks):
 
             # 2. Wait before next backup.
             now = time.time()
-            while now < next_backup_time:
-                time.sleep(next_backup_time - now)
-                now = time.time()
+            if now < next_backup_time:
+                job.sleep(next_backup_time - now)
+                continue
 
             # 3. Backup!
             callbacks.rolling_backup(LOG_DOMAIN, uri, backups_path)
         except IOError:
             log.error(
-                '{}: failed to write backup, abort!'.format(LOG_DOMAIN, uri))
+                '{}: failed to write backup of {}, abort!'.format(
+                    LOG_DOMAIN, uri))
             raise
         except Exception:
             log.error(
                 '{}: execution error: {}'.format(LOG_DOMAIN, sys.exc_info()))
             log.error(traceback.format_exc())
-
-
-if __name__ == '__main__':
-    try:
-        backup(
-            'file://{}'.format(sys.argv[2]),
-            util.get_sr_callbacks(sys.argv[1])
-        )
-    except RuntimeError:
-        log.error(
-            '{}: uncaught exception: {}'.format(LOG_DOMAIN, sys.exc_info()))
-        raise
+            job.sleep(ERROR_RETRY_DELAY)
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+"""
+GC planner: dry run of the garbage collector of an SR.
+
+Replays the GC on an in-memory copy of the volume tree and reports the
+garbage removed, the coalesces in the order the GC would run them, the
+bytes they move, the chain depths before and after and the expected
+duration at the configured bandwidth. Nothing is modified.
+
+    gcplanner.py [--bandwidth BPS] [--json] sr <sr_type> <uri>
+    gcplanner.py [--bandwidth BPS] [--json] synthetic [--vdis N] ...
+
+The synthetic mode plans a random tree and reports the time taken by
+the planner itself, to benchmark it on huge SRs.
+"""
+
+from __future__ import absolute_import, division
+import argparse
+import json
+import random
+import sys
+import time
+
+from xapi.storage import log
+from xapi.storage.libs import util
+from xapi.storage.libs.libcow.callbacks import VolumeContext
+from xapi.storage.libs.libcow.costmodel import Candidate
+from xapi.storage.libs.libcow.imageformat import ImageFormat
+from xapi.storage.libs.libcow.metabase import VDI
+
+_MIB = 2**20
+_GIB = 2**30
+
+# Bandwidth assumed when the SR has no I/O budget, in bytes/s
+DEFAULT_BANDWIDTH = 100 * _MIB
+
+# Datapath pause accepted for a leaf coalesce, when not configured
+DEFAULT_LEAF_PAUSE_TARGET = 1.0
+
+GARBAGE = 'garbage'
+NON_LEAF = 'non-leaf'
+LEAF = 'leaf'
+LEAF_SNAPSHOT = 'leaf-snapshot'
+
+
+class PlanVolume(object):
+    """
+    Volume of the simulated tree
+    """
+
+    def __init__(self, volume_id, parent_id, vsize, allocated,
+                 allocation_map=None, vdi=None):
+        self.id = volume_id
+        self.parent_id = parent_id
+        self.vsize = vsize
+        self.allocated = allocated
+        self.allocation_map = allocation_map
+        self.vdi = vdi
+
+
+class PlanTree(object):
+    """
+    Volume tree the GC is replayed on
+    """
+
+    def __init__(self, volumes, this_host=None):
+        self.volumes = dict((volume.id, volume) for volume in volumes)
+        self.this_host = this_host
+        self.children = {}
+        for volume in volumes:
+            self.children.setdefault(volume.id, set())
+            if volume.parent_id is not None:
+                self.children.setdefault(volume.parent_id, set()).add(
+                    volume.id)
+
+    @classmethod
+    def from_sr(cls, uri, callbacks, this_host):
+        """
+        Load the tree of an SR, sizing the volumes from their allocation
+        maps (physical size if there is none)
+        """
+        with VolumeContext(callbacks, uri, 'r') as opq:
+            with callbacks.db_context(opq) as db:
+                spares = set(
+                    volume.id for volume in db.get_spare_volumes())
+                volumes = [volume for volume in db.get_all_volumes()
+                           if volume.id not in spares]
+                vdis = dict(
+                    (vdi.volume.id, vdi) for vdi in db.get_all_vdis())
+
+            def measure(volume):
+                image_utils = ImageFormat.get_format(
+                    volume.image_type).image_utils
+                path = callbacks.volumeGetPath(opq, str(volume.id))
+                try:
+                    allocation_map = image_utils.get_allocation_map(
+                        'gcplanner', path)
+                    return allocation_map.allocated_bytes(), allocation_map
+                except Exception as exc:
+                    log.debug('gcplanner: no allocation map for {}: {}'
+                              .format(volume.id, exc))
+                    return callbacks.volumeGetPhysSize(
+                        opq, str(volume.id)), None
+
+            sizes = util.parallel_map('gcplanner', measure, volumes)
+
+        return cls([
+            PlanVolume(volume.id, volume.parent_id, volume.vsize,
+                       allocated, allocation_map, vdis.get(volume.id))
+            for volume, (allocated, allocation_map) in zip(volumes, sizes)
+        ], this_host)
+
+    @classmethod
+    def synthetic(cls, nr_vdis, max_depth=10, vsize=100 * _GIB,
+                  deleted_ratio=0.3, active_ratio=0.5, seed=None):
+        """
+        Random tree: every VDI gets a chain of snapshots, some of which
+        have been deleted
+        """
+        rand = random.Random(seed)
+        volumes = []
+
+        def add(parent_id, allocated, vdi_uuid=None, active=False):
+            volume_id = len(volumes) + 1
+            vdi = None
+            if vdi_uuid:
+                vdi = VDI(vdi_uuid, vdi_uuid, '', 'host' if active else None,
+                          False, None, False)
+            volumes.append(PlanVolume(
+                volume_id, parent_id, vsize, allocated, vdi=vdi))
+            if vdi:
+                vdi.volume = volumes[-1]
+            return volume_id
+
+        for index in range(nr_vdis):
+            parent_id = add(None, int(vsize * rand.uniform(0.1, 0.6)))
+            for level in range(rand.randint(0, max_depth - 1)):
+                snapshot = None
+                if rand.random() >= deleted_ratio:
+                    snapshot = 'snap-{}-{}'.format(index, level)
+                # Snapshots are the read-only sibling of the new leaf
+                add(parent_id, 0, snapshot)
+                parent_id = add(
+                    parent_id, int(vsize * rand.uniform(0, 0.05)))
+            volumes[parent_id - 1].vdi = VDI(
+                'vdi-{}'.format(index), '', '',
+                'host' if rand.random() < active_ratio else None,
+                False, volumes[parent_id - 1], False)
+        return cls(volumes, 'host')
+
+    def depth(self, volume_id, cache):
+        depth = cache.get(volume_id)
+        if depth is None:
+            parent_id = self.volumes[volume_id].parent_id
+            depth = 1
+            if parent_id is not None:
+                depth += self.depth(parent_id, cache)
+            cache[volume_id] = depth
+        return depth
+
+    def depths(self):
+        """
+        Chain depth of every VDI leaf
+        """
+        cache = {}
+        return dict(
+            (volume.vdi.uuid, self.depth(volume.id, cache))
+            for volume in self.volumes.values()
+            if volume.vdi and not self.children[volume.id])
+
+    def leaves(self, volume_id, depth, accumulator):
+        children = self.children[volume_id]
+        if not children:
+            vdi = self.volumes[volume_id].vdi
+            if vdi:
+                accumulator.append((vdi, depth))
+            return
+        for child_id in children:
+            self.leaves(child_id, depth + 1, accumulator)
+
+    def garbage(self):
+        return [
+            volume for volume in self.volumes.values()
+            if not volume.vdi and not self.children[volume.id]]
+
+    def remove(self, volume):
+        del self.volumes[volume.id]
+        del self.children[volume.id]
+        if volume.parent_id is not None:
+            self.children[volume.parent_id].discard(volume.id)
+
+    def __only_child(self, volume):
+        return volume.parent_id is not None and \
+            len(self.children[volume.parent_id]) == 1
+
+    def non_leaf_coalesceable(self):
+        return [
+            volume for volume in self.volumes.values()
+            if self.__only_child(volume) and self.children[volume.id]]
+
+    def leaf_coalesceable(self):
+        return [
+            volume for volume in self.volumes.values()
+            if self.__only_child(volume) and not self.children[volume.id]
+            and volume.vdi and volume.vdi.active_on in (None, self.this_host)]
+
+    def candidates(self, nodes):
+        cache = {}
+        candidates = []
+        for node in nodes:
+            candidate = Candidate(node, self.volumes[node.parent_id])
+            self.leaves(node.id, self.depth(node.id, cache),
+                        candidate.leaves)
+            candidate.bytes_to_copy = node.allocated
+            candidate.reclaimed = node.allocated
+            candidates.append(candidate)
+        return sorted(candidates, key=lambda c: c.score, reverse=True)
+
+    def coalesce(self, node, parent):
+        """
+        Merge 'node' into 'parent' and reparent the children of the node
+        """
+        if node.allocation_map and parent.allocation_map:
+            merged = parent.allocation_map
+            for offset, length in node.allocation_map.extents():
+                merged.set_range(offset, length)
+            parent.allocated = merged.allocated_bytes()
+        else:
+            parent.allocated = min(
+                parent.allocated + node.allocated, parent.vsize)
+        for child_id in list(self.children[node.id]):
+            self.volumes[child_id].parent_id = parent.id
+            self.children[parent.id].add(child_id)
+        self.children[node.id] = set()
+        if node.vdi:
+            parent.vdi = node.vdi
+            node.vdi = None
+        self.remove(node)
+
+
+class PlanStep(object):
+
+    def __init__(self, kind, node_id, parent_id=None, nr_bytes=0,
+                 seconds=0.0):
+        self.kind = kind
+        self.node_id = node_id
+        self.parent_id = parent_id
+        self.nr_bytes = nr_bytes
+        self.seconds = seconds
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'node': self.node_id,
+            'parent': self.parent_id,
+            'bytes': self.nr_bytes,
+            'seconds': self.seconds
+        }
+
+    def __str__(self):
+        if self.kind == GARBAGE:
+            return '{:>13} {}'.format(self.kind, self.node_id)
+        return '{:>13} {} -> {}: {:.1f} MiB, {:.1f}s'.format(
+            self.kind, self.node_id, self.parent_id,
+            self.nr_bytes / _MIB, self.seconds)
+
+
+class GCPlan(object):
+    """
+    Result of plan(): the steps in order and the chain depths
+    """
+
+    def __init__(self, depths_before):
+        self.steps = []
+        self.depths_before = depths_before
+        self.depths_after = {}
+        self.planning_time = 0.0
+
+    @property
+    def nr_bytes(self):
+        return sum(step.nr_bytes for step in self.steps)
+
+    @property
+    def seconds(self):
+        return sum(step.seconds for step in self.steps)
+
+    def to_dict(self):
+        return {
+            'steps': [step.to_dict() for step in self.steps],
+            'bytes': self.nr_bytes,
+            'seconds': self.seconds,
+            'depths_before': self.depths_before,
+            'depths_after': self.depths_after,
+            'planning_time': self.planning_time
+        }
+
+    def __str__(self):
+        lines = [str(step) for step in self.steps]
+        counts = {}
+        for step in self.steps:
+            counts[step.kind] = counts.get(step.kind, 0) + 1
+        before = self.depths_before.values() or [0]
+        after = self.depths_after.values() or [0]
+        lines.append(
+            '{} step(s) ({}), {:.1f} GiB to move, about {:.0f}s'.format(
+                len(self.steps),
+                ', '.join('{} {}'.format(count, kind)
+                          for kind, count in sorted(counts.items())),
+                self.nr_bytes / _GIB, self.seconds))
+        lines.append(
+            'Chain depth: max {} -> {}, mean {:.2f} -> {:.2f}'.format(
+                max(before), max(after),
+                sum(before) / len(before), sum(after) / len(after)))
+        lines.append('Planned in {:.3f}s'.format(self.planning_time))
+        return '\n'.join(lines)
+
+
+def plan(tree, bandwidth=DEFAULT_BANDWIDTH,
+         leaf_pause_target=DEFAULT_LEAF_PAUSE_TARGET):
+    """
+    Replay the GC on 'tree' until it has nothing left to do.
+
+    Like the GC, every round removes the garbage then runs the disjoint
+    non-leaf coalesces in the order of the cost model, or the leaf
+    coalesces when there is no non-leaf one left.
+    """
+    start = time.time()
+    result = GCPlan(tree.depths())
+    leaf_max_size = bandwidth * leaf_pause_target
+
+    while True:
+        garbage = tree.garbage()
+        while garbage:
+            for volume in garbage:
+                tree.remove(volume)
+                result.steps.append(PlanStep(GARBAGE, volume.id))
+            garbage = tree.garbage()
+
+        kind = NON_LEAF
+        candidates = tree.candidates(tree.non_leaf_coalesceable())
+        if not candidates:
+            kind = LEAF
+            candidates = tree.candidates(tree.leaf_coalesceable())
+        if not candidates:
+            break
+
+        # Pairs sharing a volume wait for a later round, as with locks
+        busy = set()
+        for candidate in candidates:
+            node, parent = candidate.node, candidate.parent
+            if node.id in busy or parent.id in busy:
+                continue
+            busy.update((node.id, parent.id))
+            step_kind = kind
+            if kind == LEAF and node.allocated > leaf_max_size:
+                step_kind = LEAF_SNAPSHOT
+            result.steps.append(PlanStep(
+                step_kind, node.id, parent.id, node.allocated,
+                node.allocated / bandwidth))
+            tree.coalesce(node, parent)
+
+    result.depths_after = tree.depths()
+    result.planning_time = time.time() - start
+    return result
+
+
+def plan_sr(sr_type, uri, bandwidth=None):
+    """
+    Plan the GC of an attached SR using its configured budget
+    """
+    callbacks = util.get_sr_callbacks(sr_type)
+    with VolumeContext(callbacks, uri, 'r') as opq:
+        with callbacks.db_context(opq) as db:
+            configured_bandwidth = db.gc_io_bps
+            leaf_pause_target = db.gc_leaf_pause_target
+    if bandwidth is None:
+        bandwidth = configured_bandwidth or DEFAULT_BANDWIDTH
+    tree = PlanTree.from_sr(uri, callbacks, callbacks.get_current_host())
+    return plan(tree, bandwidth, leaf_pause_target)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Show what the GC of an SR would do')
+    parser.add_argument('--bandwidth', type=int, default=None,
+                        help='coalesce bandwidth in bytes/s')
+    parser.add_argument('--json', action='store_true',
+                        help='print the plan as JSON')
+    subparsers = parser.add_subparsers(dest='mode')
+    sr_parser = subparsers.add_parser('sr', help='plan an attached SR')
+    sr_parser.add_argument('sr_type')
+    sr_parser.add_argument('uri')
+    synthetic_parser = subparsers.add_parser(
+        'synthetic', help='plan a random tree')
+    synthetic_parser.add_argument('--vdis', type=int, default=1000)
+    synthetic_parser.add_argument('--depth', type=int, default=10)
+    synthetic_parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv[1:])
+
+    if args.mode == 'sr':
+        result = plan_sr(args.sr_type, args.uri, args.bandwidth)
+    else:
+        start = time.time()
+        tree = PlanTree.synthetic(args.vdis, args.depth, seed=args.seed)
+        log.debug('gcplanner: built {} volumes in {:.3f}s'.format(
+            len(tree.volumes), time.time() - start))
+        result = plan(tree, args.bandwidth or DEFAULT_BANDWIDTH)
+
+    if args.json:
+        print(json.dumps(result.to_dict(), indent=2))
+    else:
+        print(result)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
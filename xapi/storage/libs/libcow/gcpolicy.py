@@ -0,0 +1,165 @@
+"""
+Load-aware policy of the GC
+"""
+
+from __future__ import absolute_import, division
+import os
+import time
+
+from xapi.storage import log
+
+# Load levels, see GCPolicy.level()
+QUIET = 'quiet'
+BUSY = 'busy'
+OVERLOADED = 'overloaded'
+
+# Pause between two passes when the host is busy, in seconds
+BUSY_DELAY = 10
+
+# Delay before re-evaluating the load when coalesces are deferred
+DEFER_DELAY = 30
+
+_PRESSURE_PATH = '/proc/pressure/{}'
+
+
+def read_pressure(resource):
+    """
+    Share of time (%) some tasks stalled on 'resource' ('io', 'cpu') over
+    the last 10 seconds, None when the kernel has no PSI support
+    """
+    try:
+        with open(_PRESSURE_PATH.format(resource)) as pressure:
+            for line in pressure:
+                fields = line.split()
+                if fields and fields[0] == 'some':
+                    return float(dict(
+                        field.split('=', 1) for field in fields[1:])['avg10'])
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+def parse_windows(spec):
+    """
+    Parse 'HH:MM-HH:MM[,HH:MM-HH:MM...]' (local time) into a list of
+    (start, end) minutes of the day. A window may span midnight.
+    """
+    windows = []
+    for window in (spec or '').split(','):
+        window = window.strip()
+        if not window:
+            continue
+        try:
+            start, end = [
+                int(hours) * 60 + int(minutes)
+                for hours, minutes in (
+                    bound.strip().split(':') for bound in window.split('-'))
+            ]
+        except ValueError:
+            log.error('Invalid GC maintenance window: {}'.format(window))
+            continue
+        windows.append((start, end))
+    return windows
+
+
+def in_windows(windows, now=None):
+    local = time.localtime(now)
+    minute = local.tm_hour * 60 + local.tm_min
+    for start, end in windows:
+        if start <= end:
+            if start <= minute < end:
+                return True
+        elif minute >= start or minute < end:
+            return True
+    return False
+
+
+class DeviceLoad(object):
+    """
+    Utilisation (%) of the block device holding a path, from the time
+    spent doing I/O in /sys/dev/block/<major>:<minor>/stat. Not available
+    for network file systems.
+    """
+
+    def __init__(self, path):
+        self.stat_path = None
+        self.last = None
+        try:
+            dev = os.stat(path).st_dev
+        except OSError:
+            return
+        stat_path = '/sys/dev/block/{}:{}/stat'.format(
+            os.major(dev), os.minor(dev))
+        if os.major(dev) and os.path.exists(stat_path):
+            self.stat_path = stat_path
+
+    def __read(self):
+        with open(self.stat_path) as stat:
+            # io_ticks: milliseconds spent doing I/O
+            return time.time(), int(stat.read().split()[9])
+
+    def sample(self):
+        """
+        Utilisation since the previous sample, None if unknown
+        """
+        if self.stat_path is None:
+            return None
+        try:
+            current = self.__read()
+        except (IOError, OSError, IndexError, ValueError):
+            return None
+        last, self.last = self.last, current
+        if last is None or current[0] <= last[0]:
+            return None
+        return min(100.0, (current[1] - last[1]) /
+                   ((current[0] - last[0]) * 10))
+
+
+class GCPolicy(object):
+    """
+    Decide how hard the GC may work given the load of the host and of
+    the SR, and the maintenance windows of the SR.
+
+    The load is the highest of the I/O and CPU pressure stalls and of the
+    utilisation of the SR device. Below 'busy' the GC runs at full
+    speed, up to 'overloaded' it runs one coalesce at a time with pauses,
+    above it defers the coalesces. Inside a maintenance window the load
+    is ignored and the I/O budget lifted to catch up.
+    """
+
+    def __init__(self, path, busy=10.0, overloaded=40.0, windows=None):
+        self.device = DeviceLoad(path)
+        self.busy = busy
+        self.overloaded = overloaded
+        self.windows = windows or []
+
+    def load_configuration(self, db):
+        self.busy = db.gc_pressure_busy
+        self.overloaded = db.gc_pressure_overloaded
+        self.windows = parse_windows(db.gc_maintenance_window)
+
+    def in_maintenance_window(self, now=None):
+        return in_windows(self.windows, now)
+
+    def pressure(self):
+        samples = [
+            read_pressure('io'),
+            read_pressure('cpu'),
+            self.device.sample()
+        ]
+        samples = [sample for sample in samples if sample is not None]
+        return max(samples) if samples else 0.0
+
+    def level(self, now=None):
+        if self.in_maintenance_window(now):
+            return QUIET
+        pressure = self.pressure()
+        if pressure >= self.overloaded:
+            level = OVERLOADED
+        elif pressure >= self.busy:
+            level = BUSY
+        else:
+            level = QUIET
+        if level != QUIET:
+            log.debug('GC: load {:.1f}% is {}'.format(pressure, level))
+        return level
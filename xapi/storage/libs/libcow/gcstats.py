@@ -0,0 +1,253 @@
+"""
+GC statistics of the SRs, published to xcp-rrdd.
+
+The GC records what it does in the GCStats of its SR, and the backlog it
+finds during its passes. Both are published every reading of xcp-rrdd as
+datasources owned by the SR, so that dashboards can alert before the
+chains reach MAX_CHAIN_HEIGHT or when the GC is stuck. While the GC is
+not running, e.g. disabled, the backlog is read from the metabase.
+
+On a shared SR each host publishes what its own GC sees: the leaves it
+can coalesce and its own passes.
+"""
+
+from __future__ import absolute_import, division
+from contextlib import contextmanager
+import threading
+import time
+
+from xapi.storage import log
+from xapi.storage.libs.libcow.callbacks import VolumeContext
+from xapi.storage.libs.rrddlib.control import PluginControl
+from xapi.storage.libs.rrddlib.datasource import Datasource, is_valid_uuid4
+
+# Seconds before an xcp-rrdd reading at which the values are collected
+TIME_TO_READING = 1
+
+# Period at which the backlog is read from the metabase when the GC does
+# not record it, in seconds: the queries walk the whole volume tree
+BACKLOG_INTERVAL = 30
+
+# Counts of the backlog recorded by the GC, see GCStats.record_backlog()
+BACKLOG_COUNTS = ('garbage_volumes', 'non_leaf_coalesceable',
+                  'leaf_coalesceable', 'max_chain_height', 'refresh_backlog')
+
+# The supervisor runs the GC of every SR in one process: SR uuid -> stats
+_STATS = {}
+_STATS_LOCK = threading.Lock()
+
+
+class GCStats(object):
+    """
+    Activity of the GC of an SR in this process
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # Total of the bytes coalesced, rrdd derives the throughput
+        self.bytes_coalesced = 0
+        # Until a pass succeeds, the GC is late since it started
+        self.last_pass = time.time()
+        self.idle = False
+        # key -> (start, bytes, bytes/s) of the running coalesces
+        self.__running = {}
+        # BACKLOG_COUNTS seen by the last passes, None if the GC is not
+        # running
+        self.__backlog = None
+
+    @contextmanager
+    def coalescing(self, key, nr_bytes, rate):
+        """
+        Account for the coalesce of 'nr_bytes' expected to run at 'rate'
+        bytes/s while in the block
+        """
+        with self.__lock:
+            self.__running[key] = (time.time(), nr_bytes, rate)
+        try:
+            yield
+            with self.__lock:
+                self.bytes_coalesced += nr_bytes
+        finally:
+            with self.__lock:
+                del self.__running[key]
+
+    def progress(self, now=None):
+        """
+        Fraction of the bytes of the running coalesces copied so far,
+        estimated from their expected throughput. 0 if none is running.
+        """
+        if now is None:
+            now = time.time()
+        done = total = 0
+        with self.__lock:
+            for start, nr_bytes, rate in self.__running.values():
+                total += nr_bytes
+                done += min((now - start) * rate, nr_bytes)
+        if not total:
+            return 0.0
+        # The estimate is not over before the coalesce is
+        return min(done / total, 0.99)
+
+    def pass_started(self):
+        if self.idle:
+            # Not late for the time spent with nothing to do
+            self.last_pass = time.time()
+            self.idle = False
+
+    def pass_done(self):
+        self.last_pass = time.time()
+
+    def wait_idle(self):
+        """
+        The GC found nothing left to do, it is not late until it works
+        again
+        """
+        self.idle = True
+
+    def record_backlog(self, **counts):
+        """
+        Record some of the BACKLOG_COUNTS, as found by a GC pass
+        """
+        with self.__lock:
+            if self.__backlog is None:
+                self.__backlog = dict.fromkeys(BACKLOG_COUNTS, 0)
+            self.__backlog.update(counts)
+
+    def gc_stopped(self):
+        """
+        The recorded backlog is no longer kept up to date
+        """
+        with self.__lock:
+            self.__backlog = None
+
+    def backlog(self):
+        """
+        Return the backlog recorded by the GC in the format of
+        get_backlog(), None if it is not running
+        """
+        with self.__lock:
+            if self.__backlog is None:
+                return None
+            counts = dict(self.__backlog)
+        return {
+            'garbage_volumes': counts['garbage_volumes'],
+            'coalesceable_nodes': (
+                counts['non_leaf_coalesceable'] +
+                counts['leaf_coalesceable']),
+            'max_chain_height': counts['max_chain_height'],
+            'refresh_backlog': counts['refresh_backlog']
+        }
+
+    def last_pass_age(self, now=None):
+        if self.idle:
+            return 0.0
+        if now is None:
+            now = time.time()
+        return max(now - self.last_pass, 0.0)
+
+
+def get_stats(sr_uuid):
+    with _STATS_LOCK:
+        return _STATS.setdefault(sr_uuid, GCStats())
+
+
+def get_backlog(uri, callbacks, this_host):
+    """
+    Return the GC backlog of an SR as seen by 'this_host', from the
+    metabase
+    """
+    with VolumeContext(callbacks, uri, 'r') as opq:
+        with callbacks.db_context(opq) as db:
+            return {
+                'garbage_volumes': len(db.get_garbage_volumes()),
+                'coalesceable_nodes': (
+                    len(db.find_non_leaf_coalesceable()) +
+                    len(db.find_leaf_coalesceable(this_host))),
+                'max_chain_height': db.get_max_chain_height(),
+                'refresh_backlog': db.count_refresh_entries()
+            }
+
+
+def make_datasources(sr_uuid):
+    """
+    Datasources of the GC of an SR, by name
+    """
+    owner = 'sr {}'.format(sr_uuid)
+    if not is_valid_uuid4(sr_uuid):
+        # rrdd only accepts UUID4 owners
+        log.debug('GC stats of {} owned by the host'.format(sr_uuid))
+        owner = None
+
+    def datasource(name, value_type, description, **args):
+        return Datasource(
+            name, 0.0 if value_type == 'float' else 0, value_type,
+            description=description, owner=owner, **args)
+
+    datasources = [
+        datasource('gc_garbage_volumes', 'int64',
+                   'Unreferenced volumes waiting for removal', min_val=0),
+        datasource('gc_coalesceable_nodes', 'int64',
+                   'Volumes waiting for a coalesce', min_val=0),
+        datasource('gc_coalesce_throughput', 'int64',
+                   'Bytes coalesced per second', datasource_type='derive',
+                   min_val=0, units='B/s'),
+        datasource('gc_coalesce_progress', 'float',
+                   'Progress of the running coalesces', min_val=0.0,
+                   max_val=1.0, units='(fraction)'),
+        datasource('gc_max_chain_height', 'int64',
+                   'Height of the longest volume chain', min_val=0),
+        datasource('gc_refresh_backlog', 'int64',
+                   'Datapath refreshes pending on the hosts', min_val=0),
+        datasource('gc_last_pass_age', 'float',
+                   'Seconds since the last successful GC pass, 0 when idle',
+                   min_val=0.0, units='s')
+    ]
+    return dict((ds.get_property('name'), ds) for ds in datasources)
+
+
+def update_datasources(datasources, stats, backlog):
+    datasources['gc_garbage_volumes'].set_value(backlog['garbage_volumes'])
+    datasources['gc_coalesceable_nodes'].set_value(
+        backlog['coalesceable_nodes'])
+    datasources['gc_coalesce_throughput'].set_value(
+        int(stats.bytes_coalesced))
+    datasources['gc_coalesce_progress'].set_value(float(stats.progress()))
+    datasources['gc_max_chain_height'].set_value(backlog['max_chain_height'])
+    datasources['gc_refresh_backlog'].set_value(backlog['refresh_backlog'])
+    datasources['gc_last_pass_age'].set_value(float(stats.last_pass_age()))
+
+
+def run_publisher(job):
+    """
+    Publish the GC statistics of an SR to xcp-rrdd until the job is
+    stopped. Runs whether the GC is enabled or not: the backlog of a
+    disabled GC grows.
+    """
+    uri, callbacks = job.uri, job.callbacks
+    this_host = callbacks.get_current_host()
+    with VolumeContext(callbacks, uri, 'r') as opq:
+        sr_uuid = callbacks.getUniqueIdentifier(opq)
+    stats = get_stats(sr_uuid)
+    datasources = make_datasources(sr_uuid)
+    plugin = PluginControl(
+        'sr-gc-{}'.format(sr_uuid), 'Local', 'Five_seconds', TIME_TO_READING)
+
+    read_backlog = None
+    read_time = 0
+    full_update = True
+    while plugin.wake_up_before_next_reading(job.sleep):
+        backlog = stats.backlog()
+        if backlog is None:
+            now = time.time()
+            if read_backlog is None or now - read_time >= BACKLOG_INTERVAL:
+                read_backlog = get_backlog(uri, callbacks, this_host)
+                read_time = now
+            backlog = read_backlog
+        else:
+            read_backlog = None
+        update_datasources(datasources, stats, backlog)
+        if full_update:
+            plugin.full_update(datasources)
+            full_update = False
+        else:
+            plugin.fast_update(datasources)
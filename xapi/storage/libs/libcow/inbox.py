@@ -0,0 +1,77 @@
+"""
+Per host inboxes of a shared SR, telling a host that the GC of another
+one left it datapaths to refresh.
+
+The inbox of a host is a file of the SR replaced at each notification.
+inotify sees no change made by a remote host, so the owner polls it; it
+opens the file every time because NFS only revalidates the attributes
+of a file on open (close-to-open consistency).
+"""
+
+from __future__ import absolute_import
+import errno
+import os
+import time
+
+from xapi.storage import log
+from xapi.storage.libs import util
+
+_INBOX_DIR = 'refresh_inbox'
+
+# Period at which a host checks its inbox, in seconds
+POLL_INTERVAL = 0.5
+
+_UNREAD = object()
+
+
+def _inbox_path(opq, host):
+    return os.path.join(opq, _INBOX_DIR, host)
+
+
+def notify(opq, hosts):
+    """
+    Tell 'hosts' that they have refresh entries, once committed
+    """
+    for host in set(hosts):
+        if not host:
+            continue
+        path = _inbox_path(opq, host)
+        try:
+            util.mkdir_p(os.path.dirname(path))
+            tmp_path = '{}.{}'.format(path, os.getpid())
+            with open(tmp_path, 'w') as inbox:
+                inbox.write(repr(time.time()))
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as exc:
+            # The host still refreshes, from its next GC pass
+            log.error('Cannot notify {} of a refresh: {}'.format(host, exc))
+
+
+class RefreshInbox(object):
+    """
+    Inbox of 'host'
+    """
+
+    def __init__(self, opq, host):
+        self.path = _inbox_path(opq, host)
+        self.last = _UNREAD
+
+    def __read(self):
+        try:
+            with open(self.path) as inbox:
+                st = os.fstat(inbox.fileno())
+                return st.st_ino, st.st_mtime, inbox.read()
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        return None
+
+    def changed(self):
+        """
+        Tell if a notification arrived since the last call. Always True
+        at first, for the notifications sent before the host listened.
+        """
+        current = self.__read()
+        changed = current != self.last
+        self.last = current
+        return changed
@@ -0,0 +1,154 @@
+"""
+Lease electing the host that runs the SR wide part of the GC.
+
+On a shared SR the GC of every host would otherwise remove the same
+garbage, try the same non-leaf coalesces and replay the same journal.
+The leader holds a lease stored in a file of the SR and renews it from a
+heartbeat thread. Another host takes it over once it has expired, for
+instance when the leader crashed or lost the storage.
+
+The expiry is an absolute time: the clocks of the hosts are assumed to be
+in sync (NTP) within CLOCK_SKEW seconds.
+"""
+
+from __future__ import absolute_import
+import errno
+import json
+import os
+import threading
+import time
+
+from xapi.storage import log
+from xapi.storage.libs.libcow.lock import Lock
+
+# Time a lease stays valid without renewal, in seconds
+LEASE_DURATION = 60
+
+# Period at which the leader renews its lease
+RENEW_INTERVAL = 20
+
+# Extra time given to an expired lease before taking it over
+CLOCK_SKEW = 10
+
+_LEASE_FILE = 'gc_lease'
+
+
+class GCLease(object):
+    """
+    GC lease of an SR as seen by 'host'
+    """
+
+    def __init__(self, opq, callbacks, host):
+        self.opq = opq
+        self.callbacks = callbacks
+        self.host = host
+        self.path = os.path.join(opq, _LEASE_FILE)
+        # Local expiry of our own lease, 0 when not the leader
+        self.expiry = 0
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    def read(self):
+        """
+        Return the (holder, expiry) of the lease, (None, 0) if never taken
+        """
+        try:
+            with open(self.path) as lease_file:
+                lease = json.load(lease_file)
+            return lease['holder'], float(lease['expiry'])
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        except (ValueError, KeyError, TypeError) as exc:
+            log.error('Invalid GC lease {}: {}'.format(self.path, exc))
+        return None, 0
+
+    def __write(self, expiry):
+        tmp_path = '{}.{}'.format(self.path, self.host)
+        with open(tmp_path, 'w') as lease_file:
+            json.dump({'holder': self.host, 'expiry': expiry}, lease_file)
+            lease_file.flush()
+            os.fsync(lease_file.fileno())
+        os.rename(tmp_path, self.path)
+
+    def holder(self, now=None):
+        """
+        Return the host holding a valid lease, None if there is none
+        """
+        if now is None:
+            now = time.time()
+        holder, expiry = self.read()
+        if expiry + CLOCK_SKEW < now:
+            return None
+        return holder
+
+    def acquire(self, now=None):
+        """
+        Take or renew the lease, return True if this host is the leader
+        """
+        if now is None:
+            now = time.time()
+        with Lock(self.opq, _LEASE_FILE, self.callbacks):
+            holder, expiry = self.read()
+            if holder != self.host and expiry + CLOCK_SKEW >= now:
+                self.expiry = 0
+                return False
+            if holder != self.host:
+                log.debug('GC: {} takes the lease of {} over from {}'.format(
+                    self.host, self.opq, holder))
+            self.__write(now + LEASE_DURATION)
+        self.expiry = now + LEASE_DURATION
+        return True
+
+    def release(self):
+        if not self.expiry:
+            return
+        self.expiry = 0
+        with Lock(self.opq, _LEASE_FILE, self.callbacks):
+            holder, _ = self.read()
+            if holder == self.host:
+                self.__write(0)
+
+    def is_leader(self, now=None):
+        """
+        Tell if this host holds the lease, from the last renewal: a
+        leader that cannot renew its lease steps down when it expires
+        """
+        if now is None:
+            now = time.time()
+        return self.expiry > now
+
+    def __try_acquire(self):
+        try:
+            self.acquire()
+        except Exception as exc:
+            log.error('GC: cannot renew the lease of {}: {}'.format(
+                self.opq, exc))
+
+    def __heartbeat(self):
+        while not self.__stopped.wait(RENEW_INTERVAL):
+            self.__try_acquire()
+
+    def start(self):
+        """
+        Try to take the lease now and then every RENEW_INTERVAL seconds
+        """
+        self.__stopped.clear()
+        self.__try_acquire()
+        self.__thread = threading.Thread(target=self.__heartbeat)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stop the heartbeat and hand the lease over
+        """
+        if self.__thread:
+            self.__stopped.set()
+            self.__thread.join()
+            self.__thread = None
+        try:
+            self.release()
+        except Exception as exc:
+            log.error('GC: cannot release the lease of {}: {}'.format(
+                self.opq, exc))
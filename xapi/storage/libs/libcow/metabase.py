@@ -4,9 +4,16 @@ Metadata database for virtual disks
 
 import logging
 import sqlite3
+import time
 from xapi.storage import log
 from xapi.storage.libs import util
 
+# Tombstones of deleted VDIs kept for VolumeMetabase.get_vdis_deleted_since()
+MAX_VDI_TOMBSTONES = 10000
+
+# Suffix of the database holding when the physical sizes were measured
+PSIZE_TIMES_SUFFIX = '-psize-times'
+
 class VDI(object):
     """
     Virtual Disk Image (VDI) database convenience class
@@ -49,13 +56,17 @@ class Volume(object):
     Volume disk object
     """
 
-    def __init__(self, volume_id, parent, snap, vsize, psize, image_type):
+    def __init__(self, volume_id, parent, snap, vsize, psize, image_type,
+                 psize_time=None):
         self.id = volume_id
         self.parent_id = parent
         self.snap = snap
         self.vsize = vsize
         self.psize = psize
         self.image_type = image_type
+        # When psize was measured, None if never or for a volume that was
+        # not loaded with its VDI
+        self.psize_time = psize_time
 
     @classmethod
     def from_row(cls, row):
@@ -68,7 +79,8 @@ class Volume(object):
             row['snap'],
             row['vsize'],
             row['psize'],
-            row['image_type']
+            row['image_type'],
+            row['psize_time']
         )
 
 
@@ -166,9 +178,26 @@ class VolumeMetabase(object):
         )
 
         self._conn.execute('PRAGMA foreign_keys = 1')
+        self.__attach_psize_times()
 
         self._conn.row_factory = sqlite3.Row
 
+    def __attach_psize_times(self):
+        """
+        Keep the times at which the physical sizes were measured in a
+        database of their own: the supervisor refreshes them every minute
+        and the GC wakes up at each write to the metabase file, see
+        GCScheduler. Losing this file only makes SR.ls measure the sizes
+        again.
+        """
+        self._conn.execute("ATTACH DATABASE ? AS psize_times",
+                           (self.__path + PSIZE_TIMES_SUFFIX,))
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS psize_times.volume_psize_time(
+                id         INTEGER PRIMARY KEY NOT NULL,
+                psize_time REAL NOT NULL
+            )""")
+
     def _table_exists(self, name):
         return self._conn.execute("""
             SELECT count(*) from sqlite_master
@@ -279,6 +308,184 @@ class VolumeMetabase(object):
                        ('max_backups', 8)
                 """)
             self._set_version("volume", 1)
+        if version < 2:
+            # I/O budget of the GC, 0 means unlimited
+            self._conn.execute("""
+                INSERT OR IGNORE INTO configuration(key, value)
+                VALUES ('gc_io_bps', 0),
+                       ('gc_io_iops', 0)
+                """)
+            self._set_version("volume", 2)
+        if version < 3:
+            # Load-aware GC policy: pressure thresholds (%) and maintenance
+            # windows ('HH:MM-HH:MM,...', local time)
+            self._conn.execute("""
+                INSERT OR IGNORE INTO configuration(key, value)
+                VALUES ('gc_pressure_busy', 10.0),
+                       ('gc_pressure_overloaded', 40.0),
+                       ('gc_maintenance_window', '')
+                """)
+            self._set_version("volume", 3)
+        if version < 4:
+            # Longest datapath pause (s) accepted for a leaf coalesce
+            self._conn.execute("""
+                INSERT OR IGNORE INTO configuration(key, value)
+                VALUES ('gc_leaf_pause_target', 1.0)
+                """)
+            self._set_version("volume", 4)
+        if version < 5:
+            # Progress of the resumable coalesces
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS coalesce_checkpoint(
+                    id         INTEGER PRIMARY KEY NOT NULL,
+                    parent_id  INTEGER NOT NULL,
+                    next_block INTEGER NOT NULL,
+                    FOREIGN KEY(id) REFERENCES volume(id)
+                        ON DELETE CASCADE,
+                    FOREIGN KEY(parent_id) REFERENCES volume(id)
+                        ON DELETE CASCADE
+                )""")
+            # Nodes holding at least that many bytes use the resumable
+            # coalesce, 0 disables it. It is opt-in: unlike 'vhd-util
+            # coalesce' it writes the parent image itself and has not
+            # been run on enough SRs to be the default yet.
+            self._conn.execute("""
+                INSERT OR IGNORE INTO configuration(key, value)
+                VALUES ('gc_resumable_coalesce_min', 0)
+                """)
+            self._set_version("volume", 5)
+        if version < 6:
+            # Bytes/s freed when deleting the trash, 0 means unlimited
+            self._conn.execute("""
+                INSERT OR IGNORE INTO configuration(key, value)
+                VALUES ('trash_reap_rate', 268435456)
+                """)
+            self._set_version("volume", 6)
+        if version < 7:
+            # Empty volumes created ahead of their use, see volumepool
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS spare_volume(
+                    id INTEGER PRIMARY KEY NOT NULL,
+                    FOREIGN KEY(id) REFERENCES volume(id)
+                        ON DELETE CASCADE
+                )""")
+            # Spare volumes kept per size class, 0 disables the pool
+            self._conn.execute("""
+                INSERT OR IGNORE INTO configuration(key, value)
+                VALUES ('volume_pool_size', 4)
+                """)
+            self._set_version("volume", 7)
+        if version < 8:
+            # Time at which volume.psize was measured, see psizecache
+            self._conn.execute(
+                "ALTER TABLE volume ADD COLUMN psize_time REAL")
+            # Age (s) up to which SR.ls reports a cached physical size
+            self._conn.execute("""
+                INSERT OR IGNORE INTO configuration(key, value)
+                VALUES ('psize_max_age', 60.0)
+                """)
+            self._set_version("volume", 8)
+        if version < 9:
+            self.__create_generation_tracking()
+            self._set_version("volume", 9)
+        if version < 10:
+            # Seconds during which this host reuses a result of SR.stat,
+            # 0 disables the cache, see statcache
+            self._conn.execute("""
+                INSERT OR IGNORE INTO configuration(key, value)
+                VALUES ('sr_stat_ttl', 10.0)
+                """)
+            self._set_version("volume", 10)
+        if version < 11:
+            # volume.psize_time moved to the psize_times database
+            self._conn.execute("UPDATE volume SET psize_time = NULL")
+            self._set_version("volume", 11)
+
+    def __create_generation_tracking(self):
+        """
+        Number every change of what SR.ls reports, see ls_since()
+
+        The SR generation is incremented by the triggers below at each
+        change of a VDI, of the size of its volume or of its custom keys.
+        Each VDI records the generation of its last change, each deleted
+        VDI leaves a tombstone with the generation of its deletion.
+        """
+        # The VDIs of an existing SR are all changed since generation 0
+        self._conn.execute("""
+            INSERT OR IGNORE INTO configuration(key, value)
+            VALUES ('generation', 1),
+                   ('vdi_tombstone_horizon', 0)
+            """)
+        self._conn.execute("""
+            ALTER TABLE vdi
+              ADD COLUMN generation INTEGER NOT NULL DEFAULT 1""")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS vdi_generation ON vdi(generation)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS vdi_tombstone(
+                uuid       TEXT PRIMARY KEY NOT NULL,
+                generation INTEGER NOT NULL
+            )""")
+        self._conn.execute("""
+            CREATE INDEX IF NOT EXISTS vdi_tombstone_generation
+                ON vdi_tombstone(generation)""")
+
+        next_generation = """
+            UPDATE configuration
+               SET value = value + 1
+             WHERE key = 'generation';"""
+        generation = """
+            (SELECT value FROM configuration WHERE key = 'generation')"""
+        self._conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS vdi_inserted
+             AFTER INSERT ON vdi
+            BEGIN {next_generation}
+                UPDATE vdi SET generation = {generation}
+                 WHERE uuid = NEW.uuid;
+                DELETE FROM vdi_tombstone WHERE uuid = NEW.uuid;
+            END""".format(next_generation=next_generation,
+                          generation=generation))
+        # active_on is not reported by SR.ls and changes at each attach
+        self._conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS vdi_updated
+             AFTER UPDATE OF name, description, volume_id, sharable ON vdi
+            BEGIN {next_generation}
+                UPDATE vdi SET generation = {generation}
+                 WHERE uuid = NEW.uuid;
+            END""".format(next_generation=next_generation,
+                          generation=generation))
+        self._conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS vdi_deleted
+             AFTER DELETE ON vdi
+            BEGIN {next_generation}
+                INSERT OR REPLACE INTO vdi_tombstone(uuid, generation)
+                VALUES (OLD.uuid, {generation});
+            END""".format(next_generation=next_generation,
+                          generation=generation))
+        # psize is refreshed periodically, see psizecache: only count
+        # actual changes
+        self._conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS volume_updated
+             AFTER UPDATE OF snap, vsize, psize ON volume
+              WHEN NEW.snap IS NOT OLD.snap
+                OR NEW.vsize IS NOT OLD.vsize
+                OR NEW.psize IS NOT OLD.psize
+            BEGIN {next_generation}
+                UPDATE vdi SET generation = {generation}
+                 WHERE volume_id = NEW.id;
+            END""".format(next_generation=next_generation,
+                          generation=generation))
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'),
+                           ('DELETE', 'OLD')):
+            self._conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS vdi_custom_key_{event_name}
+                 AFTER {event} ON vdi_custom_keys
+                BEGIN {next_generation}
+                    UPDATE vdi SET generation = {generation}
+                     WHERE uuid = {row}.vdi_uuid;
+                END""".format(event_name=event.lower(), event=event,
+                              row=row, next_generation=next_generation,
+                              generation=generation))
 
     def create(self):
         """
@@ -287,6 +494,12 @@ class VolumeMetabase(object):
         with self._conn:
             self._create_tables()
 
+    def upgrade(self):
+        """
+        Bring the database of an existing SR to the current schema
+        """
+        self.create()
+
     def _set_configuration_property(self, key, value):
         self._conn.execute("""
             UPDATE configuration
@@ -331,6 +544,131 @@ class VolumeMetabase(object):
     def max_backups(self, max_backups):
         self._set_configuration_property("max_backups", int(max_backups))
 
+    @property
+    def gc_io_bps(self):
+        return int(self._get_configuration_property("gc_io_bps"))
+
+    @gc_io_bps.setter
+    def gc_io_bps(self, gc_io_bps):
+        self._set_configuration_property("gc_io_bps", int(gc_io_bps))
+
+    @property
+    def gc_io_iops(self):
+        return int(self._get_configuration_property("gc_io_iops"))
+
+    @gc_io_iops.setter
+    def gc_io_iops(self, gc_io_iops):
+        self._set_configuration_property("gc_io_iops", int(gc_io_iops))
+
+    @property
+    def gc_pressure_busy(self):
+        return float(self._get_configuration_property("gc_pressure_busy"))
+
+    @gc_pressure_busy.setter
+    def gc_pressure_busy(self, gc_pressure_busy):
+        self._set_configuration_property(
+            "gc_pressure_busy",
+            float(gc_pressure_busy)
+        )
+
+    @property
+    def gc_pressure_overloaded(self):
+        return float(
+            self._get_configuration_property("gc_pressure_overloaded"))
+
+    @gc_pressure_overloaded.setter
+    def gc_pressure_overloaded(self, gc_pressure_overloaded):
+        self._set_configuration_property(
+            "gc_pressure_overloaded",
+            float(gc_pressure_overloaded)
+        )
+
+    @property
+    def gc_maintenance_window(self):
+        return str(self._get_configuration_property("gc_maintenance_window"))
+
+    @gc_maintenance_window.setter
+    def gc_maintenance_window(self, gc_maintenance_window):
+        self._set_configuration_property(
+            "gc_maintenance_window",
+            gc_maintenance_window
+        )
+
+    @property
+    def gc_leaf_pause_target(self):
+        return float(self._get_configuration_property("gc_leaf_pause_target"))
+
+    @gc_leaf_pause_target.setter
+    def gc_leaf_pause_target(self, gc_leaf_pause_target):
+        self._set_configuration_property(
+            "gc_leaf_pause_target",
+            float(gc_leaf_pause_target)
+        )
+
+    @property
+    def gc_resumable_coalesce_min(self):
+        return int(
+            self._get_configuration_property("gc_resumable_coalesce_min"))
+
+    @gc_resumable_coalesce_min.setter
+    def gc_resumable_coalesce_min(self, gc_resumable_coalesce_min):
+        self._set_configuration_property(
+            "gc_resumable_coalesce_min",
+            int(gc_resumable_coalesce_min)
+        )
+
+    @property
+    def trash_reap_rate(self):
+        return int(self._get_configuration_property("trash_reap_rate"))
+
+    @trash_reap_rate.setter
+    def trash_reap_rate(self, trash_reap_rate):
+        self._set_configuration_property(
+            "trash_reap_rate",
+            int(trash_reap_rate)
+        )
+
+    @property
+    def volume_pool_size(self):
+        return int(self._get_configuration_property("volume_pool_size"))
+
+    @volume_pool_size.setter
+    def volume_pool_size(self, volume_pool_size):
+        self._set_configuration_property(
+            "volume_pool_size",
+            int(volume_pool_size)
+        )
+
+    @property
+    def sr_stat_ttl(self):
+        return float(self._get_configuration_property("sr_stat_ttl"))
+
+    @sr_stat_ttl.setter
+    def sr_stat_ttl(self, sr_stat_ttl):
+        self._set_configuration_property(
+            "sr_stat_ttl",
+            float(sr_stat_ttl)
+        )
+
+    @property
+    def generation(self):
+        return int(self._get_configuration_property("generation"))
+
+    @property
+    def vdi_tombstone_horizon(self):
+        return int(self._get_configuration_property("vdi_tombstone_horizon"))
+
+    @property
+    def psize_max_age(self):
+        return float(self._get_configuration_property("psize_max_age"))
+
+    @psize_max_age.setter
+    def psize_max_age(self, psize_max_age):
+        self._set_configuration_property(
+            "psize_max_age",
+            float(psize_max_age)
+        )
+
     def dump(self, path):
         with open(path, 'w') as file:
             try:
@@ -371,6 +709,27 @@ class VolumeMetabase(object):
         self._conn.execute("""
             DELETE FROM vdi WHERE uuid=:uuid
         """, {"uuid": uuid})
+        self.__prune_vdi_tombstones()
+
+    def __prune_vdi_tombstones(self):
+        """
+        Only keep the last MAX_VDI_TOMBSTONES tombstones, older
+        generations then get a full listing from ls_since()
+        """
+        row = self._conn.execute("""
+            SELECT generation
+              FROM vdi_tombstone
+          ORDER BY generation DESC
+             LIMIT 1 OFFSET :max_tombstones""",
+                                 {"max_tombstones": MAX_VDI_TOMBSTONES}
+                                 ).fetchone()
+        if row is None:
+            return
+        self._conn.execute(
+            "DELETE FROM vdi_tombstone WHERE generation <= :generation",
+            {"generation": row["generation"]})
+        self._set_configuration_property(
+            "vdi_tombstone_horizon", row["generation"])
 
     def update_vdi_volume_id(self, uuid, volume_id):
         """
@@ -433,6 +792,9 @@ class VolumeMetabase(object):
         """
         self._conn.execute("DELETE FROM volume WHERE id=:volume_id",
                            {"volume_id": volume_id})
+        self._conn.execute(
+            "DELETE FROM volume_psize_time WHERE id=:volume_id",
+            {"volume_id": volume_id})
 
     def update_volume_parent(self, volume_id, parent):
         """
@@ -450,7 +812,50 @@ class VolumeMetabase(object):
         """
         Update the pyhsical size of a volume
         """
-        self.__update_volume(volume_id, "psize", psize)
+        self.update_volume_psizes({volume_id: psize})
+
+    def update_volume_psizes(self, psizes, psize_time=None):
+        """
+        Update the physical sizes of volumes, by volume id, measured at
+        'psize_time' (now by default)
+        """
+        if psize_time is None:
+            psize_time = time.time()
+        # A size that did not change leaves the metabase file untouched
+        self._conn.executemany("""
+            UPDATE volume
+               SET psize = :psize
+             WHERE id = :volume_id
+               AND psize IS NOT :psize""",
+                               [{"psize": psize, "volume_id": volume_id}
+                                for volume_id, psize in psizes.items()])
+        self._conn.executemany("""
+            INSERT OR REPLACE INTO volume_psize_time(id, psize_time)
+            VALUES (:volume_id, :psize_time)""",
+                               [{"psize_time": psize_time,
+                                 "volume_id": volume_id}
+                                for volume_id in psizes])
+
+    def get_stale_vdi_volumes(self, max_age, now=None):
+        """
+        Return the volumes of the VDIs whose physical size was measured
+        more than 'max_age' seconds ago, or never
+        """
+        if now is None:
+            now = time.time()
+        res = self._conn.execute("""
+            SELECT volume.id, volume.parent_id, volume.snap, volume.vsize,
+                   volume.psize, volume.image_type,
+                   volume_psize_time.psize_time
+              FROM vdi
+                   INNER JOIN volume
+                   ON vdi.volume_id = volume.id
+                   LEFT JOIN volume_psize_time
+                   ON volume.id = volume_psize_time.id
+             WHERE volume_psize_time.psize_time IS NULL
+                OR volume_psize_time.psize_time < :oldest""",
+                                 {"oldest": now - max_age})
+        return [Volume.from_row(row) for row in res]
 
     def set_volume_as_snapshot(self, volume_id):
         """
@@ -488,10 +893,14 @@ class VolumeMetabase(object):
         Get VDI object by uuid
         """
         res = self._conn.execute("""
-            SELECT *
+            SELECT vdi.*, volume.id, volume.parent_id, volume.snap,
+                     volume.vsize, volume.psize, volume.image_type,
+                     volume_psize_time.psize_time
               FROM vdi
                    INNER JOIN volume
                    ON vdi.volume_id = volume.id
+                   LEFT JOIN volume_psize_time
+                   ON volume.id = volume_psize_time.id
              WHERE uuid = :uuid""",
                                  {"uuid": vdi_uuid})
 
@@ -506,10 +915,14 @@ class VolumeMetabase(object):
         Get VDI object for specified volume (if any)
         """
         res = self._conn.execute("""
-            SELECT *
+            SELECT vdi.*, volume.id, volume.parent_id, volume.snap,
+                    volume.vsize, volume.psize, volume.image_type,
+                    volume_psize_time.psize_time
              FROM vdi
                   INNER JOIN volume
                           ON vdi.volume_id = volume.id
+                  LEFT JOIN volume_psize_time
+                          ON volume.id = volume_psize_time.id
             WHERE vdi.volume_id = :volume_id""",
                                  {"volume_id": volume_id})
         row = res.fetchone()
@@ -518,15 +931,44 @@ class VolumeMetabase(object):
 
         return None
 
+    def get_vdis_by_ids(self, vdi_uuids):
+        """
+        Get the VDI objects of a list of uuids, the unknown ones are left
+        out
+        """
+        vdis = []
+        vdi_uuids = list(vdi_uuids)
+        # Stay below the default limit of 999 SQL variables
+        for start in range(0, len(vdi_uuids), 500):
+            chunk = vdi_uuids[start:start + 500]
+            res = self._conn.execute("""
+                SELECT vdi.*, volume.id, volume.parent_id, volume.snap,
+                         volume.vsize, volume.psize, volume.image_type,
+                         volume_psize_time.psize_time
+                  FROM vdi
+                       INNER JOIN volume
+                       ON vdi.volume_id = volume.id
+                       LEFT JOIN volume_psize_time
+                       ON volume.id = volume_psize_time.id
+                 WHERE uuid IN ({})""".format(','.join('?' * len(chunk))),
+                                     chunk)
+            for row in res:
+                vdis.append(VDI.from_row(row))
+        return vdis
+
     def get_all_vdis(self):
         """
         Get all VDIs
         """
         res = self._conn.execute("""
-            SELECT *
+            SELECT vdi.*, volume.id, volume.parent_id, volume.snap,
+                     volume.vsize, volume.psize, volume.image_type,
+                     volume_psize_time.psize_time
               FROM vdi
                    INNER JOIN volume
                    ON vdi.volume_id = volume.id
+                   LEFT JOIN volume_psize_time
+                   ON volume.id = volume_psize_time.id
         """)
 
         vdis = []
@@ -535,6 +977,50 @@ class VolumeMetabase(object):
 
         return vdis
 
+    def get_vdis_since(self, generation):
+        """
+        Get the VDIs changed after the specified generation
+        """
+        res = self._conn.execute("""
+            SELECT vdi.*, volume.id, volume.parent_id, volume.snap,
+                     volume.vsize, volume.psize, volume.image_type,
+                     volume_psize_time.psize_time
+              FROM vdi
+                   INNER JOIN volume
+                   ON vdi.volume_id = volume.id
+                   LEFT JOIN volume_psize_time
+                   ON volume.id = volume_psize_time.id
+             WHERE vdi.generation > :generation
+        """, {"generation": generation})
+        return [VDI.from_row(row) for row in res]
+
+    def get_vdis_deleted_since(self, generation):
+        """
+        Get the uuids of the VDIs deleted after the specified generation
+        """
+        res = self._conn.execute("""
+            SELECT uuid
+              FROM vdi_tombstone
+             WHERE generation > :generation
+        """, {"generation": generation})
+        return [row["uuid"] for row in res]
+
+    def get_vdi_changes(self, generation):
+        """
+        Return (full, vdis, custom keys by VDI uuid, deleted VDI uuids)
+        for the VDIs changed since 'generation'. All the VDIs and no
+        deletion if 'full', when the tombstones since 'generation' were
+        pruned or 'generation' is not one of this database.
+        """
+        if self.vdi_tombstone_horizon <= generation <= self.generation:
+            vdis = self.get_vdis_since(generation)
+            custom_keys = dict(
+                (vdi.uuid, self.get_vdi_custom_keys(vdi.uuid))
+                for vdi in vdis)
+            return (False, vdis, custom_keys,
+                    self.get_vdis_deleted_since(generation))
+        return True, self.get_all_vdis(), self.get_all_vdi_custom_keys(), []
+
     def get_all_volumes(self):
         """
         Get all volumes.
@@ -579,10 +1065,15 @@ class VolumeMetabase(object):
         """Returns the total psize of non-leaf volumes"""
         total_psize = 0
 
+        # Leaves also cache their psize, see psizecache
         res = self._conn.execute("""
             SELECT psize
               FROM volume
              WHERE psize NOT NULL
+               AND id IN
+                (SELECT parent_id
+                   FROM volume
+                  WHERE parent_id NOT NULL)
         """)
 
         for row in res:
@@ -599,6 +1090,9 @@ class VolumeMetabase(object):
                 (SELECT parent_id
                    FROM volume
                   WHERE parent_id NOT NULL)
+             AND id NOT IN
+                (SELECT id
+                   FROM spare_volume)
              AND snap = 0
         """)
         row = res.fetchone()
@@ -631,13 +1125,13 @@ class VolumeMetabase(object):
             volumes.append(Volume.from_row(row))
         return volumes
 
-    def find_leaf_coalesceable(self, active_on):
+    def find_leaf_coalesceable(self, active_on, include_inactive=True):
         """
         Find all leaf coalescable volume nodes.
 
         To be considered the node should be the only child of its parent and
-        have no children itself and be either inactive or active on the
-        specified host.
+        have no children itself and be either inactive (unless
+        'include_inactive' is False) or active on the specified host.
         """
         res = self._conn.execute("""
             SELECT *
@@ -659,8 +1153,8 @@ class VolumeMetabase(object):
                          GROUP BY parent_id))) AS node1
             INNER JOIN vdi ON volume_id=id
             WHERE active_on=:active
-              OR active_on IS NULL
-        """, {'active': active_on})
+              OR (active_on IS NULL AND :inactive)
+        """, {'active': active_on, 'inactive': include_inactive})
 
         volumes = []
         for row in res:
@@ -668,7 +1162,10 @@ class VolumeMetabase(object):
         return volumes
 
     def get_garbage_volumes(self):
-        """ A garbage volume is a leaf volume with no associated VDI """
+        """
+        A garbage volume is a leaf volume with no associated VDI, which
+        is not a spare
+        """
         res = self._conn.execute("""
             SELECT * FROM VOLUME
              WHERE id NOT IN
@@ -682,7 +1179,10 @@ class VolumeMetabase(object):
                 GROUP BY volume_id)
                 AND id NOT IN
                  (SELECT old_parent_id
-                    FROM refresh)""")
+                    FROM refresh)
+                AND id NOT IN
+                 (SELECT id
+                    FROM spare_volume)""")
 
         volumes = []
         for row in res:
@@ -690,6 +1190,92 @@ class VolumeMetabase(object):
 
         return volumes
 
+    def has_pending_gc_work(self, active_on, leader=True):
+        """
+        Tell if the GC running on the specified host has anything to do.
+
+        A GC that is not the leader of a shared SR only refreshes and leaf
+        coalesces the VDIs active on its host.
+        """
+        if not leader:
+            return bool(
+                self._conn.execute(
+                    "SELECT 1 FROM refresh WHERE active_on=:active_on LIMIT 1",
+                    {"active_on": active_on}).fetchone() or
+                self.find_leaf_coalesceable(active_on, include_inactive=False)
+            )
+        return bool(
+            self._conn.execute("SELECT 1 FROM journal LIMIT 1").fetchone() or
+            self._conn.execute(
+                "SELECT 1 FROM refresh WHERE active_on=:active_on LIMIT 1",
+                {"active_on": active_on}).fetchone() or
+            self.get_garbage_volumes() or
+            self.find_non_leaf_coalesceable() or
+            self.find_leaf_coalesceable(active_on)
+        )
+
+    def insert_spare_volume(self, vsize, image_type):
+        """
+        Add an empty volume to the pool of spare volumes
+        """
+        volume = self.insert_new_volume(vsize, image_type)
+        self._conn.execute(
+            "INSERT INTO spare_volume(id) VALUES (:id)", {"id": volume.id})
+        return volume
+
+    def claim_spare_volume(self, size_class, vsize, image_type,
+                           parent_id=None):
+        """
+        Take the oldest spare volume of 'size_class' bytes out of the
+        pool and turn it into a volume of 'vsize' bytes, child of
+        'parent_id' if not None. Return None if there is no such spare.
+        """
+        row = self._conn.execute("""
+            SELECT volume.*
+              FROM spare_volume
+                   INNER JOIN volume
+                   ON spare_volume.id = volume.id
+             WHERE vsize = :size_class
+          ORDER BY volume.id
+             LIMIT 1""", {"size_class": size_class}).fetchone()
+        if row is None:
+            return None
+        self._conn.execute(
+            "DELETE FROM spare_volume WHERE id=:id", {"id": row['id']})
+        self._conn.execute("""
+            UPDATE volume
+               SET parent_id = :parent_id, vsize = :vsize,
+                   image_type = :image_type
+             WHERE id = :volume_id""",
+                           {"parent_id": parent_id,
+                            "vsize": vsize,
+                            "image_type": image_type,
+                            "volume_id": row['id']})
+        return Volume(row['id'], parent_id, False, vsize, row['psize'],
+                      image_type)
+
+    def get_spare_volumes(self):
+        res = self._conn.execute("""
+            SELECT volume.*
+              FROM spare_volume
+                   INNER JOIN volume
+                   ON spare_volume.id = volume.id
+          ORDER BY volume.id""")
+        return [Volume.from_row(row) for row in res]
+
+    def get_vdi_vsizes(self):
+        """
+        Return the number of VDIs of each virtual size
+        """
+        res = self._conn.execute("""
+            SELECT vsize, COUNT(*) AS num
+              FROM vdi
+                   INNER JOIN volume
+                   ON vdi.volume_id = volume.id
+             WHERE vsize NOT NULL
+          GROUP BY vsize""")
+        return dict((row['vsize'], row['num']) for row in res)
+
     def add_journal_entries(self, parent_id, new_parent_id, children):
         """ Add journal entries for post-coalesce reparenting.
 
@@ -732,6 +1318,40 @@ class VolumeMetabase(object):
             DELETE FROM journal WHERE id=:id""",
                            {"id": entry_id})
 
+    def get_coalesce_checkpoint(self, volume_id, parent_id):
+        """
+        Next block to coalesce from the volume into the specified parent,
+        0 if no coalesce was interrupted
+        """
+        row = self._conn.execute("""
+            SELECT next_block FROM coalesce_checkpoint
+             WHERE id=:id AND parent_id=:parent_id""",
+                                 {"id": volume_id,
+                                  "parent_id": parent_id}).fetchone()
+        if row:
+            return row['next_block']
+        return 0
+
+    def set_coalesce_checkpoint(self, volume_id, parent_id, next_block):
+        """
+        Record the progress of the coalesce of a volume into its parent
+        """
+        self._conn.execute("""
+            INSERT OR REPLACE INTO coalesce_checkpoint(
+                id, parent_id, next_block)
+            VALUES(:id, :parent_id, :next_block)""",
+                           {"id": volume_id,
+                            "parent_id": parent_id,
+                            "next_block": next_block})
+
+    def remove_coalesce_checkpoint(self, volume_id):
+        """
+        Forget the progress of the coalesce of a volume
+        """
+        self._conn.execute("""
+            DELETE FROM coalesce_checkpoint WHERE id=:id""",
+                           {"id": volume_id})
+
     def add_refresh_entries(
             self, volume_id, old_parent_id, new_parent_id, leaves):
         """ Add refresh entries for post-reparenting refresh
@@ -762,9 +1382,10 @@ class VolumeMetabase(object):
         """
         Get all entries in the refresh table
         """
-        res = self._conn.execute(
-            "SELECT * FROM refresh WHERE active_on=:active_on",
-            {"active_on": active_on})
+        res = self._conn.execute("""
+            SELECT * FROM refresh
+             WHERE active_on=:active_on
+          ORDER BY rowid""", {"active_on": active_on})
         refresh_entries = []
         for row in res:
             refresh_entries.append(Refresh.from_row(row))
@@ -778,6 +1399,30 @@ class VolumeMetabase(object):
             DELETE FROM refresh WHERE leaf_id=:leaf_id""",
                            {'leaf_id': leaf_id})
 
+    def remove_refresh_entries(self, leaf_ids):
+        """
+        Remove the refresh entries of all the specified leaf ids
+        """
+        self._conn.executemany(
+            "DELETE FROM refresh WHERE leaf_id=:leaf_id",
+            [{'leaf_id': leaf_id} for leaf_id in leaf_ids])
+
+    def remove_applied_refresh_entries(self, entries):
+        """
+        Remove the specified Refresh entries
+        """
+        self._conn.executemany("""
+            DELETE FROM refresh
+             WHERE leaf_id=:leaf_id
+               AND child_id=:child_id
+               AND old_parent_id=:old_parent_id
+               AND new_parent_id=:new_parent_id""",
+                               [{'leaf_id': entry.leaf_id,
+                                 'child_id': entry.updated_node,
+                                 'old_parent_id': entry.old_parent,
+                                 'new_parent_id': entry.new_parent}
+                                for entry in entries])
+
     def get_vdi_custom_keys(self, vdi_uuid):
         """
         Get all custom_keys for vdi_uuid
@@ -839,6 +1484,33 @@ class VolumeMetabase(object):
 
         return volume_count
 
+    def get_max_chain_height(self):
+        """
+        Return the height of the longest volume chain of the SR
+        """
+        parents = dict(
+            (row['id'], row['parent_id'])
+            for row in self._conn.execute("SELECT id, parent_id FROM volume"))
+        heights = {}
+        for volume_id in parents:
+            # Walk up to the first volume of known height
+            chain = []
+            while volume_id is not None and volume_id not in heights:
+                chain.append(volume_id)
+                volume_id = parents.get(volume_id)
+            height = heights.get(volume_id, 0)
+            for volume_id in reversed(chain):
+                height += 1
+                heights[volume_id] = height
+        return max(heights.values()) if heights else 0
+
+    def count_refresh_entries(self):
+        """
+        Return the number of datapath refreshes pending on all the hosts
+        """
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM refresh").fetchone()[0]
+
     def clear_host_references(self, host_id):
         """
         Removes the links to hosts in VDI and refresh tables
@@ -0,0 +1,109 @@
+"""
+Physical sizes of the VDIs cached in the metabase, so that SR.ls does not
+stat every volume of the SR.
+
+volume.psize holds the last measure and volume_psize_time its time, in a
+database attached to the metabase so that refreshing a measure that did
+not change does not wake the GC up. SR.ls reports the measures younger
+than 'psize_max_age' seconds and only measures the other volumes. The supervisor refreshes the measures before
+they get that old, one volume at a time so that the file system is not
+flooded, and stores them REFRESH_BATCH_SIZE at a time. On a shared SR
+only the GC leader refreshes them.
+"""
+
+from __future__ import absolute_import, division
+import time
+
+from xapi.storage import log
+from xapi.storage.libs import util
+from xapi.storage.libs.libcow.callbacks import VolumeContext
+from xapi.storage.libs.libcow.lease import GCLease
+
+# Longest time between two refreshes, in seconds
+REFRESH_INTERVAL_MAX = 60
+
+# Measures stored per metabase transaction
+REFRESH_BATCH_SIZE = 64
+
+_DBG = 'psize_refresher'
+
+
+def is_fresh(volume, max_age, now):
+    return (volume.psize is not None and volume.psize_time is not None and
+            now - volume.psize_time <= max_age)
+
+
+def get_psizes(dbg, opq, callbacks, vdis, max_age):
+    """
+    Return the physical sizes of 'vdis', measuring the ones whose cached
+    size is older than 'max_age' seconds and caching the new measures
+    """
+    now = time.time()
+    stale = [vdi for vdi in vdis if not is_fresh(vdi.volume, max_age, now)]
+    if stale:
+        psizes = util.parallel_map(
+            dbg,
+            lambda vdi: callbacks.volumeGetPhysSize(opq, str(vdi.volume.id)),
+            stale
+        )
+        measures = {}
+        for vdi, psize in zip(stale, psizes):
+            vdi.volume.psize = psize
+            measures[vdi.volume.id] = psize
+        with callbacks.db_context(opq) as db:
+            db.update_volume_psizes(measures, now)
+    return [vdi.volume.psize for vdi in vdis]
+
+
+def refresh(uri, callbacks, sleep=None):
+    """
+    Measure the VDIs of an SR whose cached physical size will be too old
+    for SR.ls within half of 'psize_max_age'. Return the interval until
+    the next refresh.
+    """
+    with VolumeContext(callbacks, uri, 'r') as opq:
+        with callbacks.db_context(opq) as db:
+            max_age = db.psize_max_age
+            volumes = db.get_stale_vdi_volumes(max_age / 2)
+
+        for start in range(0, len(volumes), REFRESH_BATCH_SIZE):
+            measures = {}
+            for volume in volumes[start:start + REFRESH_BATCH_SIZE]:
+                try:
+                    measures[volume.id] = callbacks.volumeGetPhysSize(
+                        opq, str(volume.id))
+                except (IOError, OSError) as exc:
+                    # Destroyed since it was listed
+                    log.debug('{}: cannot measure volume {}: {}'.format(
+                        _DBG, volume.id, exc))
+            if measures:
+                with callbacks.db_context(opq) as db:
+                    db.update_volume_psizes(measures)
+            if sleep is not None and not sleep(0):
+                break
+    return min(max_age / 2, REFRESH_INTERVAL_MAX)
+
+
+def run_refresher(job):
+    """
+    Keep the cached physical sizes of an SR fresh until the job is
+    stopped
+    """
+    uri, callbacks = job.uri, job.callbacks
+    this_host = callbacks.get_current_host()
+    with VolumeContext(callbacks, uri, 'r') as opq:
+        lease = None
+        if callbacks.is_shared(opq):
+            lease = GCLease(opq, callbacks, this_host)
+    while not job.stopping:
+        if lease is not None and lease.holder() != this_host:
+            # SR.ls measures what the leader did not
+            job.sleep(REFRESH_INTERVAL_MAX)
+            continue
+        try:
+            interval = refresh(uri, callbacks, job.sleep)
+        except Exception as exc:
+            log.error('{}: cannot refresh the sizes of {}: {}'.format(
+                _DBG, uri, exc))
+            interval = REFRESH_INTERVAL_MAX
+        job.sleep(interval)
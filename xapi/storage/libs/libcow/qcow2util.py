@@ -1,6 +1,9 @@
 import json
+import struct
+
+from xapi.storage.libs.libcow.allocationmap import AllocationMap
 from xapi.storage.libs.libcow.cowutil import COWUtil
-from xapi.storage.libs.util import call
+from xapi.storage.libs.util import call, cached_call, invalidate_cached_calls
 from xapi.storage import log
 import xapi.storage.libs.qemudisk as qemudisk
 
@@ -14,6 +17,14 @@ QEMU_IO = '/usr/lib64/qemu-dp/bin/qemu-io'
 
 QCOW2_CLUSTER_SIZE = '2048k'
 
+QCOW2_MAGIC = b'QFI\xfb'
+QCOW2_HEADER_FORMAT = '>4sIQIIQIIQ'
+# Bits 9-55 of L1/L2 entries hold the host offset
+QCOW2_OFFSET_MASK = 0x00fffffffffffe00
+# Everything but the "copied" flag (bit 63) marks a cluster as allocated:
+# host offset, compressed flag (bit 62) or zero flag (bit 0)
+QCOW2_L2_ALLOCATED_MASK = 0x7fffffffffffffff
+
 
 def __num_bits(val):
     count = 0
@@ -30,6 +41,15 @@ def __count_bits(bitmap):
     return count
 
 
+def _read_table(qcow2_file, offset, nr_entries):
+    """
+    Read a table of big endian 64 bits entries (L1 or L2)
+    """
+    qcow2_file.seek(offset)
+    return struct.unpack(
+        '>{}Q'.format(nr_entries), qcow2_file.read(nr_entries * 8))
+
+
 class QCOW2Util(COWUtil):
     @staticmethod
     def get_max_chain_height():
@@ -37,19 +57,40 @@ class QCOW2Util(COWUtil):
 
     @staticmethod
     def is_empty(dbg, vol_path):
-        cmd = [
-            QEMU_IO,
-            '--cmd', 'open ' + vol_path,
-            '--cmd', 'map'
-        ]
-        ret = call(dbg, cmd)
-        lines = ret.splitlines()
-        if len(lines) == 1:
-            log.debug("Empty, {}".format(lines[0]))
-            return "not allocated" in lines[0]
-        else:
-            log.debug("Not empty {}".format(lines))
-            return False
+        return QCOW2Util.get_allocation_map(dbg, vol_path).is_empty()
+
+    @staticmethod
+    def get_allocation_map(dbg, vol_path):
+        """Build the allocation map from the L1 and L2 tables.
+
+        Only the clusters described by this image are reported, data
+        coming from the backing file is ignored.
+        """
+        with open(vol_path, 'rb') as qcow2_file:
+            header = qcow2_file.read(struct.calcsize(QCOW2_HEADER_FORMAT))
+            (magic, _, _, _, cluster_bits, vsize, _, l1_size,
+             l1_table_offset) = struct.unpack(QCOW2_HEADER_FORMAT, header)
+            if magic != QCOW2_MAGIC:
+                raise ValueError('{} is not a QCOW2 file'.format(vol_path))
+
+            cluster_size = 1 << cluster_bits
+            l2_entries = cluster_size // 8
+            allocation_map = AllocationMap(cluster_size, vsize)
+            l1_table = _read_table(qcow2_file, l1_table_offset, l1_size)
+            for l1_index, l1_entry in enumerate(l1_table):
+                l2_offset = l1_entry & QCOW2_OFFSET_MASK
+                if not l2_offset:
+                    continue
+                first_cluster = l1_index * l2_entries
+                l2_table = _read_table(qcow2_file, l2_offset, l2_entries)
+                for l2_index, l2_entry in enumerate(l2_table):
+                    cluster = first_cluster + l2_index
+                    if cluster >= allocation_map.nr_blocks:
+                        break
+                    if l2_entry & QCOW2_L2_ALLOCATED_MASK:
+                        allocation_map.set_block(cluster)
+        log.debug("{}: {} {}".format(dbg, vol_path, allocation_map))
+        return allocation_map
 
     @staticmethod
     def create(dbg, vol_path, size_mib):
@@ -60,6 +101,7 @@ class QCOW2Util(COWUtil):
             .format(size_mib, QCOW2_CLUSTER_SIZE),
             vol_path
         ]
+        invalidate_cached_calls((vol_path,))
         return call(dbg, cmd)
 
     @staticmethod
@@ -71,6 +113,7 @@ class QCOW2Util(COWUtil):
             .format(backing_file, QCOW2_CLUSTER_SIZE),
             vol_path
         ]
+        invalidate_cached_calls((vol_path,))
         return call(dbg, cmd)
 
     @staticmethod
@@ -80,6 +123,7 @@ class QCOW2Util(COWUtil):
             vol_path,
             str(size_mib) + 'M'
         ]
+        invalidate_cached_calls((vol_path,))
         return call(dbg, cmd)
 
     @staticmethod
@@ -129,10 +173,10 @@ class QCOW2Util(COWUtil):
         return QCOW2Util.create_snapshot(dbg, backing_file, new_cow_path)
 
     @staticmethod
-    def coalesce(dbg, vol_path, parent_path):
+    def coalesce(dbg, vol_path, parent_path, throttle=None):
         cmd = [QEMU_IMG, 'commit', '-q', '-t', 'none', vol_path,
                '-b', parent_path, '-d']
-        return call(dbg, cmd)
+        return call(dbg, cmd, throttle=throttle)
 
     @staticmethod
     def get_parent(dbg, vol_path):
@@ -141,7 +185,7 @@ class QCOW2Util(COWUtil):
             '--output=json',
             vol_path
         ]
-        ret = call(dbg, cmd)
+        ret = cached_call(dbg, cmd, tags=(vol_path,))
         d = json.loads(ret)
         if "backing-filename" in d.keys():
             return d["backing-filename"]
@@ -155,10 +199,34 @@ class QCOW2Util(COWUtil):
         out = call(dbg, cmd).rstrip()
         return int(out) * MEBIBYTE
 
+    @staticmethod
+    def scan(dbg, paths):
+        """Get parent, vsize and psize using qemu-img --backing-chain.
+
+        A single call describes a whole chain, so images already seen as
+        part of a previous chain are not queried again.
+        """
+        results = {}
+        for vol_path in paths:
+            if vol_path in results:
+                continue
+            cmd = [QEMU_IMG, 'info', '--output=json', '--backing-chain',
+                   vol_path]
+            chain = json.loads(call(dbg, cmd))
+            # The first entry describes vol_path itself
+            chain[0]['filename'] = vol_path
+            for info in chain:
+                parent = info.get(
+                    'full-backing-filename', info.get('backing-filename'))
+                results[info['filename']] = (
+                    parent, info['virtual-size'], info.get('actual-size'))
+        return dict((path, results[path]) for path in paths)
+
     @staticmethod
     def set_parent(dbg, vol_path, parent_path):
         cmd = [QEMU_IMG, 'rebase', '-t', 'none', '-T', 'none',
                vol_path, '-b', parent_path, '-u']
+        invalidate_cached_calls((vol_path,))
         return call(dbg, cmd)
 
     @staticmethod
@@ -1,7 +1,34 @@
+import errno
+import os
+
 from xapi.storage.libs import util
+from xapi.storage.libs.libcow.allocationmap import AllocationMap
 
 
 MEBIBYTE = 2**20
+RAW_BLOCK_SIZE = 2 * MEBIBYTE
+
+# Linux lseek(2) whence values, not exposed by the os module in Python 2
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+
+def _data_extents(fd, size):
+    """
+    Yield the (offset, length) data ranges of a sparse file
+    """
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as exc:
+            if exc.errno == errno.ENXIO:
+                # No data after offset
+                return
+            raise
+        end = os.lseek(fd, start, SEEK_HOLE)
+        yield start, end - start
+        offset = end
 
 
 class RawUtil(object):
@@ -12,10 +39,46 @@ class RawUtil(object):
                 # truncate is in bytes
                 vdi.truncate(size_mib * MEBIBYTE)
 
+    @staticmethod
+    def is_empty(dbg, vol_path):
+        return RawUtil.get_allocation_map(dbg, vol_path).is_empty()
+
+    @staticmethod
+    def get_allocation_map(dbg, vol_path):
+        """Build the allocation map using SEEK_DATA/SEEK_HOLE.
+
+        Block devices and filesystems without sparse file support are
+        reported as fully allocated.
+        """
+        size = util.get_file_size(vol_path)
+        if util.is_block_device(vol_path):
+            return AllocationMap.fully_allocated(RAW_BLOCK_SIZE, size)
+
+        fd = os.open(vol_path, os.O_RDONLY)
+        try:
+            return AllocationMap.from_extents(
+                RAW_BLOCK_SIZE, size, _data_extents(fd, size))
+        except OSError as exc:
+            if exc.errno != errno.EINVAL:
+                raise
+            return AllocationMap.fully_allocated(RAW_BLOCK_SIZE, size)
+        finally:
+            os.close(fd)
+
     @staticmethod
     def get_vsize(dbg, vol_path):
         return util.get_file_size(vol_path)
 
+    @staticmethod
+    def scan(dbg, paths):
+        results = {}
+        for vol_path in paths:
+            results[vol_path] = (
+                None,
+                util.get_file_size(vol_path),
+                util.get_physical_file_size(vol_path))
+        return results
+
     @staticmethod
     def getImgFormat(dbg):
         return 'raw'
@@ -0,0 +1,52 @@
+"""
+Background removal of the volumes moved to the trash of an SR
+"""
+
+from __future__ import absolute_import
+
+from xapi.storage import log
+from xapi.storage.libs.libcow.callbacks import VolumeContext
+from xapi.storage.libs.libcow.coalesce import gc_is_enabled
+from xapi.storage.libs.libcow.lease import GCLease
+from xapi.storage.libs.libcow.scheduler import GCScheduler
+
+
+def get_reap_rate(uri, callbacks):
+    with VolumeContext(callbacks, uri, 'w') as opq:
+        with callbacks.db_context(opq) as db:
+            return db.trash_reap_rate
+
+
+def run_reaper(job):
+    """
+    Trash reaper loop of an SR, run by the supervisor like the GC.
+
+    Deleted volumes are shrunk at the configured rate before being
+    unlinked so that huge files do not stall the file system. On a shared
+    SR only the GC leader empties the trash.
+    """
+    uri, callbacks = job.uri, job.callbacks
+    this_host = callbacks.get_current_host()
+    with VolumeContext(callbacks, uri, 'w') as opq:
+        scheduler = GCScheduler(opq, callbacks, watch_db=False)
+        lease = None
+        if callbacks.is_shared(opq):
+            lease = GCLease(opq, callbacks, this_host)
+    job.on_stop(scheduler.interrupt)
+    try:
+        while not job.stopping and gc_is_enabled(uri, callbacks):
+            is_leader = lease is None or lease.holder() == this_host
+            if is_leader:
+                rate = get_reap_rate(uri, callbacks)
+            # Files trashed from now on wake up the wait below
+            scheduler.drain()
+            emptied = True
+            if is_leader:
+                with VolumeContext(callbacks, uri, 'w') as opq:
+                    emptied = callbacks.empty_trash(opq, rate, job.sleep)
+            if emptied:
+                scheduler.wait_idle(False)
+    finally:
+        scheduler.close()
+    if not job.stopping:
+        log.debug('Stopping trash reaper of {}... GC is disabled'.format(uri))
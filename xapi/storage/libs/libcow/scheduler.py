@@ -0,0 +1,189 @@
+"""
+Wake-up policy of the GC main loop
+"""
+
+from __future__ import absolute_import
+import errno
+import os
+import select
+import struct
+import time
+
+from xapi.storage import log
+from xapi.storage.libs import inotify
+
+# Delay before retrying when candidates exist but none could be processed,
+# e.g. because their volumes are locked by a running operation
+GC_RETRY_INTERVAL = 30
+
+# Polling period when inotify cannot be used and the SR defines no timeout
+GC_POLL_INTERVAL = 30
+
+# Opening and closing the metabase, as every read does, raises no event
+# of these: only writes and the restore of a backup
+_DB_EVENTS = inotify.IN_MODIFY | inotify.IN_MOVED_TO
+_TRASH_EVENTS = inotify.IN_MOVED_TO | inotify.IN_CREATE
+
+# Offset of the file change counter in the header of a sqlite database,
+# incremented by each committed write transaction
+_DB_CHANGE_COUNTER_OFFSET = 24
+
+
+def read_db_change_counter(db_path):
+    """
+    Return the file change counter of the sqlite database 'db_path', None
+    if it cannot be read
+    """
+    try:
+        with open(db_path, 'rb') as db_file:
+            db_file.seek(_DB_CHANGE_COUNTER_OFFSET)
+            data = db_file.read(4)
+    except IOError:
+        return None
+    if len(data) != 4:
+        return None
+    return struct.unpack('>I', data)[0]
+
+
+class GCScheduler(object):
+    """
+    Decide when the GC runs its next pass.
+
+    The GC runs passes back to back while they do some work. When a pass
+    finds nothing to do it sleeps until a write transaction is committed
+    to the metabase or a file is put in the trash directory, or until the
+    idle timeout of the SR expires: changes made by other hosts on a
+    shared SR raise no local event.
+
+    inotify only tells that a file of the metabase was written, the file
+    change counter of the database tells whether a transaction actually
+    changed it since drain(). The times of the physical sizes live in
+    another file, ignored, see VolumeMetabase.update_volume_psizes().
+
+    interrupt() ends the current and the next waits, to stop the GC.
+
+    With 'watch_db' False only the trash directory wakes it up, as the
+    trash reaper needs.
+    """
+
+    def __init__(self, opq, callbacks, watch_db=True):
+        db_path = callbacks.volumeMetadataGetPath(opq)
+        db_name = os.path.basename(db_path)
+        self.db_path = db_path
+        self.watch_db = watch_db
+        # The journal of a rollback is written before the database
+        self.db_files = set([db_name, db_name + '-wal'])
+        self.db_change_counter = None
+        self.trash_dir = callbacks.get_trash_dir(opq)
+        self.idle_timeout = callbacks.get_gc_idle_timeout(opq)
+
+        self.interrupted = False
+        self.wake_fds = os.pipe()
+
+        self.watcher = None
+        try:
+            self.watcher = inotify.Watcher()
+            if watch_db:
+                self.watcher.add_watch(os.path.dirname(db_path), _DB_EVENTS)
+            self.watcher.add_watch(self.trash_dir, _TRASH_EVENTS)
+        except OSError as exc:
+            log.error('GC: cannot watch {} ({}), polling every {}s'.format(
+                opq, exc, GC_POLL_INTERVAL))
+            if self.watcher:
+                self.watcher.close()
+                self.watcher = None
+
+    def __db_changed(self):
+        """
+        Tell if a transaction was committed since the last call
+        """
+        if not self.watch_db:
+            return False
+        change_counter = read_db_change_counter(self.db_path)
+        changed = change_counter != self.db_change_counter
+        self.db_change_counter = change_counter
+        return changed
+
+    def __is_relevant(self, events):
+        db_written = False
+        for path, mask, name in events:
+            if mask & inotify.IN_Q_OVERFLOW or path == self.trash_dir:
+                return True
+            if name in self.db_files:
+                db_written = True
+        return db_written and self.__db_changed()
+
+    def drain(self):
+        """
+        Forget the events received so far, including the ones caused by
+        the GC itself. Must be called before checking for pending work so
+        that no later change is missed.
+        """
+        if self.watcher:
+            self.watcher.read_events()
+        self.__db_changed()
+
+    def __select(self, timeout):
+        fds = [self.wake_fds[0]]
+        if self.watcher:
+            fds.append(self.watcher.fd)
+        try:
+            readable, _, _ = select.select(fds, [], [], timeout)
+        except select.error as exc:
+            if exc.args[0] != errno.EINTR:
+                raise
+            return []
+        if self.watcher and self.watcher.fd in readable:
+            return self.watcher.read_events()
+        return []
+
+    def wait(self, timeout):
+        """
+        Sleep until a relevant change or 'timeout' seconds (None: forever).
+
+        Return True if woken up by a change.
+        """
+        if self.watcher is None and timeout is None:
+            timeout = GC_POLL_INTERVAL
+
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.interrupted:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.time())
+            events = self.__select(remaining)
+            if events and self.__is_relevant(events):
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+        return False
+
+    def wait_idle(self, has_pending_work):
+        """
+        Sleep after a pass that did no work
+        """
+        if has_pending_work:
+            timeout = GC_RETRY_INTERVAL
+            if self.idle_timeout is not None:
+                timeout = min(timeout, self.idle_timeout)
+        else:
+            timeout = self.idle_timeout
+        return self.wait(timeout)
+
+    def interrupt(self):
+        """
+        Wake up the GC for good, may be called from any thread
+        """
+        self.interrupted = True
+        wake_fds = self.wake_fds
+        if wake_fds:
+            os.write(wake_fds[1], b'\0')
+
+    def close(self):
+        if self.watcher:
+            self.watcher.close()
+            self.watcher = None
+        if self.wake_fds:
+            for fd in self.wake_fds:
+                os.close(fd)
+            self.wake_fds = None
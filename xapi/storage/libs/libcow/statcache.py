@@ -0,0 +1,124 @@
+"""
+Host-local cache of the results of SR.stat.
+
+SR.stat scans the metabase for the provisioned size and queries the file
+system (or the zpool) each time xapi polls the SR. Its result is kept for
+'sr_stat_ttl' seconds in a file of this host and dropped by the
+operations of this host changing it: creating, destroying, resizing,
+snapshotting or cloning a volume and renaming the SR. Changes made by
+other hosts of a shared SR, and the space freed by the GC, show after
+the TTL at most.
+"""
+
+from __future__ import absolute_import
+import errno
+import functools
+import inspect
+import json
+import os
+import time
+import urlparse
+
+from xapi.storage import log
+from xapi.storage.libs import util
+from xapi.storage.libs.libcow.callbacks import VolumeContext
+
+
+def _cache_path(sr):
+    name = util.sanitise_name(os.path.normpath(urlparse.urlparse(sr).path))
+    return os.path.join(util.var_run_prefix(), 'sr', 'stat', name)
+
+
+def _read(path):
+    try:
+        with open(path) as cache:
+            return json.load(cache)
+    except IOError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+    except ValueError:
+        # Interrupted write
+        pass
+    return {}
+
+
+def _write(path, entry):
+    tmp_path = '{}.{}'.format(path, os.getpid())
+    with open(tmp_path, 'w') as cache:
+        json.dump(entry, cache)
+    os.rename(tmp_path, path)
+
+
+def _locked(path):
+    util.mkdir_p(os.path.dirname(path))
+    return util.lock_file('statcache', path + '.lock', mode='w+')
+
+
+def invalidate(dbg, sr):
+    """
+    Drop the cached SR.stat of 'sr', including the result of a stat
+    running at the same time
+    """
+    path = _cache_path(sr)
+    try:
+        lock = _locked(path)
+        try:
+            _write(path, {'invalidated': time.time()})
+        finally:
+            util.unlock_file(dbg, lock)
+    except (IOError, OSError) as exc:
+        # The cache is then only refreshed after the TTL
+        log.error('{}: cannot invalidate the SR.stat cache of {}: {}'.format(
+            dbg, sr, exc))
+
+
+def invalidates(function):
+    """
+    Decorator of the operations changing what SR.stat reports, which take
+    'dbg' and 'sr' arguments. The invalidation never raises.
+    """
+    @functools.wraps(function)
+    def _invalidates(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        finally:
+            try:
+                call_args = inspect.getcallargs(function, *args, **kwargs)
+                invalidate(call_args['dbg'], call_args['sr'])
+            except Exception as exc:
+                log.error('Cannot invalidate the SR.stat cache after {}: '
+                          '{}'.format(function.__name__, exc))
+    return _invalidates
+
+
+def cached_stat(dbg, sr, callbacks, stat):
+    """
+    Return the result of stat() for 'sr', cached for 'sr_stat_ttl'
+    seconds
+    """
+    path = _cache_path(sr)
+    now = time.time()
+    entry = _read(path)
+    if 'result' in entry and 0 <= now - entry['time'] <= entry['ttl']:
+        log.debug('{}: Reusing SR.stat of {} from {}'.format(
+            dbg, sr, entry['time']))
+        return entry['result']
+
+    with VolumeContext(callbacks, sr, 'r') as opq:
+        with callbacks.db_context(opq) as db:
+            ttl = db.sr_stat_ttl
+    result = stat()
+    if ttl <= 0:
+        return result
+
+    try:
+        lock = _locked(path)
+        try:
+            # Not if the SR changed while it was measured
+            if _read(path).get('invalidated', 0) < now:
+                _write(path, {'time': now, 'ttl': ttl, 'result': result})
+        finally:
+            util.unlock_file(dbg, lock)
+    except (IOError, OSError) as exc:
+        log.error('{}: cannot cache SR.stat of {}: {}'.format(dbg, sr, exc))
+    return result
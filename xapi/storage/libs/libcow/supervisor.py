@@ -0,0 +1,501 @@
+#!/usr/bin/env python
+"""
+Host-wide supervisor of the background tasks of the SRs.
+
+A single daemon per host runs, each in its own thread, the GC, the trash
+reaper, the publisher of the GC statistics, the filler of the volume pool,
+the refresher of the cached physical sizes and the tasks returned by
+Callbacks.get_background_tasks() of every attached SR. SRs without a GC,
+see Callbacks.has_gc(), only get the volume pool and their own tasks:
+
+- at most MAX_CONCURRENT_GC_PASSES GC passes run at once across the SRs,
+- a task that fails is restarted after a delay doubling at each failure,
+- SRs are registered through a Unix socket which also serves the status
+  of the jobs.
+
+    supervisor.py           run the daemon (started on demand, through
+                            its systemd service if installed)
+    supervisor.py status    print the jobs of this host
+"""
+
+from __future__ import absolute_import
+from contextlib import contextmanager
+import errno
+import fcntl
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+from xapi.storage import log
+from xapi.storage.libs import util
+from xapi.storage.libs.libcow import (
+    coalesce, gcstats, psizecache, reaper, volumepool)
+
+# GC passes running at once on the host, across all the SRs
+MAX_CONCURRENT_GC_PASSES = 2
+
+# Delay before restarting a failed job, doubled at each failure in a row
+RESTART_DELAY_MIN = 1
+RESTART_DELAY_MAX = 300
+
+# A job running for that long before failing is restarted without delay
+HEALTHY_RUN_TIME = 600
+
+# Time given to the jobs of an SR to stop when it is unregistered
+STOP_TIMEOUT = 30
+
+# Time given to a new supervisor to accept connections
+START_TIMEOUT = 10
+
+# systemd unit of the supervisor, see daemons/xapi-storage-supervisor
+SERVICE = 'xapi-storage-supervisor.service'
+
+# Job states
+RUNNING = 'running'
+WORKING = 'working'
+RESTARTING = 'restarting'
+FINISHED = 'finished'
+STOPPED = 'stopped'
+
+
+class SupervisorError(Exception):
+    pass
+
+
+class JobsStillRunning(SupervisorError):
+    """
+    The jobs of an SR did not stop in time: the SR must not be detached,
+    nor registered again, until they are gone
+    """
+    pass
+
+
+def _run_dir():
+    return os.path.join(util.var_run_prefix(), 'sr')
+
+
+def socket_path():
+    return os.path.join(_run_dir(), 'supervisor.sock')
+
+
+def _lock_path():
+    return os.path.join(_run_dir(), 'supervisor.lock')
+
+
+def _state_path():
+    return os.path.join(_run_dir(), 'supervisor.json')
+
+
+def _read_line(sock):
+    data = ''
+    while not data.endswith('\n'):
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+class Job(object):
+    """
+    Background task of an SR, run in its own thread.
+
+    The task is a function called with the job. It must sleep through
+    sleep(), return soon after 'stopping' is set and hold work() while it
+    uses the budget shared by all the jobs. Stopping the job also kills
+    the commands the task runs through util.call(), which then raises
+    util.Interrupted.
+    """
+
+    def __init__(self, name, sr_type, uri, target, budget):
+        self.name = name
+        self.sr_type = sr_type
+        self.uri = uri
+        self.callbacks = util.get_sr_callbacks(sr_type)
+        self.target = target
+        self.budget = budget
+        self.state = RUNNING
+        self.started = None
+        self.restarts = 0
+        self.last_error = None
+        self.__stopping = threading.Event()
+        self.__interruption = util.Interruption()
+        self.__on_stop = []
+        self.__lock = threading.Lock()
+        self.thread = threading.Thread(
+            target=self.__run, name='{}:{}'.format(name, uri))
+        self.thread.daemon = True
+
+    @property
+    def stopping(self):
+        return self.__stopping.is_set()
+
+    def sleep(self, seconds):
+        """
+        Sleep up to 'seconds', return False if the job is stopping
+        """
+        return not self.__stopping.wait(seconds)
+
+    def on_stop(self, callback):
+        """
+        Call 'callback' when the job is stopped, e.g. to end a wait. Only
+        valid until the task returns.
+        """
+        with self.__lock:
+            if not self.stopping:
+                self.__on_stop.append(callback)
+                return
+        callback()
+
+    @contextmanager
+    def work(self):
+        with self.budget:
+            self.state = WORKING
+            try:
+                yield
+            finally:
+                self.state = RUNNING
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        with self.__lock:
+            self.__stopping.set()
+            callbacks, self.__on_stop = self.__on_stop, []
+        self.__interruption.interrupt()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as exc:
+                log.error('{}: cannot interrupt {}: {}'.format(
+                    self.name, self.uri, exc))
+
+    def join(self, timeout):
+        """
+        Wait for the task to return, return False on timeout
+        """
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def __run(self):
+        util.set_interruption(self.__interruption)
+        delay = RESTART_DELAY_MIN
+        while not self.stopping:
+            self.state = RUNNING
+            self.started = time.time()
+            try:
+                self.target(self)
+                if not self.stopping:
+                    self.state = FINISHED
+                    log.debug('{}: {} finished'.format(self.name, self.uri))
+                    return
+            except Exception:
+                self.last_error = traceback.format_exc().strip().splitlines(
+                )[-1]
+                log.error('{}: {} failed: {}'.format(
+                    self.name, self.uri, traceback.format_exc()))
+            finally:
+                with self.__lock:
+                    self.__on_stop = []
+
+            if self.stopping:
+                break
+            if time.time() - self.started >= HEALTHY_RUN_TIME:
+                delay = RESTART_DELAY_MIN
+            self.state = RESTARTING
+            self.restarts += 1
+            log.debug('{}: restarting {} in {}s'.format(
+                self.name, self.uri, delay))
+            self.sleep(delay)
+            delay = min(delay * 2, RESTART_DELAY_MAX)
+        self.state = STOPPED
+
+    def status(self):
+        return {
+            'name': self.name,
+            'sr_type': self.sr_type,
+            'uri': self.uri,
+            'state': self.state,
+            'started': self.started,
+            'restarts': self.restarts,
+            'last_error': self.last_error
+        }
+
+
+class Supervisor(object):
+    """
+    Jobs of the SRs registered on this host
+    """
+
+    def __init__(self, max_concurrent_passes=MAX_CONCURRENT_GC_PASSES):
+        self.budget = threading.Semaphore(max_concurrent_passes)
+        self.lock = threading.Lock()
+        # uri -> (sr_type, [Job])
+        self.srs = {}
+        # uri -> [Job] unregistered but not stopped yet
+        self.stopping = {}
+
+    def __save(self):
+        state = dict((uri, sr_type) for uri, (sr_type, _) in self.srs.items())
+        tmp_path = _state_path() + '.tmp'
+        with open(tmp_path, 'w') as state_file:
+            json.dump(state, state_file)
+        os.rename(tmp_path, _state_path())
+
+    def load(self):
+        """
+        Register again the SRs of a previous supervisor
+        """
+        try:
+            with open(_state_path()) as state_file:
+                state = json.load(state_file)
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                log.error('Cannot read the supervisor state: {}'.format(exc))
+            return
+        for uri, sr_type in state.items():
+            try:
+                self.register(sr_type, uri)
+            except Exception as exc:
+                log.error('Cannot register {} again: {}'.format(uri, exc))
+
+    def register(self, sr_type, uri):
+        """
+        Start the jobs of an SR, return False if it was already registered
+        """
+        with self.lock:
+            if uri in self.srs:
+                return False
+            self.__check_stopped(uri)
+            callbacks = util.get_sr_callbacks(sr_type)
+            if callbacks.has_gc():
+                # The GC comes first, it is also stopped first
+                tasks = [('gc', coalesce.run_gc),
+                         ('trash_reaper', reaper.run_reaper),
+                         ('gc_stats', gcstats.run_publisher),
+                         ('volume_pool', volumepool.run_pool),
+                         ('psize_refresher', psizecache.run_refresher)]
+            else:
+                tasks = [('volume_pool', volumepool.run_pool)]
+            tasks.extend(callbacks.get_background_tasks() or [])
+            jobs = [Job(name, sr_type, uri, target, self.budget)
+                    for name, target in tasks]
+            self.srs[uri] = (sr_type, jobs)
+            self.__save()
+        for job in jobs:
+            log.debug('Starting {} sr_type={} uri={}'.format(
+                job.name, sr_type, uri))
+            job.start()
+        return True
+
+    def __check_stopped(self, uri):
+        """
+        Raise JobsStillRunning if jobs of a previous registration of 'uri'
+        are alive. Must be called with the lock held.
+        """
+        alive = [job for job in self.stopping.get(uri, [])
+                 if job.is_alive()]
+        if alive:
+            raise JobsStillRunning('{} still running for {}'.format(
+                ', '.join(job.name for job in alive), uri))
+        self.stopping.pop(uri, None)
+
+    def unregister(self, uri):
+        """
+        Stop the jobs of an SR, return False if it was not registered.
+
+        Raises JobsStillRunning if some jobs are alive after STOP_TIMEOUT,
+        unregistering it again waits for them again.
+        """
+        with self.lock:
+            sr_type, jobs = self.srs.pop(uri, (None, None))
+            if jobs is None:
+                jobs = self.stopping.get(uri)
+                if jobs is None:
+                    return False
+            else:
+                self.stopping[uri] = jobs
+                self.__save()
+        for job in jobs:
+            job.stop()
+        deadline = time.time() + STOP_TIMEOUT
+        for job in jobs:
+            if job.join(max(deadline - time.time(), 0)):
+                log.debug('{} stopped for uri={}'.format(job.name, uri))
+            else:
+                log.error('Timeout reached for task: {} of {}'.format(
+                    job.name, uri))
+        with self.lock:
+            if self.stopping.get(uri) is jobs:
+                self.__check_stopped(uri)
+        return True
+
+    def status(self):
+        with self.lock:
+            return [job.status()
+                    for _, jobs in self.srs.values() for job in jobs] + [
+                        job.status()
+                        for jobs in self.stopping.values() for job in jobs
+                        if job.is_alive()]
+
+    def handle(self, request):
+        command = request.get('command')
+        if command == 'register':
+            return self.register(request['sr_type'], request['uri'])
+        if command == 'unregister':
+            return self.unregister(request['uri'])
+        if command == 'status':
+            return self.status()
+        raise SupervisorError('Unknown command: {}'.format(command))
+
+    def __serve_client(self, conn):
+        try:
+            request = json.loads(_read_line(conn))
+            try:
+                response = {'result': self.handle(request)}
+            except Exception as exc:
+                log.error('Supervisor: {} failed: {}'.format(
+                    request, traceback.format_exc()))
+                response = {'error': str(exc)}
+                if isinstance(exc, JobsStillRunning):
+                    response['still_running'] = True
+            conn.sendall(json.dumps(response) + '\n')
+        except Exception as exc:
+            log.error('Supervisor: bad request: {}'.format(exc))
+        finally:
+            conn.close()
+
+    def serve(self, server):
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.error as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                raise
+            thread = threading.Thread(target=self.__serve_client,
+                                      args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+
+def _terminate(signum, frame):
+    # Exit through the atexit handlers, which resume the commands paced
+    # by an IOThrottle
+    sys.exit(0)
+
+
+def run():
+    """
+    Supervisor main loop, returns at once if a supervisor is running
+    """
+    util.daemonize()
+    signal.signal(signal.SIGTERM, _terminate)
+    util.mkdir_p(_run_dir())
+
+    lock_file = open(_lock_path(), 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as exc:
+        if exc.errno in (errno.EAGAIN, errno.EACCES):
+            log.debug('Supervisor already running')
+            return
+        raise
+
+    path = socket_path()
+    try:
+        os.unlink(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(16)
+
+    supervisor = Supervisor()
+    supervisor.load()
+    supervisor.serve(server)
+
+
+def request(command, **args):
+    """
+    Send a command to the supervisor of this host and return its result
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path())
+        client.sendall(json.dumps(dict(args, command=command)) + '\n')
+        response = json.loads(_read_line(client))
+    finally:
+        client.close()
+    if 'error' in response:
+        if response.get('still_running'):
+            raise JobsStillRunning(response['error'])
+        raise SupervisorError(response['error'])
+    return response['result']
+
+
+def _start():
+    # systemd restarts the supervisor of the service if it dies, it then
+    # registers the SRs of its state again
+    try:
+        if subprocess.call(['systemctl', 'start', '--no-block', SERVICE],
+                           close_fds=True) == 0:
+            return
+    except OSError as exc:
+        log.debug('Cannot start {}: {}'.format(SERVICE, exc))
+    path = os.path.abspath(re.sub("pyc$", "py", __file__))
+    subprocess.Popen([path], close_fds=True)
+
+
+def _request_started(command, **args):
+    """
+    request(), starting the supervisor if it is not running
+    """
+    deadline = time.time() + START_TIMEOUT
+    started = False
+    while True:
+        try:
+            return request(command, **args)
+        except socket.error as exc:
+            if exc.errno not in (errno.ENOENT, errno.ECONNREFUSED) or \
+                    time.time() >= deadline:
+                raise
+        if not started:
+            _start()
+            started = True
+        time.sleep(0.1)
+
+
+def register(dbg, sr_type, uri):
+    log.debug('{}: Registering sr_type={} uri={} with the supervisor'.format(
+        dbg, sr_type, uri))
+    _request_started('register', sr_type=sr_type, uri=uri)
+
+
+def unregister(dbg, sr_type, uri):
+    log.debug('{}: Unregistering sr_type={} uri={} from the supervisor'.format(
+        dbg, sr_type, uri))
+    _request_started('unregister', uri=uri)
+
+
+def status():
+    return request('status')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['status']:
+        print(json.dumps(status(), indent=2))
+    else:
+        run()
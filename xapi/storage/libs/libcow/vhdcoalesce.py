@@ -0,0 +1,233 @@
+"""
+Resumable coalesce of a VHD image into its parent.
+
+'vhd-util coalesce' starts from scratch when it is interrupted. This
+engine copies the node block by block and reports the next block to copy
+once the parent has been synced, so a killed GC resumes where it stopped.
+Copying a block again is harmless: until the children of the node are
+reparented, every sector copied is still masked by the node itself.
+"""
+
+from __future__ import absolute_import, division
+import os
+import struct
+import time
+
+from xapi.storage import log
+from xapi.storage.libs import util
+from xapi.storage.libs.libcow.vhdutil import (
+    VHD_BAT_UNUSED, VHD_DISK_TYPE_FIXED, VHD_FOOTER_SIZE,
+    _read_bat, _read_dynamic_header, _read_footer)
+
+SECTOR_SIZE = 512
+
+# Report progress after copying that many bytes
+CHECKPOINT_BYTES = 256 * 2**20
+
+_BAT_ENTRY = struct.Struct('>I')
+
+
+def _sector_runs(bitmap, nr_sectors):
+    """
+    Yield the (first, count) runs of sectors set in a VHD sector bitmap
+    """
+    start = None
+    for index in range((nr_sectors + 7) // 8):
+        byte = bitmap[index]
+        if byte == 0 and start is None:
+            continue
+        if byte == 0xff and start is not None:
+            continue
+        for bit in range(8):
+            sector = (index << 3) + bit
+            if sector >= nr_sectors:
+                break
+            if byte & (0x80 >> bit):
+                if start is None:
+                    start = sector
+            elif start is not None:
+                yield start, sector - start
+                start = None
+    if start is not None:
+        yield start, nr_sectors - start
+
+
+class VHDImage(object):
+    """
+    Block level access to a fixed, dynamic or differencing VHD
+    """
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.file = open(path, 'r+b' if writable else 'rb')
+        try:
+            self.disk_type, data_offset, self.vsize = _read_footer(self.file)
+            if self.disk_type == VHD_DISK_TYPE_FIXED:
+                self.block_size = None
+                self.bat = None
+                return
+            self.table_offset, max_table_entries, self.block_size, _ = \
+                _read_dynamic_header(self.file, data_offset)
+            self.bat = _read_bat(
+                self.file, self.table_offset, max_table_entries)
+            self.sectors_per_block = self.block_size // SECTOR_SIZE
+            self.bitmap_size = (
+                (self.sectors_per_block // 8 + SECTOR_SIZE - 1) //
+                SECTOR_SIZE * SECTOR_SIZE)
+        except Exception:
+            self.file.close()
+            raise
+
+    @property
+    def fixed(self):
+        return self.disk_type == VHD_DISK_TYPE_FIXED
+
+    @property
+    def nr_blocks(self):
+        return len(self.bat)
+
+    def __block_offset(self, block):
+        return self.bat[block] * SECTOR_SIZE
+
+    def read_block(self, block):
+        """
+        Return the (sector bitmap, data) of an allocated block, None if
+        the block is not allocated
+        """
+        if self.bat[block] == VHD_BAT_UNUSED:
+            return None
+        self.file.seek(self.__block_offset(block))
+        bitmap = bytearray(self.file.read(self.bitmap_size))
+        data = self.file.read(self.block_size)
+        return bitmap, data
+
+    def __allocate_block(self, block):
+        """
+        Append an empty block in place of the trailing footer.
+
+        The footer is moved and synced before the BAT points at the new
+        block, and the BAT is synced before the block is written, so an
+        interruption leaves a valid image.
+        """
+        self.file.seek(-VHD_FOOTER_SIZE, os.SEEK_END)
+        offset = self.file.tell()
+        footer = self.file.read(VHD_FOOTER_SIZE)
+        self.file.seek(offset)
+        self.file.write(b'\0' * self.bitmap_size)
+        # The data area is left as a hole, it reads as zeroes
+        self.file.seek(offset + self.bitmap_size + self.block_size)
+        self.file.write(footer)
+        self.sync()
+
+        self.file.seek(self.table_offset + block * _BAT_ENTRY.size)
+        self.file.write(_BAT_ENTRY.pack(offset // SECTOR_SIZE))
+        self.sync()
+        self.bat[block] = offset // SECTOR_SIZE
+
+    def write_sectors(self, block, block_size, bitmap, data):
+        """
+        Write the sectors of 'data' set in 'bitmap' at 'block' (of
+        'block_size' bytes), return the number of write requests issued
+        """
+        nr_sectors = block_size // SECTOR_SIZE
+        if self.fixed:
+            # Never write over the footer
+            nr_sectors = min(
+                nr_sectors,
+                max(self.vsize - block * block_size, 0) // SECTOR_SIZE)
+        runs = list(_sector_runs(bitmap, nr_sectors))
+        if not runs:
+            return 0
+
+        if self.fixed:
+            base = block * block_size
+        else:
+            if self.bat[block] == VHD_BAT_UNUSED:
+                self.__allocate_block(block)
+            base = self.__block_offset(block) + self.bitmap_size
+
+        for first, count in runs:
+            self.file.seek(base + first * SECTOR_SIZE)
+            self.file.write(data[first * SECTOR_SIZE:
+                                 (first + count) * SECTOR_SIZE])
+        if self.fixed:
+            return len(runs)
+
+        self.file.seek(self.__block_offset(block))
+        parent_bitmap = bytearray(self.file.read(self.bitmap_size))
+        for index in range(len(bitmap)):
+            parent_bitmap[index] |= bitmap[index]
+        self.file.seek(self.__block_offset(block))
+        self.file.write(parent_bitmap)
+        return len(runs) + 1
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def coalesce(dbg, node_path, parent_path, checkpoint=None, start_block=0,
+             throttle=None):
+    """
+    Copy the sectors of the node into its parent, starting at
+    'start_block'.
+
+    'checkpoint' is called with the next block to copy every time the
+    parent has been synced. Raises NotImplementedError when the images
+    cannot be coalesced by this engine, see 'vhd-util coalesce' then, and
+    util.Interrupted when the task running it is interrupted.
+    """
+    node = VHDImage(node_path)
+    try:
+        parent = VHDImage(parent_path, writable=True)
+        try:
+            if node.fixed:
+                raise NotImplementedError(
+                    '{} is not a dynamic VHD'.format(node_path))
+            if not parent.fixed and (
+                    parent.block_size != node.block_size or
+                    parent.nr_blocks < node.nr_blocks):
+                raise NotImplementedError(
+                    '{} and {} have incompatible geometries'.format(
+                        node_path, parent_path))
+            if parent.fixed and parent.vsize < node.vsize:
+                raise NotImplementedError(
+                    '{} is smaller than {}'.format(parent_path, node_path))
+
+            log.debug('{}: coalescing {} into {} from block {}'.format(
+                dbg, node_path, parent_path, start_block))
+            __copy_blocks(node, parent, checkpoint, start_block, throttle)
+        finally:
+            parent.close()
+    finally:
+        node.close()
+
+
+def __copy_blocks(node, parent, checkpoint, start_block, throttle):
+    unsynced = 0
+    for block in range(start_block, node.nr_blocks):
+        util.check_interrupted()
+        content = node.read_block(block)
+        if content is None:
+            continue
+        bitmap, data = content
+        requests = parent.write_sectors(block, node.block_size, bitmap, data)
+        if not requests:
+            continue
+        unsynced += len(data)
+        if throttle is not None:
+            delay = throttle.consume(
+                len(bitmap) + 2 * len(data), requests + 2)
+            if delay > 0:
+                time.sleep(delay)
+        if unsynced >= CHECKPOINT_BYTES:
+            parent.sync()
+            unsynced = 0
+            if checkpoint is not None:
+                checkpoint(block + 1)
+    parent.sync()
+    if checkpoint is not None:
+        checkpoint(node.nr_blocks)
@@ -1,6 +1,13 @@
-from xapi.storage.libs import image, tapdisk
+import array
+import os
+import struct
+import sys
+import uuid
+
+from xapi.storage.libs import image, tapdisk, util
+from xapi.storage.libs.libcow.allocationmap import AllocationMap
 from xapi.storage.libs.libcow.cowutil import COWUtil
-from xapi.storage.libs.util import call
+from xapi.storage.libs.util import call, cached_call, invalidate_cached_calls
 from xapi.storage import log
 
 MEBIBYTE = 2**20
@@ -10,6 +17,65 @@ MAX_CHAIN_HEIGHT = 30
 
 VHD_UTIL_BIN = '/usr/bin/vhd-util'
 
+VHD_FOOTER_SIZE = 512
+VHD_HEADER_SIZE = 1024
+VHD_DISK_TYPE_FIXED = 2
+VHD_DISK_TYPE_DIFF = 4
+VHD_BAT_UNUSED = 0xFFFFFFFF
+
+
+def _read_footer(vhd_file):
+    """
+    Return (disk_type, data_offset, current_size) from the VHD footer
+    """
+    vhd_file.seek(0)
+    footer = vhd_file.read(VHD_FOOTER_SIZE)
+    if len(footer) < VHD_FOOTER_SIZE or footer[:8] != b'conectix':
+        # Fixed disks only have a footer at the end of the file
+        vhd_file.seek(-VHD_FOOTER_SIZE, os.SEEK_END)
+        footer = vhd_file.read(VHD_FOOTER_SIZE)
+        if footer[:8] != b'conectix':
+            raise ValueError('{} is not a VHD file'.format(vhd_file.name))
+    data_offset, = struct.unpack_from('>Q', footer, 16)
+    current_size, = struct.unpack_from('>Q', footer, 48)
+    disk_type, = struct.unpack_from('>I', footer, 60)
+    return disk_type, data_offset, current_size
+
+
+def _read_dynamic_header(vhd_file, data_offset):
+    """
+    Return (table_offset, max_table_entries, block_size, parent_name) from
+    the VHD dynamic disk header
+    """
+    vhd_file.seek(data_offset)
+    header = vhd_file.read(VHD_HEADER_SIZE)
+    if header[:8] != b'cxsparse':
+        raise ValueError(
+            '{}: invalid VHD dynamic header'.format(vhd_file.name))
+    table_offset, = struct.unpack_from('>Q', header, 16)
+    max_table_entries, block_size = struct.unpack_from('>II', header, 28)
+    parent_name = header[64:576].decode('utf-16-be').rstrip(u'\x00')
+    return table_offset, max_table_entries, block_size, parent_name
+
+
+def _footer_checksum(footer):
+    """
+    One's complement of the sum of the footer bytes, checksum excluded
+    """
+    return ~(sum(footer[:64]) + sum(footer[68:])) & 0xFFFFFFFF
+
+
+def _read_bat(vhd_file, table_offset, max_table_entries):
+    """
+    Read the Block Allocation Table, entries are sector offsets
+    """
+    vhd_file.seek(table_offset)
+    bat = array.array('I')
+    bat.fromstring(vhd_file.read(max_table_entries * bat.itemsize))
+    if sys.byteorder == 'little':
+        bat.byteswap()
+    return bat
+
 
 class VHDUtil(COWUtil):
 
@@ -18,25 +84,30 @@ class VHDUtil(COWUtil):
         return MAX_CHAIN_HEIGHT
 
     @staticmethod
-    def __num_bits(val):
-        count = 0
-        while val:
-            count += val & 1
-            val = val >> 1
-        return count
+    def is_empty(dbg, vol_path):
+        return VHDUtil.get_allocation_map(dbg, vol_path).is_empty()
 
     @staticmethod
-    def __count_bits(bitmap):
-        count = 0
-        for i in range(len(bitmap)):
-            count += VHDUtil.__num_bits(ord(bitmap[i]))
-        return count
+    def get_allocation_map(dbg, vol_path):
+        """Build the allocation map from the Block Allocation Table.
 
-    @staticmethod
-    def is_empty(dbg, vol_path):
-        cmd = [VHD_UTIL_BIN, 'read', OPT_LOG_ERR, '-B', '-n', vol_path]
-        ret = call(dbg, cmd)
-        return VHDUtil.__count_bits(ret) == 0
+        The BAT is read directly from the image: one 4 byte entry per
+        block, so multi-TiB images only cost a few MiB of I/O.
+        """
+        with open(vol_path, 'rb') as vhd_file:
+            disk_type, data_offset, vsize = _read_footer(vhd_file)
+            if disk_type == VHD_DISK_TYPE_FIXED:
+                return AllocationMap.fully_allocated(2 * MEBIBYTE, vsize)
+
+            table_offset, max_table_entries, block_size, _ = \
+                _read_dynamic_header(vhd_file, data_offset)
+            bat = _read_bat(vhd_file, table_offset, max_table_entries)
+
+        allocation_map = AllocationMap(block_size, vsize)
+        for block in range(min(len(bat), allocation_map.nr_blocks)):
+            if bat[block] != VHD_BAT_UNUSED:
+                allocation_map.set_block(block)
+        return allocation_map
 
     @staticmethod
     def create(dbg, vol_path, size_mib):
@@ -46,12 +117,14 @@ class VHDUtil(COWUtil):
             '-s', str(size_mib),
             '-S', str(MSIZE_MIB)
         ]
+        invalidate_cached_calls((vol_path,))
         return call(dbg, cmd)
 
     @staticmethod
     def resize(dbg, vol_path, size_mib):
         cmd = [VHD_UTIL_BIN, 'resize', '-n', vol_path,
                '-s', str(size_mib), '-f']
+        invalidate_cached_calls((vol_path,))
         return call(dbg, cmd)
 
     @staticmethod
@@ -81,8 +154,41 @@ class VHDUtil(COWUtil):
         if force_parent_link:
             cmd.append('-e')
 
+        invalidate_cached_calls((new_cow_path,))
         return call(dbg, cmd)
 
+    @staticmethod
+    def copy_child(dbg, child_path, new_path):
+        """Copy an empty differencing VHD with a new unique id.
+
+        Only the footer, kept at both ends of the file, identifies the
+        image: the header and the parent locators are copied as is.
+        """
+        with open(child_path, 'rb') as vhd_file:
+            disk_type, data_offset, _ = _read_footer(vhd_file)
+            if disk_type != VHD_DISK_TYPE_DIFF:
+                raise ValueError(
+                    '{} is not a differencing VHD'.format(child_path))
+            table_offset, max_table_entries, _, _ = \
+                _read_dynamic_header(vhd_file, data_offset)
+            bat = _read_bat(vhd_file, table_offset, max_table_entries)
+            if bat.count(VHD_BAT_UNUSED) != len(bat):
+                raise ValueError('{} holds data'.format(child_path))
+            vhd_file.seek(0)
+            data = bytearray(vhd_file.read())
+
+        footer = data[-VHD_FOOTER_SIZE:]
+        footer[68:84] = uuid.uuid4().bytes
+        struct.pack_into('>I', footer, 64, _footer_checksum(footer))
+        data[:VHD_FOOTER_SIZE] = footer
+        data[-VHD_FOOTER_SIZE:] = footer
+
+        invalidate_cached_calls((new_path,))
+        with open(new_path, 'wb') as vhd_file:
+            vhd_file.write(data)
+            vhd_file.flush()
+            os.fsync(vhd_file.fileno())
+
     @staticmethod
     def online_snapshot(dbg, new_cow_path, parent_cow_path, force_parent_link):
         return VHDUtil.snapshot(
@@ -95,25 +201,58 @@ class VHDUtil(COWUtil):
             dbg, new_cow_path, parent_cow_path, force_parent_link)
 
     @staticmethod
-    def coalesce(dbg, vol_path, parent_path):
+    def coalesce(dbg, vol_path, parent_path, throttle=None):
         cmd = [VHD_UTIL_BIN, 'coalesce', '-n', vol_path]
-        return call(dbg, cmd)
+        return call(dbg, cmd, throttle=throttle)
+
+    @staticmethod
+    def coalesce_resumable(dbg, vol_path, parent_path, checkpoint=None,
+                           start_block=0, throttle=None):
+        # Imported here, vhdcoalesce depends on this module
+        from xapi.storage.libs.libcow import vhdcoalesce
+        invalidate_cached_calls((parent_path,))
+        return vhdcoalesce.coalesce(
+            dbg, vol_path, parent_path, checkpoint, start_block, throttle)
 
     @staticmethod
     def get_parent(dbg, vol_path):
         cmd = [VHD_UTIL_BIN, 'query', '-n', vol_path, '-p']
-        return call(dbg, cmd).rstrip()
+        return cached_call(dbg, cmd, tags=(vol_path,)).rstrip()
 
     @staticmethod
     def get_vsize(dbg, vol_path):
         # vsize is returned in MB but we want to return bytes
         cmd = [VHD_UTIL_BIN, 'query', '-n', vol_path, '-v']
-        out = call(dbg, cmd).rstrip()
+        out = cached_call(dbg, cmd, tags=(vol_path,)).rstrip()
         return int(out) * MEBIBYTE
 
+    @staticmethod
+    def scan(dbg, paths):
+        """Read parent, vsize and psize of many VHDs without forking.
+
+        Volumes of a chain live in the same directory and the parent
+        name recorded in the header is the parent file name.
+        """
+        results = {}
+        for vol_path in paths:
+            with open(vol_path, 'rb') as vhd_file:
+                disk_type, data_offset, vsize = _read_footer(vhd_file)
+                parent = None
+                if disk_type == VHD_DISK_TYPE_DIFF:
+                    parent_name = _read_dynamic_header(
+                        vhd_file, data_offset)[3]
+                    parent = os.path.join(
+                        os.path.dirname(vol_path),
+                        os.path.basename(parent_name.encode('utf-8')))
+            results[vol_path] = (
+                parent, vsize, util.get_physical_file_size(vol_path))
+        log.debug("{}: scanned {} VHD(s)".format(dbg, len(results)))
+        return results
+
     @staticmethod
     def set_parent(dbg, vol_path, parent_path):
         cmd = [VHD_UTIL_BIN, 'modify', '-n', vol_path, '-p', parent_path]
+        invalidate_cached_calls((vol_path,))
         return call(dbg, cmd)
 
     @staticmethod
@@ -140,6 +279,11 @@ class VHDUtil(COWUtil):
         tap.pause(dbg)
         tap.unpause(dbg)
 
+    @staticmethod
+    def refresh_reloads_chain():
+        # tapdisk reopens the whole chain on unpause
+        return True
+
     @staticmethod
     def pause_datapath(dbg, meta_path):
         tap = tapdisk.find_by_file(dbg, meta_path)
@@ -8,6 +8,7 @@ import xapi.storage.api.v5.volume
 from .callbacks import VolumeContext
 from .imageformat import ImageFormat
 from .lock import Lock, PollLock
+from . import psizecache, statcache, volumepool
 
 MEBIBYTE = 2**20
 
@@ -29,6 +30,29 @@ def _vdi_sanitize(vdi, opq, db, cb):
         db.update_volume_vsize(vdi.volume.id, vdi.volume.vsize)
 
 
+def _vdis_sanitize(vdis, opq, db, cb):
+    """Sanitize a list of vdi metadata objects
+
+    Same as '_vdi_sanitize' but the volumes missing a 'vsize' are
+    queried with a single scan per image format.
+    """
+    unsized = {}
+    for vdi in vdis:
+        if vdi.volume.vsize is None:
+            unsized.setdefault(vdi.image_type, []).append(vdi)
+
+    for image_type, unsized_vdis in unsized.items():
+        image_utils = ImageFormat.get_format(image_type).image_utils
+        paths = dict(
+            (cb.volumeGetPath(opq, str(vdi.volume.id)), vdi)
+            for vdi in unsized_vdis
+        )
+        for path, (_, vsize, _) in image_utils.scan("", paths.keys()).items():
+            vdi = paths[path]
+            vdi.volume.vsize = vsize
+            db.update_volume_vsize(vdi.volume.id, vsize)
+
+
 def _set_property(dbg, sr, key, field, value, cb):
     with VolumeContext(cb, sr, 'w') as opq:
         with cb.db_context(opq) as db:
@@ -48,6 +72,7 @@ def _get_size_mib_and_vsize(size):
 
 class COWVolume(object):
     @staticmethod
+    @statcache.invalidates
     def create(dbg, sr, name, description, size, sharable, cb):
         size_mib, vsize = _get_size_mib_and_vsize(size)
 
@@ -60,12 +85,16 @@ class COWVolume(object):
 
             with PollLock(opq, 'gl', cb, 0.5):
                 with cb.db_context(opq) as db:
-                    volume = db.insert_new_volume(vsize, image_type)
+                    volume = volumepool.claim(
+                        dbg, opq, db, cb, vsize, image_type)
+                    if volume is None:
+                        volume = db.insert_new_volume(vsize, image_type)
+                        volume_path = cb.volumeCreate(
+                            opq, str(volume.id), vsize)
+                        image_format.image_utils.create(
+                            dbg, volume_path, size_mib)
                     db.insert_vdi(name, description, vdi_uuid,
                                   volume.id, sharable)
-                    volume_path = cb.volumeCreate(opq, str(volume.id), vsize)
-                    image_format.image_utils.create(
-                        dbg, volume_path, size_mib)
 
             psize = cb.volumeGetPhysSize(opq, str(volume.id))
             vdi_uri = cb.getVolumeUriPrefix(opq) + vdi_uuid
@@ -84,6 +113,7 @@ class COWVolume(object):
         }
 
     @staticmethod
+    @statcache.invalidates
     def destroy(dbg, sr, key, cb):
         with VolumeContext(cb, sr, 'w') as opq:
             with Lock(opq, 'gl', cb):
@@ -95,6 +125,7 @@ class COWVolume(object):
                     db.delete_volume(vdi.volume.id)
 
     @staticmethod
+    @statcache.invalidates
     def resize(dbg, sr, key, new_size, cb):
         size_mib, vsize = _get_size_mib_and_vsize(new_size)
 
@@ -152,6 +183,23 @@ class COWVolume(object):
                     vdi.active_on)
 
     @staticmethod
+    def _new_child(dbg, opq, db, cb, vdi, parent_id):
+        """
+        Add a volume for a child of 'parent_id' of the size of 'vdi',
+        taken from the pool of spare volumes if possible. Return the
+        volume and its path, the caller writes its image.
+        """
+        volume = volumepool.claim(
+            dbg, opq, db, cb, vdi.volume.vsize, vdi.volume.image_type,
+            parent_id)
+        if volume is not None:
+            return volume, cb.volumeGetPath(opq, str(volume.id))
+        volume = db.insert_child_volume(parent_id, vdi.volume.vsize)
+        return volume, cb.volumeCreate(
+            opq, str(volume.id), vdi.volume.vsize)
+
+    @staticmethod
+    @statcache.invalidates
     def _clone(dbg, sr, key, cb, is_snapshot):
         snap_uuid = str(uuid.uuid4())
         need_extra_snap = False
@@ -176,10 +224,8 @@ class COWVolume(object):
                             'SR_BACKEND_FAILURE_82',
                             ['Cannot clone or snapshot block device', ''])
 
-                    snap_volume = db.insert_child_volume(vol_id,
-                                                         vdi.volume.vsize)
-                    snap_path = cb.volumeCreate(opq, str(snap_volume.id),
-                                                vdi.volume.vsize)
+                    snap_volume, snap_path = COWVolume._new_child(
+                        dbg, opq, db, cb, vdi, vol_id)
                     if vdi.active_on:
                         image_utils.online_snapshot(
                             dbg, snap_path, vol_path, False)
@@ -221,11 +267,10 @@ class COWVolume(object):
                         db.update_volume_psize(vdi.volume.id,
                                                cb.volumeGetPhysSize(
                                                    opq, str(vdi.volume.id)))
-                        snap_2_volume = db.insert_child_volume(
-                            vdi.volume.id, vdi.volume.vsize, is_snapshot)
-                        snap_2_path = cb.volumeCreate(opq,
-                                                      str(snap_2_volume.id),
-                                                      vdi.volume.vsize)
+                        snap_2_volume, snap_2_path = COWVolume._new_child(
+                            dbg, opq, db, cb, vdi, vdi.volume.id)
+                        if is_snapshot:
+                            db.set_volume_as_snapshot(snap_2_volume.id)
                         if vdi.active_on:
                             image_utils.online_snapshot(
                                 dbg, snap_2_path, vol_path, False)
@@ -240,6 +285,12 @@ class COWVolume(object):
 
             snap_uri = cb.getVolumeUriPrefix(opq) + snap_uuid
 
+        return COWVolume._clone_info(
+            vdi, snap_uuid, image_format.uri_prefix + snap_uri, psize,
+            is_snapshot)
+
+    @staticmethod
+    def _clone_info(vdi, snap_uuid, snap_uri, psize, is_snapshot):
         return {
             'uuid': snap_uuid,
             'key': snap_uuid,
@@ -248,7 +299,7 @@ class COWVolume(object):
             'read_write': not is_snapshot,
             'virtual_size': vdi.volume.vsize,
             'physical_utilisation': psize,
-            'uri': [image_format.uri_prefix + snap_uri],
+            'uri': [snap_uri],
             'keys': {},
             'sharable': False
         }
@@ -261,6 +312,280 @@ class COWVolume(object):
     def snapshot(dbg, sr, key, cb):
         return COWVolume._clone(dbg, sr, key, cb, True)
 
+    @staticmethod
+    def _create_child(dbg, opq, db, cb, vdi, parent_id, image_utils,
+                      created, is_snapshot=False):
+        volume = db.insert_child_volume(
+            parent_id, vdi.volume.vsize, is_snapshot)
+        path = cb.volumeCreate(opq, str(volume.id), vdi.volume.vsize)
+        created.append(volume.id)
+        parent_path = cb.volumeGetPath(opq, str(parent_id))
+        if vdi.active_on:
+            image_utils.online_snapshot(dbg, path, parent_path, False)
+        else:
+            image_utils.offline_snapshot(dbg, path, parent_path, False)
+        return volume, path
+
+    @staticmethod
+    def _snapshot_paused(dbg, opq, db, cb, vdi, image_utils, created):
+        """
+        Snapshot a VDI whose datapath, if any, is paused unless the VDI
+        is a snapshot. Return the snapshot volume and the path of the new
+        leaf of the VDI, None if the VDI keeps its leaf.
+        """
+        if vdi.volume.snap:
+            # The parent of a snapshot holds all its data
+            snap_volume, _ = COWVolume._create_child(
+                dbg, opq, db, cb, vdi, vdi.volume.parent_id, image_utils,
+                created)
+            db.set_volume_as_snapshot(snap_volume.id)
+            return snap_volume, None
+
+        vol_path = cb.volumeGetPath(opq, str(vdi.volume.id))
+        leaf_volume, leaf_path = COWVolume._create_child(
+            dbg, opq, db, cb, vdi, vdi.volume.id, image_utils, created)
+        if not vdi.active_on and not image_utils.is_parent_pointing_to_path(
+                dbg, leaf_path, vol_path):
+            # The VDI is empty, the new volume was linked to its parent:
+            # it is the snapshot and the VDI keeps its leaf, see _clone()
+            db.update_volume_parent(leaf_volume.id, vdi.volume.parent_id)
+            db.set_volume_as_snapshot(leaf_volume.id)
+            return leaf_volume, None
+
+        # The current leaf becomes the read-only parent of the new leaf
+        # of the VDI and of the snapshot
+        db.update_vdi_volume_id(vdi.uuid, leaf_volume.id)
+        db.update_volume_psize(
+            vdi.volume.id, cb.volumeGetPhysSize(opq, str(vdi.volume.id)))
+        snap_volume, _ = COWVolume._create_child(
+            dbg, opq, db, cb, vdi, vdi.volume.id, image_utils, created,
+            is_snapshot=True)
+        return snap_volume, leaf_path
+
+    @staticmethod
+    @statcache.invalidates
+    def snapshot_batch(dbg, sr, keys, cb):
+        """
+        Snapshot several VDIs at the same point in time, e.g. the disks of
+        a VM.
+
+        The global SR lock is taken once and the datapaths of all the
+        active VDIs are paused together while the snapshots are created.
+        The metabase is updated in a single transaction, committed before
+        the datapaths resume on their new leaves: on failure nothing is
+        changed. Return the snapshots in the order of 'keys'.
+        """
+        if len(set(keys)) != len(keys):
+            raise ValueError('Duplicate VDIs in batch snapshot: {}'.format(
+                keys))
+
+        with VolumeContext(cb, sr, 'w') as opq:
+            with PollLock(opq, 'gl', cb, 0.5):
+                created = []
+                paused = []
+                snapshots = []
+                leaves = []
+                try:
+                    with cb.db_context(opq) as db:
+                        vdis = dict(
+                            (vdi.uuid, vdi) for vdi in db.get_vdis_by_ids(keys))
+                        for key in keys:
+                            vdi = vdis.get(key)
+                            if vdi is None:
+                                raise xapi.storage.api.v5.volume \
+                                    .Volume_does_not_exist(key)
+                            image_utils = ImageFormat.get_format(
+                                vdi.image_type).image_utils
+                            COWVolume._check_clone(
+                                vdi, db, cb, image_utils, True)
+                            vol_path = cb.volumeGetPath(opq, str(
+                                vdi.volume.id if vdi.volume.snap == 0
+                                else vdi.volume.parent_id))
+                            if util.is_block_device(vol_path):
+                                raise util.create_storage_error(
+                                    'SR_BACKEND_FAILURE_82',
+                                    ['Cannot clone or snapshot block device',
+                                     ''])
+
+                        for key in keys:
+                            vdi = vdis[key]
+                            # A snapshot VDI keeps its leaf, its datapath
+                            # is left running
+                            if vdi.active_on and not vdi.volume.snap:
+                                ImageFormat.get_format(
+                                    vdi.image_type).image_utils.pause_datapath(
+                                        dbg,
+                                        cb.get_data_metadata_path(opq, key))
+                                paused.append(vdi)
+
+                        for key in keys:
+                            vdi = vdis[key]
+                            snap_uuid = str(uuid.uuid4())
+                            snap_volume, leaf_path = \
+                                COWVolume._snapshot_paused(
+                                    dbg, opq, db, cb, vdi,
+                                    ImageFormat.get_format(
+                                        vdi.image_type).image_utils,
+                                    created)
+                            db.insert_vdi(vdi.name, vdi.description,
+                                          snap_uuid, snap_volume.id,
+                                          vdi.sharable)
+                            snapshots.append((vdi, snap_uuid, snap_volume))
+                            leaves.append(leaf_path)
+                except Exception:
+                    # The transaction was rolled back
+                    for vdi in paused:
+                        COWVolume._unpause(dbg, opq, cb, vdi, cb.volumeGetPath(
+                            opq, str(vdi.volume.id)))
+                    COWVolume._destroy_created(dbg, opq, cb, created)
+                    raise
+
+                errors = []
+                for vdi in paused:
+                    leaf_path = leaves[keys.index(vdi.uuid)]
+                    if not COWVolume._unpause(dbg, opq, cb, vdi, leaf_path):
+                        errors.append(vdi.uuid)
+                if errors:
+                    raise util.create_storage_error(
+                        'SR_BACKEND_FAILURE_46',
+                        ['Cannot resume the datapath of the VDIs',
+                         ', '.join(errors)])
+
+            uri_prefix = cb.getVolumeUriPrefix(opq)
+            return [
+                COWVolume._clone_info(
+                    base_vdi, new_uuid,
+                    ImageFormat.get_format(base_vdi.image_type).uri_prefix +
+                    uri_prefix + new_uuid,
+                    cb.volumeGetPhysSize(opq, str(new_volume.id)), True)
+                for base_vdi, new_uuid, new_volume in snapshots
+            ]
+
+    @staticmethod
+    def _destroy_created(dbg, opq, cb, created):
+        """
+        Destroy the volumes of a rolled back transaction
+        """
+        for volume_id in created:
+            try:
+                cb.volumeDestroy(opq, str(volume_id))
+            except Exception as exc:
+                log.error('{}: cannot destroy volume {}: {}'.format(
+                    dbg, volume_id, exc))
+
+    @staticmethod
+    def _copy_child(dbg, opq, db, cb, vdi, parent_id, image_utils, created,
+                    template_path):
+        """
+        Like _create_child(), copying the empty child 'template_path' of
+        the same parent when the image format allows it
+        """
+        volume = db.insert_child_volume(parent_id, vdi.volume.vsize)
+        path = cb.volumeCreate(opq, str(volume.id), vdi.volume.vsize)
+        created.append(volume.id)
+        try:
+            image_utils.copy_child(dbg, template_path, path)
+        except NotImplementedError:
+            image_utils.offline_snapshot(
+                dbg, path, cb.volumeGetPath(opq, str(parent_id)), False)
+        return volume
+
+    @staticmethod
+    @statcache.invalidates
+    def clone_many(dbg, sr, key, count, cb):
+        """
+        Create 'count' clones of a VDI, e.g. to provision VMs from a
+        template, in one locked section and one metabase transaction.
+
+        The VDI is checked and snapshotted once, the other clones are
+        copies of the first one made in process (see COWUtil.copy_child).
+        Return the clones.
+        """
+        if count < 1:
+            raise ValueError('Invalid number of clones: {}'.format(count))
+
+        with VolumeContext(cb, sr, 'w') as opq:
+            with PollLock(opq, 'gl', cb, 0.5):
+                created = []
+                clones = []
+                try:
+                    with cb.db_context(opq) as db:
+                        vdi = db.get_vdi_by_id(key)
+                        if vdi is None:
+                            raise xapi.storage.api.v5.volume \
+                                .Volume_does_not_exist(key)
+                        image_format = ImageFormat.get_format(vdi.image_type)
+                        image_utils = image_format.image_utils
+                        COWVolume._check_clone(
+                            vdi, db, cb, image_utils, False)
+
+                        base_id = (vdi.volume.id if vdi.volume.snap == 0
+                                   else vdi.volume.parent_id)
+                        base_path = cb.volumeGetPath(opq, str(base_id))
+                        if util.is_block_device(base_path):
+                            raise util.create_storage_error(
+                                'SR_BACKEND_FAILURE_82',
+                                ['Cannot clone or snapshot block device', ''])
+
+                        first, first_path = COWVolume._create_child(
+                            dbg, opq, db, cb, vdi, base_id, image_utils,
+                            created)
+                        if not image_utils.is_parent_pointing_to_path(
+                                dbg, first_path, base_path):
+                            # The base is empty, the clones are linked to
+                            # its parent, see _clone()
+                            base_id = db.get_volume_by_id(base_id).parent_id
+                            db.update_volume_parent(first.id, base_id)
+                        elif not vdi.volume.snap:
+                            # The leaf of the VDI becomes the read-only
+                            # parent of the clones and of its new leaf
+                            leaf = COWVolume._copy_child(
+                                dbg, opq, db, cb, vdi, base_id, image_utils,
+                                created, first_path)
+                            db.update_vdi_volume_id(vdi.uuid, leaf.id)
+                            db.update_volume_psize(
+                                base_id, cb.volumeGetPhysSize(
+                                    opq, str(base_id)))
+
+                        volumes = [first] + [
+                            COWVolume._copy_child(
+                                dbg, opq, db, cb, vdi, base_id, image_utils,
+                                created, first_path)
+                            for _ in range(count - 1)]
+                        for volume in volumes:
+                            clone_uuid = str(uuid.uuid4())
+                            db.insert_vdi(vdi.name, vdi.description,
+                                          clone_uuid, volume.id, vdi.sharable)
+                            clones.append((clone_uuid, volume))
+                except Exception:
+                    # The transaction was rolled back
+                    COWVolume._destroy_created(dbg, opq, cb, created)
+                    raise
+
+            uri_prefix = image_format.uri_prefix + cb.getVolumeUriPrefix(opq)
+            return [
+                COWVolume._clone_info(
+                    vdi, new_uuid, uri_prefix + new_uuid,
+                    cb.volumeGetPhysSize(opq, str(new_volume.id)), False)
+                for new_uuid, new_volume in clones
+            ]
+
+    @staticmethod
+    def _unpause(dbg, opq, cb, vdi, leaf_path):
+        """
+        Resume the datapath of a VDI on 'leaf_path', return False on
+        failure
+        """
+        try:
+            ImageFormat.get_format(vdi.image_type).image_utils \
+                .unpause_datapath(
+                    dbg, cb.get_data_metadata_path(opq, vdi.uuid), leaf_path)
+            return True
+        except Exception as exc:
+            log.error('{}: cannot unpause the datapath of {}: {}'.format(
+                dbg, vdi.uuid, exc))
+            return False
+
     @staticmethod
     def stat(dbg, sr, key, cb):
         image_format = None
@@ -289,38 +614,73 @@ class COWVolume(object):
         }
 
     @staticmethod
-    def ls(dbg, sr, cb):
+    def _ls_results(dbg, opq, cb, vdis, all_custom_keys, psize_max_age):
         results = []
+        psizes = psizecache.get_psizes(dbg, opq, cb, vdis, psize_max_age)
+
+        for vdi, psize in zip(vdis, psizes):
+            image_format = ImageFormat.get_format(vdi.image_type)
+
+            vdi_uri = cb.getVolumeUriPrefix(opq) + vdi.uuid
+            custom_keys = {}
+            if vdi.uuid in all_custom_keys:
+                custom_keys = all_custom_keys[vdi.uuid]
+
+            results.append({
+                'uuid': vdi.uuid,
+                'key': vdi.uuid,
+                'name': vdi.name,
+                'description': vdi.description,
+                'read_write': True,
+                'virtual_size': vdi.volume.vsize,
+                'physical_utilisation': psize,
+                'uri': [image_format.uri_prefix + vdi_uri],
+                'keys': custom_keys,
+                'sharable': bool(vdi.sharable)
+            })
+
+        return results
+
+    @staticmethod
+    def ls(dbg, sr, cb):
         with VolumeContext(cb, sr, 'r') as opq:
             with cb.db_context(opq) as db:
                 vdis = db.get_all_vdis()
                 all_custom_keys = db.get_all_vdi_custom_keys()
+                _vdis_sanitize(vdis, opq, db, cb)
+                psize_max_age = db.psize_max_age
 
-            for vdi in vdis:
-                _vdi_sanitize(vdi, opq, db, cb)
+            return COWVolume._ls_results(
+                dbg, opq, cb, vdis, all_custom_keys, psize_max_age)
 
-                image_format = ImageFormat.get_format(vdi.image_type)
-
-                psize = cb.volumeGetPhysSize(opq, str(vdi.volume.id))
-                vdi_uri = cb.getVolumeUriPrefix(opq) + vdi.uuid
-                custom_keys = {}
-                if vdi.uuid in all_custom_keys:
-                    custom_keys = all_custom_keys[vdi.uuid]
-
-                results.append({
-                    'uuid': vdi.uuid,
-                    'key': vdi.uuid,
-                    'name': vdi.name,
-                    'description': vdi.description,
-                    'read_write': True,
-                    'virtual_size': vdi.volume.vsize,
-                    'physical_utilisation': psize,
-                    'uri': [image_format.uri_prefix + vdi_uri],
-                    'keys': custom_keys,
-                    'sharable': bool(vdi.sharable)
-                })
+    @staticmethod
+    def ls_since(dbg, sr, generation, cb):
+        """
+        Incremental SR.ls: return the VDIs changed and the uuids of the
+        VDIs deleted since 'generation', the generation of a previous
+        call or 0, and the generation to pass to the next call.
 
-        return results
+        The listing is full ('full' set) when the tombstones of the
+        deletions since 'generation' were pruned or 'generation' is not
+        one of this SR.
+        """
+        with VolumeContext(cb, sr, 'r') as opq:
+            with cb.db_context(opq) as db:
+                full, vdis, all_custom_keys, deleted = \
+                    db.get_vdi_changes(generation)
+                _vdis_sanitize(vdis, opq, db, cb)
+                psize_max_age = db.psize_max_age
+                # Changes made from now on, such as the physical sizes
+                # measured below, are reported by the next call
+                new_generation = db.generation
+
+            return {
+                'generation': new_generation,
+                'full': full,
+                'vdis': COWVolume._ls_results(
+                    dbg, opq, cb, vdis, all_custom_keys, psize_max_age),
+                'deleted': deleted
+            }
 
     @staticmethod
     def set(dbg, sr, key, custom_key, value, cb):
@@ -352,7 +712,8 @@ class COWVolume(object):
         with VolumeContext(cb, sr, 'w') as opq:
             with cb.db_context(opq) as db:
                 provisioned_size = db.get_non_leaf_total_psize()
-                for vdi in db.get_all_vdis():
-                    _vdi_sanitize(vdi, opq, db, cb)
+                vdis = db.get_all_vdis()
+                _vdis_sanitize(vdis, opq, db, cb)
+                for vdi in vdis:
                     provisioned_size += vdi.volume.vsize
         return provisioned_size
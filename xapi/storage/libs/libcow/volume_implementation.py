@@ -11,9 +11,15 @@ class Implementation(xapi.storage.api.v5.volume.Volume_skeleton):
     def clone(self, dbg, sr, key):
         return COWVolume.clone(dbg, sr, key, self.callbacks)
 
+    def clone_many(self, dbg, sr, key, count):
+        return COWVolume.clone_many(dbg, sr, key, count, self.callbacks)
+
     def snapshot(self, dbg, sr, key):
         return COWVolume.snapshot(dbg, sr, key, self.callbacks)
 
+    def snapshot_batch(self, dbg, sr, keys):
+        return COWVolume.snapshot_batch(dbg, sr, keys, self.callbacks)
+
     def create(self, dbg, sr, name, description, size, sharable):
         return COWVolume.create(
             dbg,
@@ -0,0 +1,145 @@
+"""
+Pool of spare volumes taking the creation of the volumes out of the
+foreground operations.
+
+The supervisor keeps 'volume_pool_size' spare volumes for each of the
+POOL_SIZE_CLASSES size classes most used by the VDIs of an SR, the GC
+leader fills the pool of a shared SR. A spare is a row of the volume
+table listed in spare_volume, hence neither garbage nor a VDI, whose
+container holds an empty raw image of the size of its class.
+
+Volume.create, the clones and the reset of non-persistent VDIs claim a
+spare of the size class of the new volume under the global SR lock: the
+metabase turns the spare into the new volume, then the container and its
+image are resized. Only the image of a child, which embeds its parent,
+is still written in the foreground.
+"""
+
+from __future__ import absolute_import
+
+from xapi.storage import log
+from xapi.storage.libs.libcow.callbacks import VolumeContext
+from xapi.storage.libs.libcow.imageformat import ImageFormat
+from xapi.storage.libs.libcow.lease import GCLease
+
+MEBIBYTE = 2**20
+
+# Size classes of an SR for which spares are kept
+POOL_SIZE_CLASSES = 4
+
+# Period at which the pool is refilled, in seconds
+REFILL_INTERVAL = 5
+
+_DBG = 'volume_pool'
+
+
+def size_class(vsize):
+    """
+    Size class of a volume of 'vsize' bytes: the largest power of two
+    number of MiB not above it
+    """
+    return 1 << (max(int(vsize), MEBIBYTE).bit_length() - 1)
+
+
+def _empty_image(dbg, path, vsize):
+    """
+    Turn the image of a volume into an empty raw image of 'vsize' bytes.
+    Block devices, e.g. zvols, are left as they are.
+    """
+    raw_utils = ImageFormat.get_format(ImageFormat.IMAGE_RAW).image_utils
+    # Dropping the previous image first zeroes the blocks it used
+    raw_utils.create(dbg, path, 0)
+    raw_utils.create(dbg, path, vsize // MEBIBYTE)
+
+
+def claim(dbg, opq, db, callbacks, vsize, image_type, parent_id=None):
+    """
+    Take a spare volume for a new volume of 'vsize' bytes and
+    'image_type', child of 'parent_id' if not None. Return None if the
+    pool has no spare of its size class. Must be called in the
+    transaction that uses the volume.
+
+    A new base volume holds an empty raw image of 'vsize' bytes, the
+    container of a child is emptied for the caller to write its image, as
+    after Callbacks.volumeCreate().
+    """
+    volume = db.claim_spare_volume(
+        size_class(vsize), vsize, image_type, parent_id)
+    if volume is None:
+        return None
+    log.debug('{}: claimed spare volume {}'.format(dbg, volume.id))
+    callbacks.volumeResize(opq, str(volume.id), vsize)
+    _empty_image(dbg, callbacks.volumeGetPath(opq, str(volume.id)),
+                 vsize if parent_id is None else 0)
+    return volume
+
+
+def _wanted_classes(db):
+    """
+    The POOL_SIZE_CLASSES size classes with the most VDIs
+    """
+    counts = {}
+    for vsize, num in db.get_vdi_vsizes().items():
+        counts[size_class(vsize)] = counts.get(size_class(vsize), 0) + num
+    return sorted(counts, key=lambda cls: (-counts[cls], cls))[
+        :POOL_SIZE_CLASSES]
+
+
+def refill(uri, callbacks):
+    """
+    Bring the spare volumes of an SR to its configured number per size
+    class, destroying those of the classes no longer used
+    """
+    with VolumeContext(callbacks, uri, 'w') as opq:
+        with callbacks.db_context(opq) as db:
+            pool_size = db.volume_pool_size
+            wanted = _wanted_classes(db) if pool_size > 0 else []
+            spares = {}
+            for volume in db.get_spare_volumes():
+                spares.setdefault(volume.vsize, []).append(volume)
+
+        # Each spare is committed on its own so that the operations
+        # claiming them do not wait for the whole pool
+        for vsize in wanted:
+            for _ in range(pool_size - len(spares.get(vsize, []))):
+                with callbacks.db_context(opq) as db:
+                    volume = db.insert_spare_volume(
+                        vsize, ImageFormat.IMAGE_RAW)
+                    path = callbacks.volumeCreate(
+                        opq, str(volume.id), vsize)
+                    _empty_image(_DBG, path, vsize)
+
+        for vsize, volumes in spares.items():
+            keep = pool_size if vsize in wanted else 0
+            for _ in range(len(volumes) - keep):
+                with callbacks.db_context(opq) as db:
+                    volume = db.claim_spare_volume(
+                        vsize, vsize, ImageFormat.IMAGE_RAW)
+                    if volume is None:
+                        break
+                    db.delete_volume(volume.id)
+                    callbacks.volumeDestroy(opq, str(volume.id))
+
+
+def run_pool(job):
+    """
+    Keep the pool of spare volumes of an SR full until the job is
+    stopped. On a shared SR only the GC leader fills it.
+    """
+    uri, callbacks = job.uri, job.callbacks
+    this_host = callbacks.get_current_host()
+    with VolumeContext(callbacks, uri, 'w') as opq:
+        if not callbacks.has_volume_pool(opq):
+            log.debug('{}: {} has no volume pool'.format(_DBG, uri))
+            return
+        lease = None
+        if callbacks.is_shared(opq):
+            lease = GCLease(opq, callbacks, this_host)
+    while not job.stopping:
+        if lease is None or lease.holder() == this_host:
+            try:
+                refill(uri, callbacks)
+            except Exception as exc:
+                log.error('{}: cannot refill the pool of {}: {}'.format(
+                    _DBG, uri, exc))
+        job.sleep(REFILL_INTERVAL)
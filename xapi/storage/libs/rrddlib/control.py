@@ -108,12 +108,16 @@ class PluginControl(object):
     def fast_update(self, datasource_list):
         self.__mmap.fast_update(datasource_list)
 
-    def wake_up_before_next_reading(self):
+    def wake_up_before_next_reading(self, sleep=None):
         """Block until next rrdd stats reading
 
         Args:
-            time_to_reading: seconds this function returns
-                             before the next reading from rrdd
+            sleep: function called to wait a number of seconds, which
+                   can return False to give up waiting (default:
+                   time.sleep)
+
+        Returns:
+            False if 'sleep' gave up waiting, True otherwise
 
         The xcp-rrdd daemon reads the files written by registered plugins
         in pre-determined time intervals. This function coordinates this
@@ -124,9 +128,12 @@ class PluginControl(object):
         for the plugin to collect its data; however, it should also not
         be much larger, since this decreases the freshness of the data.
         """
-        from time import sleep
+        from time import sleep as time_sleep
         from socket import error as socket_error
 
+        if sleep is None:
+            sleep = time_sleep
+
         while True:
             try:
                 wait_time = self.__register() - self.__time_to_reading
@@ -134,10 +141,10 @@ class PluginControl(object):
                 if wait_time < 0:
                     wait_time = READ_FREQS[self.__read_freq] - wait_time
 
-                sleep(wait_time)
-                return
+                return sleep(wait_time) is not False
             except socket_error:
                 # Log this thing instead of stderr
                 msg = "Failed to contact xcp-rrdd. Sleeping for 5 seconds.."
                 print msg
-                sleep(5.0)
+                if sleep(5.0) is False:
+                    return False
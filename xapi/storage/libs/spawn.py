@@ -0,0 +1,142 @@
+"""
+Process spawning backends used to run external commands.
+
+Python 2 'subprocess.Popen(close_fds=True)' closes every descriptor up to
+SC_OPEN_MAX in the child, one syscall each. With a high 'nofile' limit
+this costs milliseconds per command. The backends below only close the
+descriptors that are really open:
+
+    subprocess32  C implementation walking /proc/self/fd (if installed)
+    procfd        flags close-on-exec, in the parent, the descriptors
+                  listed in /proc/self/fd
+    subprocess    stock Python 2 behaviour
+
+The procfd backend runs no Python code between fork and exec, which could
+deadlock on a lock held by another thread at fork time (the GIL, the
+import lock, a logging handler...), so it is safe in multi-threaded
+processes such as the supervisor. Its spawns are serialized: the pipes
+of a child started by another thread are flagged before the next fork.
+A descriptor opened by another thread while a child is being spawned,
+without going through popen(), may still be inherited by that child.
+
+The backend can be forced with the XAPI_STORAGE_SPAWN_BACKEND environment
+variable.
+
+Run this module to compare the per-spawn latency of each backend:
+
+    ulimit -n 1048576; python -m xapi.storage.libs.spawn
+"""
+
+from __future__ import absolute_import, division
+import fcntl
+import os
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import subprocess32
+except ImportError:
+    subprocess32 = None
+
+SPAWN_BACKEND_ENV = 'XAPI_STORAGE_SPAWN_BACKEND'
+PIPE = subprocess.PIPE
+
+
+_procfd_lock = threading.Lock()
+
+
+def _set_inherited_fds_cloexec():
+    """
+    Flag close-on-exec the descriptors a child would inherit through exec.
+    """
+    for name in os.listdir('/proc/self/fd'):
+        fd = int(name)
+        if fd <= 2:
+            continue
+        try:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            if not flags & fcntl.FD_CLOEXEC:
+                fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        except (IOError, OSError):
+            # The descriptor used by listdir() is already closed
+            pass
+
+
+def _popen_subprocess(cmd_args, **kwargs):
+    return subprocess.Popen(cmd_args, close_fds=True, **kwargs)
+
+
+def _popen_procfd(cmd_args, **kwargs):
+    with _procfd_lock:
+        _set_inherited_fds_cloexec()
+        return subprocess.Popen(cmd_args, close_fds=False, **kwargs)
+
+
+def _popen_subprocess32(cmd_args, **kwargs):
+    return subprocess32.Popen(cmd_args, close_fds=True, **kwargs)
+
+
+BACKENDS = {
+    'subprocess': _popen_subprocess,
+    'procfd': _popen_procfd,
+}
+if subprocess32 is not None:
+    BACKENDS['subprocess32'] = _popen_subprocess32
+
+_backend = None
+
+
+def get_backend():
+    """
+    Name of the backend used by popen()
+    """
+    global _backend
+    if _backend is None:
+        name = os.environ.get(SPAWN_BACKEND_ENV)
+        if name not in BACKENDS:
+            name = 'subprocess32' if subprocess32 is not None else 'procfd'
+        _backend = name
+    return _backend
+
+
+def set_backend(name):
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError("Unknown spawn backend '{}', expected one of {}"
+                         .format(name, ', '.join(sorted(BACKENDS))))
+    _backend = name
+
+
+def popen(cmd_args, **kwargs):
+    """
+    Start 'cmd_args' without leaking descriptors, returns a Popen object
+    """
+    return BACKENDS[get_backend()](cmd_args, **kwargs)
+
+
+def benchmark(backend, cmd_args, iterations):
+    """
+    Return the mean latency in seconds to spawn and reap 'cmd_args'
+    """
+    spawn = BACKENDS[backend]
+    start = time.time()
+    for _ in range(iterations):
+        proc = spawn(cmd_args, stdout=PIPE, stderr=PIPE)
+        proc.communicate()
+    return (time.time() - start) / iterations
+
+
+def main(argv):
+    iterations = int(argv[1]) if len(argv) > 1 else 200
+    cmd_args = argv[2:] or ['/bin/true']
+    print('SC_OPEN_MAX={} iterations={} cmd={}'.format(
+        os.sysconf('SC_OPEN_MAX'), iterations, ' '.join(cmd_args)))
+    for backend in sorted(BACKENDS):
+        latency = benchmark(backend, cmd_args, iterations)
+        print('{:>12}: {:8.3f} ms/spawn'.format(backend, latency * 1000))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
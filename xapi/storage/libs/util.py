@@ -6,6 +6,7 @@ import importlib
 import inspect
 import json
 import os
+import Queue
 import shutil
 import signal
 import stat
@@ -13,9 +14,12 @@ import string
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import urlparse
 
 from xapi.storage import log
+from xapi.storage.libs import spawn
 from xapi import Rpc_light_failure
 
 
@@ -78,19 +82,138 @@ def unlock_file(dbg, filehandle):
     filehandle.close()
 
 
-def call_unlogged(dbg, cmd_args, error=True, simple=True, exp_rc=0):
+def _kill(process):
+    try:
+        process.kill()
+    except OSError as exc:
+        if exc.errno != errno.ESRCH:
+            raise
+
+
+def _kill_timed_out(process, timed_out):
+    timed_out.append(True)
+    _kill(process)
+
+
+class Interrupted(Exception):
+    """
+    Raised in a thread whose Interruption was interrupted
+    """
+    pass
+
+
+class Interruption(object):
+    """
+    Way to stop a background task at once, even in the middle of a long
+    command.
+
+    The threads of the task enter it with set_interruption(). interrupt()
+    kills the commands they run through call() and makes them raise
+    Interrupted from call() and check_interrupted().
+    """
+
+    def __init__(self):
+        self.interrupted = False
+        self.__processes = set()
+        self.__lock = threading.Lock()
+
+    def add_process(self, process):
+        with self.__lock:
+            if not self.interrupted:
+                self.__processes.add(process)
+                return
+        _kill(process)
+
+    def remove_process(self, process):
+        with self.__lock:
+            self.__processes.discard(process)
+
+    def interrupt(self):
+        """
+        May be called from any thread
+        """
+        with self.__lock:
+            self.interrupted = True
+            processes, self.__processes = self.__processes, set()
+        for process in processes:
+            _kill(process)
+
+    def check(self):
+        if self.interrupted:
+            raise Interrupted('interrupted')
+
+
+_interruption = threading.local()
+
+
+def set_interruption(interruption):
+    """
+    Make the current thread stop when 'interruption' is interrupted, None
+    to leave it
+    """
+    _interruption.current = interruption
+
+
+def get_interruption():
+    return getattr(_interruption, 'current', None)
+
+
+def check_interrupted():
+    """
+    Raise Interrupted if the task of the current thread is interrupted
+    """
+    interruption = get_interruption()
+    if interruption is not None:
+        interruption.check()
+
+
+def call_unlogged(dbg, cmd_args, error=True, simple=True, exp_rc=0,
+                  timeout=None, throttle=None):
     """[call dbg cmd_args] executes [cmd_args]
     if [error] and exit code != exp_rc, log and throws a BackendError
     if [simple], returns only stdout
+    if [timeout], kills the command after [timeout] seconds and throws
+    if [throttle], paces the I/O of the command with this IOThrottle
     """
-    p = subprocess.Popen(
+    p = spawn.popen(
         cmd_args,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        close_fds=True
+        stdout=spawn.PIPE,
+        stderr=spawn.PIPE
     )
 
-    stdout, stderr = p.communicate()
+    timer = None
+    timed_out = []
+    if timeout is not None:
+        timer = threading.Timer(timeout, _kill_timed_out, [p, timed_out])
+        timer.daemon = True
+        timer.start()
+    interruption = get_interruption()
+    if interruption is not None:
+        interruption.add_process(p)
+    pacer = None
+    if throttle is not None:
+        pacer = throttle.start(p)
+    try:
+        stdout, stderr = p.communicate()
+    finally:
+        if pacer:
+            pacer.stop()
+        if timer:
+            timer.cancel()
+            timer.join()
+        if interruption is not None:
+            interruption.remove_process(p)
+
+    if interruption is not None and interruption.interrupted:
+        log.debug("{}: {} interrupted".format(dbg, ' '.join(cmd_args)))
+        raise Interrupted('interrupted')
+
+    if timed_out:
+        log.error("{}: {} killed after {} second(s)".format(
+            dbg, ' '.join(cmd_args), timeout))
+        raise CommandException(
+            p.returncode, cmd=str(cmd_args),
+            reason='timed out after {} second(s)'.format(timeout))
 
     if error and p.returncode != exp_rc:
         log.error(
@@ -110,13 +233,220 @@ def call_unlogged(dbg, cmd_args, error=True, simple=True, exp_rc=0):
     return stdout, stderr, p.returncode
 
 
-def call(dbg, cmd_args, error=True, simple=True, exp_rc=0):
+def call(dbg, cmd_args, error=True, simple=True, exp_rc=0, timeout=None,
+         throttle=None):
     """[call dbg cmd_args] executes [cmd_args]
     if [error] and exit code != exp_rc, log and throws a BackendError
     if [simple], returns only stdout
+    if [timeout], kills the command after [timeout] seconds and throws
+    if [throttle], paces the I/O of the command with this IOThrottle
     """
     log.debug("{}: Running cmd {}".format(dbg, cmd_args))
-    return call_unlogged(dbg, cmd_args, error, simple, exp_rc)
+    return call_unlogged(dbg, cmd_args, error, simple, exp_rc, timeout,
+                         throttle)
+
+
+# Default number of threads used to run independent jobs
+PARALLEL_MAX_WORKERS = 8
+
+
+class ParallelException(Exception):
+    """
+    Raised by parallel_map() when some jobs failed.
+
+    'errors' is the list of (item, exception) of the failed jobs.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        Exception.__init__(self, '{} job(s) failed: {}'.format(
+            len(errors),
+            '; '.join('{}: {}'.format(item, exc) for item, exc in errors)))
+
+
+def parallel_map(dbg, function, items, max_workers=PARALLEL_MAX_WORKERS):
+    """Apply 'function' to every item using a bounded pool of threads.
+
+    The worker threads inherit the Interruption of the calling thread
+    (see set_interruption()) and its stack of active CommandCaches, so
+    the jobs can be stopped and share the cached command outputs like
+    the caller.
+
+    Args:
+        function (callable): called with one item, it must not depend
+            on the other jobs
+        items (iterable): arguments of the jobs
+        max_workers (int): maximum number of jobs running at once
+
+    Returns:
+        (list) results, in the order of 'items'
+
+    Raises:
+        ParallelException once all the jobs are done, if any failed
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    pending = Queue.Queue()
+    for index in range(len(items)):
+        pending.put(index)
+    interruption = get_interruption()
+    caches = list(_active_command_caches())
+
+    def worker():
+        set_interruption(interruption)
+        _command_caches.stack = list(caches)
+        while True:
+            try:
+                index = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = function(items[index])
+            except Exception as exc:
+                log.error("{}: parallel job {} failed: {}".format(
+                    dbg, items[index], exc))
+                errors.append((items[index], exc))
+
+    workers = [
+        threading.Thread(target=worker)
+        for _ in range(min(max_workers, len(items)))
+    ]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    if errors:
+        raise ParallelException(errors)
+    return results
+
+
+def call_parallel(dbg, cmds, error=True, simple=True, exp_rc=0,
+                  timeout=None, max_workers=PARALLEL_MAX_WORKERS):
+    """Run independent commands concurrently, see call() and
+    parallel_map()
+
+    Returns:
+        (list) outputs, in the order of 'cmds'
+    """
+    return parallel_map(
+        dbg,
+        lambda cmd_args: call(
+            dbg, cmd_args, error, simple, exp_rc, timeout),
+        cmds,
+        max_workers
+    )
+
+
+class CommandCache(object):
+    """
+    Memoised output of read-only commands, see cached_call().
+
+    Used as a context manager, the cache is active in the current thread,
+    and the parallel_map() jobs it starts, until the block exits.
+    VolumeContext opens one for the duration of each operation.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        _active_command_caches().append(self)
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        _active_command_caches().remove(self)
+        return False
+
+    def key_lock(self, key):
+        """
+        Lock serializing the concurrent misses on the same command
+        """
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def lookup(self, key):
+        """
+        Return (found, output) for the command 'key'
+        """
+        with self._lock:
+            if key in self._entries:
+                return True, self._entries[key][1]
+        return False, None
+
+    def store(self, key, tags, output):
+        with self._lock:
+            self._entries[key] = (frozenset(tags), output)
+
+    def invalidate(self, tags=None):
+        """
+        Forget the entries sharing a tag with 'tags', or all of them
+        """
+        with self._lock:
+            if tags is None:
+                self._entries.clear()
+                return
+            tags = frozenset(tags)
+            for key in [key for key, (entry_tags, _) in self._entries.items()
+                        if entry_tags & tags]:
+                del self._entries[key]
+
+
+_command_caches = threading.local()
+
+
+def _active_command_caches():
+    """
+    CommandCaches active in the current thread, innermost last
+    """
+    caches = getattr(_command_caches, 'stack', None)
+    if caches is None:
+        caches = _command_caches.stack = []
+    return caches
+
+
+def cached_call(dbg, cmd_args, tags=(), caller=call):
+    """Run a read-only command, reusing the output of an identical one.
+
+    Outside of an active CommandCache this is a plain call.
+
+    Args:
+        cmd_args (list): command to run, also the cache key
+        tags (iterable): labels of the objects the output depends on,
+            see invalidate_cached_calls()
+        caller (callable): runs the command on a cache miss,
+            call(dbg, cmd_args) by default
+    """
+    caches = list(reversed(_active_command_caches()))
+    if not caches:
+        return caller(dbg, cmd_args)
+
+    key = tuple(cmd_args)
+    with caches[0].key_lock(key):
+        for cache in caches:
+            found, output = cache.lookup(key)
+            if found:
+                log.debug(
+                    "{}: Reusing output of cmd {}".format(dbg, cmd_args))
+                return output
+
+        output = caller(dbg, cmd_args)
+        caches[0].store(key, tags, output)
+    return output
+
+
+def invalidate_cached_calls(tags=None):
+    """
+    Drop the cached outputs depending on 'tags' (all if None) from every
+    CommandCache active in the current thread. Must be called by the
+    helpers mutating them.
+    """
+    for cache in list(_active_command_caches()):
+        cache.invalidate(tags)
 
 
 def get_host_name_from_env():
@@ -212,14 +542,68 @@ def remove_path(path, force=False):
             raise
 
 
-def remove_folder_content(dirpath):
-    """Remove folder content and preserve main target folder."""
+# Largest part of a file freed at once by reap_file(), in bytes
+REAP_STEP = 1 << 30
+
+
+def reap_file(path, rate=0, sleep=time.sleep):
+    """Shrink a file from its end step by step, then unlink it.
+
+    Freeing all the extents of a huge file in a single unlink stalls
+    ext4 and NFS servers, every truncate frees at most REAP_STEP bytes.
+
+    Args:
+        path (str): file to remove, other file types are simply unlinked
+        rate (int): bytes freed per second, 0 for no limit
+        sleep (callable): waits between two steps, the file is left
+            partially shrunk if it returns False
+
+    Returns:
+        (bool) False if interrupted by 'sleep', True once removed
+    """
+    try:
+        st = os.lstat(path)
+    except OSError as exc:
+        if exc.errno == errno.ENOENT:
+            return True
+        raise
+
+    if stat.S_ISREG(st.st_mode) and st.st_size > REAP_STEP:
+        fd = os.open(path, os.O_WRONLY | os.O_NOFOLLOW)
+        try:
+            size = st.st_size
+            allocated = st.st_blocks * 512
+            while size > REAP_STEP:
+                size -= REAP_STEP
+                os.ftruncate(fd, size)
+                current = os.fstat(fd).st_blocks * 512
+                freed, allocated = allocated - current, current
+                if rate and freed > 0 and \
+                        sleep(float(freed) / rate) is False:
+                    return False
+        finally:
+            os.close(fd)
+
+    try:
+        os.unlink(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+    return True
+
+
+def remove_folder_content(dirpath, rate=0):
+    """Remove folder content and preserve main target folder.
+
+    Files are removed with reap_file() at 'rate' bytes/s (0: no limit).
+    """
     for filename in os.listdir(dirpath):
         filepath = os.path.join(dirpath, filename)
-        try:
-            shutil.rmtree(filepath)
-        except OSError:
-            os.remove(filepath)
+        if os.path.isdir(filepath) and not os.path.islink(filepath):
+            remove_folder_content(filepath, rate)
+            os.rmdir(filepath)
+        else:
+            reap_file(filepath, rate)
 
 
 def sanitise_name(name):
@@ -380,6 +764,41 @@ def create_storage_error(error_code, params):
     return xapi.XenAPIException(error_code, params)
 
 
+def sr_ls_since_commandline(impl):
+    """
+    Command line of SR.ls_since, which SR_commandline does not implement:
+    the arguments of SR.ls and a 'generation', see COWVolume.ls_since
+    """
+    import argparse
+    import xapi
+    use_json = '--json' in sys.argv or '-j' in sys.argv
+    try:
+        if use_json:
+            request = json.loads(sys.stdin.readline())
+        else:
+            parser = argparse.ArgumentParser(
+                description='[ls_since sr generation] returns the volumes '
+                            'of an attached SR changed since a generation.')
+            parser.add_argument(
+                '--json', action='store_const', const=True, default=False,
+                help='Read json from stdin, print json to stdout')
+            parser.add_argument(
+                'dbg', action='store', help='Debug context from the caller')
+            parser.add_argument(
+                'sr', action='store', help='The Storage Repository')
+            parser.add_argument(
+                'generation', action='store', type=int,
+                help='Generation returned by the previous call, or 0')
+            request = vars(parser.parse_args())
+        print(json.dumps(impl.ls_since(
+            request['dbg'], request['sr'], int(request['generation']))))
+    except Exception as exc:
+        if use_json:
+            xapi.handle_exception(exc)
+        else:
+            raise
+
+
 def daemonize():
     """
     Daemonize the process by disconnecting from stdin, out, err